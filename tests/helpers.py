@@ -0,0 +1,153 @@
+"""Yacbi projects with synthetic databases for tests."""
+import datetime
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import yacbi
+
+
+class ProjectTestCase(unittest.TestCase):
+    """Test case with an initialized, empty Yacbi project in a temporary
+    directory.
+
+    Rows are inserted directly into the database, so no files are parsed.
+    """
+
+    def setUp(self):
+        self.root = os.path.realpath(tempfile.mkdtemp())
+        yacbi.initialize_project(self.root)
+        yacbi.clear_query_cache()
+        self.conn = sqlite3.connect(self.get_db_file())
+        self.shard_conns = []
+
+    def tearDown(self):
+        for conn in self.shard_conns:
+            conn.close()
+        self.conn.close()
+        shutil.rmtree(self.root)
+        yacbi.clear_query_cache()
+
+    def get_db_file(self):
+        return os.path.join(self.root, '.yacbi', 'index.db')
+
+    def get_path(self, name):
+        return os.path.join(self.root, name)
+
+    def write_file(self, name, text):
+        with open(self.get_path(name), 'w') as f:
+            f.write(text)
+
+    def write_config(self, js):
+        with open(os.path.join(self.root, '.yacbi', 'config.json'), 'w') as f:
+            json.dump(js, f)
+
+    def add_shard(self, name, prefix):
+        """Give files under a prefix a shard of their own and connect to it.
+        """
+        config = yacbi._read_config(self.root)
+        shards = dict((n, os.path.relpath(p, self.root))
+                      for n, p in config.shards.iteritems())
+        shards[name] = prefix
+        self.write_config({'shards': shards})
+        yacbi._connect_to_shard(self.root, name).close()
+        conn = sqlite3.connect(yacbi._get_db_file(self.root, name))
+        self.shard_conns.append(conn)
+        return conn
+
+    def write_compile_commands(self, *names):
+        """Write a compilation database that compiles given sources."""
+        self.write_file('compile_commands.json', json.dumps([
+            {'directory': self.root,
+             'file': self.get_path(name),
+             'command': 'c++ -c {0}'.format(name)}
+            for name in names]))
+
+    def add_file(self, name, is_included=False, conn=None):
+        cur = (conn or self.conn).cursor()
+        cur.execute("""
+                    INSERT INTO files (
+                      path,
+                      working_dir,
+                      last_update,
+                      is_included)
+                    VALUES (?, ?, ?, ?)""",
+                    (self.get_path(name),
+                     self.root,
+                     datetime.datetime.now(),
+                     is_included))
+        return cur.lastrowid
+
+    def add_symbol(self, usr, name=None, conn=None):
+        cur = (conn or self.conn).cursor()
+        cur.execute("SELECT id FROM symbols WHERE usr = ?", (usr,))
+        symbol_id = cur.fetchone()
+        if symbol_id:
+            return symbol_id[0]
+        cur.execute("INSERT INTO symbols (usr, name) VALUES (?, ?)",
+                    (usr, name))
+        return cur.lastrowid
+
+    def add_ref(self,
+                usr,
+                file_id,
+                line,
+                column,
+                kind=101,
+                is_definition=False,
+                name=None,
+                length=None,
+                conn=None):
+        symbol_id = self.add_symbol(usr, name, conn)
+        (conn or self.conn).execute(
+            """
+            INSERT INTO refs (
+              symbol_id,
+              file_id,
+              line,
+              "column",
+              kind,
+              is_definition,
+              length)
+            VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            (symbol_id, file_id, line, column, kind, is_definition, length))
+
+    def add_base(self,
+                 derived_usr,
+                 base_usr,
+                 file_id,
+                 line,
+                 column=1,
+                 conn=None):
+        (conn or self.conn).execute(
+            """
+            INSERT INTO inheritance (
+              derived_symbol_id,
+              base_symbol_id,
+              file_id,
+              line,
+              "column")
+            VALUES (?, ?, ?, ?, ?)""",
+            (self.add_symbol(derived_usr, conn=conn),
+             self.add_symbol(base_usr, conn=conn),
+             file_id,
+             line,
+             column))
+
+    def add_include(self, including_file_id, included_file_id, line=1):
+        self.conn.execute(
+            """
+            INSERT INTO includes (
+              including_file_id,
+              included_file_id,
+              line,
+              "column")
+            VALUES (?, ?, ?, 1)""",
+            (including_file_id, included_file_id, line))
+
+    def commit(self, conn=None):
+        """Commit like indexing does, moving to the next generation."""
+        yacbi._commit_index(conn or self.conn)
@@ -0,0 +1,143 @@
+import sys
+import threading
+import time
+import traceback
+
+import yacbi
+
+from tests.helpers import ProjectTestCase
+
+
+# a statement that runs until it is interrupted; started() is called for
+# every row, i.e. while the statement is running
+ENDLESS_QUERY = """
+    WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c)
+    SELECT count(*) FROM c WHERE started()"""
+
+
+def wait_for(event, root):
+    event.wait()
+
+
+def run_endless(started, root):
+    def notify():
+        started.set()
+        return 1
+
+    with yacbi._open_dbs(root) as conns:
+        conn = conns.values()[0]
+        conn.create_function('started', 0, notify)
+        return conn.execute(ENDLESS_QUERY).fetchone()
+
+
+def fail(root):
+    raise ValueError("query failed")
+
+
+class AsyncProjectTest(ProjectTestCase):
+    def setUp(self):
+        ProjectTestCase.setUp(self)
+        self.a_id = self.add_file('a.cpp')
+        self.add_ref('c:@F@f#', self.a_id, 1, 5, 8, True)
+        self.add_ref('c:@F@f#', self.a_id, 2, 3, 103)
+        self.commit()
+        self.project = yacbi.AsyncProject(self.root, workers=1)
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.project.close()
+        ProjectTestCase.tearDown(self)
+
+    def block_worker(self):
+        return self.project.submit(lambda root: wait_for(self.release, root))
+
+    def test_submit(self):
+        future = self.project.query_references('c:@F@f#')
+        self.assertEqual(future.result(),
+                         yacbi.query_references(self.root, 'c:@F@f#'))
+        self.assertTrue(future.done())
+        self.assertFalse(future.cancelled())
+
+    def test_error_keeps_traceback(self):
+        future = self.project.submit(fail)
+        with self.assertRaises(ValueError):
+            try:
+                future.result()
+            except ValueError:
+                functions = [entry[2] for entry in
+                             traceback.extract_tb(sys.exc_info()[2])]
+                raise
+        self.assertEqual(functions[-1], 'fail')
+
+    def test_timeout(self):
+        self.block_worker()
+        future = self.project.query_references('c:@F@f#')
+        with self.assertRaises(RuntimeError):
+            future.result(0.01)
+
+    def test_cancel_pending(self):
+        blocker = self.block_worker()
+        future = self.project.query_references('c:@F@f#')
+        self.assertTrue(future.cancel())
+        self.assertTrue(future.done())
+        self.release.set()
+        blocker.result()
+        with self.assertRaises(yacbi.QueryCancelledError):
+            future.result()
+        self.assertTrue(future.cancelled())
+
+    def test_cancel_running(self):
+        started = threading.Event()
+        future = self.project.submit(lambda root: run_endless(started, root))
+        started.wait()
+        self.assertTrue(future.cancel())
+        with self.assertRaises(yacbi.QueryCancelledError):
+            future.result()
+        # the worker goes on serving queries
+        self.assertEqual(len(self.project.query_references(
+            'c:@F@f#').result()), 2)
+
+    def test_cancel_finished(self):
+        future = self.project.query_references('c:@F@f#')
+        future.result()
+        self.assertFalse(future.cancel())
+        self.assertFalse(future.cancelled())
+
+    def test_done_callbacks(self):
+        done = []
+        self.block_worker()
+        future = self.project.query_references('c:@F@f#')
+        future.add_done_callback(done.append)
+        self.assertEqual(done, [])
+        self.release.set()
+        future.result()
+        # the callback runs on the worker after the result is set
+        while not done:
+            time.sleep(0.01)
+        future.add_done_callback(done.append)
+        self.assertEqual(done, [future, future])
+
+    def test_failing_callback(self):
+        def callback(future):
+            raise ValueError("callback failed")
+
+        self.block_worker()
+        future = self.project.query_references('c:@F@f#')
+        future.add_done_callback(callback)
+        self.release.set()
+        self.assertEqual(len(future.result()), 2)
+
+    def test_close_cancels_queued_queries(self):
+        blocker = self.block_worker()
+        future = self.project.query_references('c:@F@f#')
+        closer = threading.Thread(target=self.project.close)
+        closer.start()
+        while self.project._threads:
+            time.sleep(0.01)
+        self.release.set()
+        closer.join()
+        self.assertIsNone(blocker.result())
+        self.assertTrue(future.cancelled())
+        with self.assertRaises(RuntimeError):
+            self.project.submit(fail)
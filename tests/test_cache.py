@@ -0,0 +1,69 @@
+import yacbi
+
+from tests.helpers import ProjectTestCase
+
+
+class QueryCacheTest(ProjectTestCase):
+    def setUp(self):
+        ProjectTestCase.setUp(self)
+        self.file_id = self.add_file('a.cpp')
+        self.add_ref('c:@F@foo#', self.file_id, 1, 5, 8, True, name='foo')
+        self.commit()
+
+    def get_counts(self):
+        stats = yacbi.get_query_cache_stats()
+        return stats.hits, stats.misses
+
+    def test_hit_and_miss(self):
+        refs = yacbi.query_references(self.root, 'c:@F@foo#')
+        self.assertEqual(self.get_counts(), (0, 1))
+        self.assertEqual(yacbi.query_references(self.root, 'c:@F@foo#'),
+                         refs)
+        self.assertEqual(self.get_counts(), (1, 1))
+        yacbi.query_references(self.root, 'c:@F@bar#')
+        self.assertEqual(self.get_counts(), (1, 2))
+
+    def test_none_result(self):
+        path = self.get_path('a.cpp')
+        self.assertIsNone(yacbi.query_symbol_at(self.root, path, 9, 1))
+        self.assertIsNone(yacbi.query_symbol_at(self.root, path, 9, 1))
+        self.assertEqual(self.get_counts(), (1, 1))
+
+    def test_invalidated_by_commit(self):
+        self.assertEqual(
+            len(yacbi.query_references(self.root, 'c:@F@foo#')), 1)
+        self.add_ref('c:@F@foo#', self.file_id, 7, 1, 103)
+        self.commit()
+        self.assertEqual(
+            len(yacbi.query_references(self.root, 'c:@F@foo#')), 2)
+        self.assertEqual(self.get_counts(), (0, 2))
+
+    def test_results_are_copies(self):
+        yacbi.query_references(self.root, 'c:@F@foo#').append(None)
+        self.assertEqual(
+            len(yacbi.query_references(self.root, 'c:@F@foo#')), 1)
+
+    def test_failure_diagnostics_are_immutable(self):
+        self.conn.execute("""
+            INSERT INTO failures (id, path, fingerprint, last_attempt)
+            VALUES (1, ?, '', '2000-01-01 00:00:00')""",
+                          (self.get_path('b.cpp'),))
+        self.conn.execute("""
+            INSERT INTO failure_diagnostics (
+              failure_id, path, line, "column", spelling)
+            VALUES (1, ?, 1, 1, 'error')""",
+                          (self.get_path('b.cpp'),))
+        self.commit()
+        failures = yacbi.query_failures(self.root)
+        self.assertEqual(len(failures[0].diagnostics), 1)
+        self.assertIsInstance(failures[0].diagnostics, tuple)
+        self.assertEqual(yacbi.query_failures(self.root), failures)
+
+    def test_disabled(self):
+        yacbi.configure_query_cache(0)
+        try:
+            yacbi.query_references(self.root, 'c:@F@foo#')
+            yacbi.query_references(self.root, 'c:@F@foo#')
+            self.assertEqual(self.get_counts(), (0, 0))
+        finally:
+            yacbi.configure_query_cache(yacbi._DEFAULT_QUERY_CACHE_SIZE)
@@ -0,0 +1,26 @@
+import json
+import os
+
+import yacbi
+
+from tests.helpers import ProjectTestCase
+
+
+class ConfigTest(ProjectTestCase):
+    def write_config(self, js):
+        with open(os.path.join(self.root, '.yacbi', 'config.json'), 'w') as f:
+            json.dump(js, f)
+
+    def test_cached_until_changed(self):
+        self.write_config({'shards': {'lib': 'lib'}})
+        config = yacbi._read_config(self.root)
+        self.assertIs(yacbi._read_config(self.root), config)
+        self.assertEqual(yacbi._get_shards(self.root), [None, 'lib'])
+        self.write_config({'shards': {'lib': 'lib', 'app': 'app'}})
+        self.assertEqual(yacbi._get_shards(self.root), [None, 'app', 'lib'])
+
+    def test_removed_config(self):
+        self.write_config({'quick_tier_macros': False})
+        self.assertFalse(yacbi._read_config(self.root).quick_tier_macros)
+        os.remove(os.path.join(self.root, '.yacbi', 'config.json'))
+        self.assertTrue(yacbi._read_config(self.root).quick_tier_macros)
@@ -0,0 +1,102 @@
+import json
+import StringIO
+
+import yacbi
+
+from tests.helpers import ProjectTestCase
+
+
+class ExportTest(ProjectTestCase):
+    def setUp(self):
+        ProjectTestCase.setUp(self)
+        self.a_id = self.add_file('a.cpp')
+        self.add_ref('c:@F@f#', self.a_id, 1, 5, 8, True, name='f')
+        self.add_ref('c:@F@g#', self.a_id, 2, 5, 8, name='g')
+        self.add_ref('c:@F@g#', self.a_id, 3, 3, 103)
+        self.add_ref('c:@S@Old', self.a_id, 4, 8, 4, True)
+        self.b_id = self.add_file('b.cpp')
+        self.add_ref('c:@F@g#', self.b_id, 1, 5, 8, True)
+        self.commit()
+
+    def export(self, fmt, **kwargs):
+        output = StringIO.StringIO()
+        generation = yacbi.export_index(self.root, output, fmt, **kwargs)
+        return generation, output.getvalue()
+
+    def test_ctags(self):
+        _, text = self.export('ctags')
+        self.assertEqual(text.splitlines()[3:],
+                         ['f\t{0}\t1;"\tf'.format(self.get_path('a.cpp')),
+                          'g\t{0}\t2;"\tp'.format(self.get_path('a.cpp')),
+                          'g\t{0}\t1;"\tf'.format(self.get_path('b.cpp'))])
+
+    def test_jsonl(self):
+        generation, text = self.export('jsonl')
+        objs = [json.loads(line) for line in text.splitlines()]
+        self.assertEqual(objs[0], {'type': 'index',
+                                   'generation': generation})
+        self.assertEqual([(o['type'], o['path']) for o in objs[1:]],
+                         [('file', self.get_path('a.cpp'))] +
+                         [('ref', self.get_path('a.cpp'))] * 4 +
+                         [('file', self.get_path('b.cpp')),
+                          ('ref', self.get_path('b.cpp'))])
+        self.assertEqual(objs[4], {'type': 'ref',
+                                   'path': self.get_path('a.cpp'),
+                                   'line': 3,
+                                   'column': 3,
+                                   'usr': 'c:@F@g#',
+                                   'name': 'g',
+                                   'kind': 103,
+                                   'description': 'function call',
+                                   'is_definition': False})
+        self.assertIsNone(objs[5]['name'])
+
+    def test_since(self):
+        generation, _ = self.export('jsonl')
+        self.conn.execute("UPDATE files SET generation = ? WHERE id = ?",
+                          (generation + 1, self.b_id))
+        self.commit()
+        _, text = self.export('jsonl', since=generation)
+        b_path = self.get_path('b.cpp')
+        self.assertEqual([json.loads(line).get('path')
+                          for line in text.splitlines()],
+                         [None, b_path, b_path])
+
+    def test_worker_sees_later_changes(self):
+        with yacbi.AsyncProject(self.root, workers=1) as project:
+            project.submit(yacbi.export_index,
+                           StringIO.StringIO(),
+                           'jsonl').result()
+            self.add_ref('c:@F@f#', self.b_id, 2, 3, 103)
+            self.commit()
+            refs = project.query_references('c:@F@f#').result()
+        self.assertEqual(len(refs), 2)
+
+    def test_shards(self):
+        h_id = self.add_file('x.h', is_included=True)
+        self.add_ref('c:@F@h#', h_id, 1, 5, 8)
+        self.commit()
+        shard_conn = self.add_shard('lib', 'lib')
+        c_id = self.add_file('lib/c.cpp', conn=shard_conn)
+        self.add_ref('c:@F@h#', c_id, 2, 3, 103, conn=shard_conn)
+        h_id = self.add_file('x.h', is_included=True, conn=shard_conn)
+        self.add_ref('c:@F@h#', h_id, 1, 5, 8, conn=shard_conn)
+        self.commit(shard_conn)
+        _, text = self.export('jsonl')
+        objs = [json.loads(line) for line in text.splitlines()[1:]]
+        self.assertEqual([o['path'] for o in objs if o['type'] == 'file'],
+                         [self.get_path(name)
+                          for name in ['a.cpp', 'b.cpp', 'lib/c.cpp', 'x.h']])
+        self.assertEqual(objs[-2:],
+                         [{'type': 'file',
+                           'path': self.get_path('x.h'),
+                           'generation': objs[-2]['generation']},
+                          {'type': 'ref',
+                           'path': self.get_path('x.h'),
+                           'line': 1,
+                           'column': 5,
+                           'usr': 'c:@F@h#',
+                           'name': None,
+                           'kind': 8,
+                           'description': 'function declaration',
+                           'is_definition': False}])
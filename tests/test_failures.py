@@ -0,0 +1,50 @@
+import os
+import time
+
+import yacbi
+
+from tests.helpers import ProjectTestCase
+
+
+class FingerprintTest(ProjectTestCase):
+    def setUp(self):
+        ProjectTestCase.setUp(self)
+        os.mkdir(self.get_path('include'))
+        self.src = self.get_path('a.cpp')
+        self.write(self.src, '#include "b.h"\n')
+        self.cmd = yacbi._CompileCommand(
+            self.src,
+            yacbi._CompileArgs(['-Iinclude', self.src], set(), False),
+            self.root,
+            False)
+
+    def write(self, path, text):
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def fingerprint(self, dependencies):
+        return yacbi._make_fingerprint(self.cmd, dependencies)
+
+    def test_unrelated_file_in_same_directory(self):
+        before = self.fingerprint([self.src])
+        time.sleep(0.01)
+        self.write(self.get_path('unrelated.txt'), '')
+        self.assertEqual(self.fingerprint([self.src]), before)
+
+    def test_changed_dependency(self):
+        before = self.fingerprint([self.src])
+        self.write(self.src, '#include "b.h"\nint x;\n')
+        self.assertNotEqual(self.fingerprint([self.src]), before)
+
+    def test_created_missing_header(self):
+        errors = [yacbi._Error("'b.h' file not found",
+                               yacbi.SourceLocation(self.src, 1, 10),
+                               None)]
+        missing = yacbi._get_missing_header_paths(self.cmd, errors)
+        self.assertEqual(missing,
+                         set([self.get_path('b.h'),
+                              self.get_path('include/b.h')]))
+        dependencies = [self.src] + sorted(missing)
+        before = self.fingerprint(dependencies)
+        self.write(self.get_path('include/b.h'), '')
+        self.assertNotEqual(self.fingerprint(dependencies), before)
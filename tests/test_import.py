@@ -0,0 +1,15 @@
+import os
+import subprocess
+import sys
+import unittest
+
+
+class ImportTest(unittest.TestCase):
+    def test_clang_is_not_imported(self):
+        # a fresh interpreter, because other tests may have imported clang
+        code = ("import sys, yacbi; "
+                "sys.exit('clang.cindex' in sys.modules)")
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(subprocess.call([sys.executable, '-c', code],
+                                         cwd=root),
+                         0)
@@ -0,0 +1,92 @@
+import imp
+import os
+import StringIO
+import sys
+import unittest
+
+import yacbi
+
+from tests.helpers import ProjectTestCase
+
+SCRIPT = os.path.join(os.path.dirname(__file__), os.pardir, 'scripts', 'yacbi')
+
+
+class IndexFilesTest(ProjectTestCase):
+    def setUp(self):
+        ProjectTestCase.setUp(self)
+        self.write_file('x.h', 'int x();\n')
+        self.write_file('y.h', 'int y();\n')
+        self.write_file('a.cpp',
+                        '#include "x.h"\n'
+                        '#include "y.h"\n'
+                        'int a() { return x() + y(); }\n')
+        self.write_file('b.cpp', '#include "x.h"\nint b() { return x(); }\n')
+        self.write_compile_commands('a.cpp', 'b.cpp')
+        yacbi.index(self.root)
+
+    def get_files(self):
+        return dict((path[len(self.root) + 1:], last_update)
+                    for path, last_update in self.conn.execute(
+                        "SELECT path, last_update FROM files"))
+
+    def get_calls(self, usr):
+        return sorted((r.location.filename[len(self.root) + 1:],
+                       r.location.line)
+                      for r in yacbi.query_references(self.root, usr)
+                      if r.kind == 103)
+
+    def test_reindexes_only_given_file(self):
+        before = self.get_files()
+        self.write_file('a.cpp',
+                        '#include "x.h"\n'
+                        '#include "y.h"\n'
+                        '\n'
+                        'int a() { return x() + y(); }\n')
+        self.write_file('b.cpp', '#include "x.h"\n\nint b() { return x(); }\n')
+        yacbi.index_files(self.root, [self.get_path('a.cpp')])
+        after = self.get_files()
+        self.assertNotEqual(after['a.cpp'], before['a.cpp'])
+        self.assertEqual(after['b.cpp'], before['b.cpp'])
+        self.assertEqual(self.get_calls('c:@F@x#'),
+                         [('a.cpp', 4), ('b.cpp', 2)])
+
+    def test_removes_header_no_longer_included(self):
+        self.write_file('a.cpp', '#include "x.h"\nint a() { return x(); }\n')
+        yacbi.index_files(self.root, [self.get_path('a.cpp')])
+        self.assertEqual(sorted(self.get_files()), ['a.cpp', 'b.cpp', 'x.h'])
+        self.assertEqual(self.get_calls('c:@F@y#'), [])
+        self.assertEqual(yacbi.query_definitions(self.root, 'c:@F@y#'), [])
+
+    def test_keeps_header_included_elsewhere(self):
+        self.write_file('b.cpp', 'int b() { return 0; }\n')
+        yacbi.index_files(self.root, [self.get_path('b.cpp')])
+        self.assertEqual(sorted(self.get_files()),
+                         ['a.cpp', 'b.cpp', 'x.h', 'y.h'])
+        self.assertEqual(self.get_calls('c:@F@x#'), [('a.cpp', 3)])
+
+
+class FileArgsTest(unittest.TestCase):
+    def setUp(self):
+        self.script = imp.load_source('yacbi_script', SCRIPT)
+        self.parser = self.script.create_argument_parser()
+
+    def check_rejected(self, *options):
+        args = self.parser.parse_args(
+            ['index', '--file', 'a.cpp'] + list(options))
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            with self.assertRaises(SystemExit) as cm:
+                self.script.index(args)
+            message = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(cm.exception.code, 2)
+        self.assertIn('argument {0}: not allowed with argument --file'.format(
+            options[0]), message)
+
+    def test_rejects_full_run_options(self):
+        self.check_rejected('--rebuild')
+        self.check_rejected('--tier', 'quick')
+        self.check_rejected('--retry-failed')
+        self.check_rejected('--prioritize', 'a.cpp')
+        self.check_rejected('--recent', '5')
@@ -0,0 +1,101 @@
+import os
+import sqlite3
+
+import yacbi
+
+from tests.helpers import ProjectTestCase
+
+
+# schema of databases created before generations and migrations
+_LEGACY_SCHEMA = """
+PRAGMA foreign_keys=ON;
+
+CREATE TABLE files (
+  id INTEGER NOT NULL,
+  path VARCHAR NOT NULL,
+  working_dir VARCHAR NOT NULL,
+  last_update DATETIME NOT NULL,
+  is_included BOOL NOT NULL,
+  PRIMARY KEY (id),
+  UNIQUE (path)
+);
+
+CREATE TABLE compile_args (
+  id INTEGER NOT NULL,
+  file_id INTEGER NOT NULL,
+  arg VARCHAR NOT NULL,
+  PRIMARY KEY (id),
+  FOREIGN KEY (file_id) REFERENCES files (id) ON DELETE CASCADE
+);
+
+CREATE TABLE includes (
+  including_file_id INTEGER NOT NULL,
+  included_file_id INTEGER NOT NULL,
+  line INTEGER NOT NULL,
+  "column" INTEGER NOT NULL,
+  PRIMARY KEY (including_file_id, included_file_id, line, "column"),
+  FOREIGN KEY (including_file_id) REFERENCES files (id) ON DELETE CASCADE,
+  FOREIGN KEY (included_file_id) REFERENCES files (id) ON DELETE CASCADE
+);
+
+CREATE TABLE symbols (
+  id INTEGER NOT NULL,
+  usr VARCHAR NOT NULL,
+  PRIMARY KEY (id),
+  UNIQUE (usr)
+);
+
+CREATE TABLE refs (
+  symbol_id INTEGER NOT NULL,
+  file_id INTEGER NOT NULL,
+  line INTEGER NOT NULL,
+  "column" INTEGER NOT NULL,
+  kind INTEGER NOT NULL,
+  is_definition BOOL NOT NULL,
+  PRIMARY KEY (symbol_id, file_id, line, "column"),
+  FOREIGN KEY (symbol_id) REFERENCES symbols (id) ON DELETE CASCADE,
+  FOREIGN KEY (file_id) REFERENCES files (id) ON DELETE CASCADE
+);
+"""
+
+
+class LegacyDatabaseTest(ProjectTestCase):
+    def setUp(self):
+        ProjectTestCase.setUp(self)
+        self.conn.close()
+        os.remove(self.get_db_file())
+        self.conn = sqlite3.connect(self.get_db_file())
+        self.conn.executescript(_LEGACY_SCHEMA)
+        a = self.add_file('a.cpp')
+        b = self.add_file('b.h', is_included=True)
+        self.add_include(a, b)
+        self.conn.execute(
+            "INSERT INTO symbols (id, usr) VALUES (1, 'c:@F@f#')")
+        self.conn.execute("""
+            INSERT INTO refs (
+              symbol_id, file_id, line, "column", kind, is_definition)
+            VALUES (1, ?, 3, 5, 8, 1)""", (a,))
+        self.conn.commit()
+
+    def check_queries(self):
+        a = self.get_path('a.cpp')
+        refs = yacbi.query_references(self.root, 'c:@F@f#')
+        self.assertEqual([r.location for r in refs],
+                         [yacbi.SourceLocation(a, 3, 5)])
+        self.assertEqual(yacbi.query_symbol_at(self.root, a, 3, 20).usr,
+                         'c:@F@f#')
+        includers = yacbi.query_including_files(self.root,
+                                                self.get_path('b.h'))
+        self.assertEqual([l.filename for l in includers], [a])
+        self.assertEqual(yacbi.query_failures(self.root), [])
+        self.assertEqual(yacbi.query_subtypes(self.root, 'c:@F@f#'), [])
+
+    def test_migrated_on_connect(self):
+        self.check_queries()
+        self.assertEqual(
+            self.conn.execute("PRAGMA user_version").fetchone()[0],
+            yacbi._SCHEMA_VERSION)
+        self.assertEqual(yacbi._query_generation(self.conn), 0)
+
+    def test_generation_without_meta(self):
+        self.assertEqual(yacbi._query_generation(self.conn), 0)
@@ -0,0 +1,84 @@
+import hashlib
+import os
+import sqlite3
+
+import yacbi
+
+from tests.helpers import ProjectTestCase
+from tests.test_legacy import _LEGACY_SCHEMA
+
+
+class MergeIndicesTest(ProjectTestCase):
+    def make_db(self, name, schema=None):
+        conn = sqlite3.connect(os.path.join(self.root, name))
+        if schema is None:
+            yacbi._create_schema(conn)
+        else:
+            conn.executescript(schema)
+        return conn
+
+    def merge(self, *conns):
+        inputs = []
+        for conn in conns:
+            conn.commit()
+            inputs.append(conn.execute("PRAGMA database_list").fetchone()[2])
+            conn.close()
+        self.conn.close()
+        yacbi.merge_indices(self.get_db_file(), inputs)
+        self.conn = sqlite3.connect(self.get_db_file())
+
+    def get_refs(self):
+        return yacbi.query_references(self.root, 'c:@F@f#')
+
+    def test_merge(self):
+        db1 = self.make_db('1.db')
+        a = self.add_file('a.cpp', conn=db1)
+        h = self.add_file('h.h', is_included=True, conn=db1)
+        self.add_ref('c:@F@f#', a, 3, 1, 103, conn=db1)
+        self.add_ref('c:@F@f#', h, 1, 6, 8, True, name='f', conn=db1)
+        db2 = self.make_db('2.db')
+        b = self.add_file('b.cpp', conn=db2)
+        self.add_ref('c:@F@f#', b, 5, 2, 103, conn=db2)
+        self.merge(db1, db2)
+        self.assertEqual(
+            [(r.location.filename, r.is_definition) for r in self.get_refs()],
+            [(self.get_path('h.h'), True),
+             (self.get_path('a.cpp'), False),
+             (self.get_path('b.cpp'), False)])
+        self.assertEqual(yacbi._query_generation(self.conn), 2)
+
+    def test_source_copy_wins(self):
+        db1 = self.make_db('1.db')
+        h = self.add_file('h.h', is_included=True, conn=db1)
+        self.add_ref('c:@F@f#', h, 1, 1, conn=db1)
+        db2 = self.make_db('2.db')
+        h = self.add_file('h.h', conn=db2)
+        self.add_ref('c:@F@f#', h, 2, 2, conn=db2)
+        self.merge(db1, db2)
+        self.assertEqual([r.location.line for r in self.get_refs()], [2])
+
+    def test_inputs_are_not_modified(self):
+        db = self.make_db('legacy.db', _LEGACY_SCHEMA)
+        a = self.add_file('a.cpp', conn=db)
+        db.execute("INSERT INTO symbols (id, usr) VALUES (1, 'c:@F@f#')")
+        db.execute("""
+            INSERT INTO refs (
+              symbol_id, file_id, line, "column", kind, is_definition)
+            VALUES (1, ?, 3, 5, 8, 1)""", (a,))
+        db.commit()
+        dbfile = os.path.join(self.root, 'legacy.db')
+        with open(dbfile, 'rb') as f:
+            digest = hashlib.sha1(f.read()).digest()
+        self.merge(db)
+        with open(dbfile, 'rb') as f:
+            self.assertEqual(hashlib.sha1(f.read()).digest(), digest)
+        src_conn = sqlite3.connect(dbfile)
+        try:
+            self.assertEqual(
+                src_conn.execute("PRAGMA user_version").fetchone()[0], 0)
+        finally:
+            src_conn.close()
+        self.assertEqual(
+            self.conn.execute("SELECT tier FROM files").fetchall(),
+            [(yacbi._TIERS['full'],)])
+        self.assertEqual(len(self.get_refs()), 1)
@@ -0,0 +1,199 @@
+import yacbi
+
+from tests.helpers import ProjectTestCase
+
+
+class SymbolAtTest(ProjectTestCase):
+    def setUp(self):
+        ProjectTestCase.setUp(self)
+        self.file_id = self.add_file('a.cpp')
+        self.add_ref('c:@F@foo#', self.file_id, 3, 5, 8, True, length=3)
+        self.add_ref('c:@F@bar#', self.file_id, 3, 12, 103, length=3)
+        self.commit()
+
+    def query(self, column):
+        ref = yacbi.query_symbol_at(self.root,
+                                    self.get_path('a.cpp'),
+                                    3,
+                                    column)
+        return ref.usr if ref else None
+
+    def test_inside_token(self):
+        self.assertEqual(self.query(5), 'c:@F@foo#')
+        self.assertEqual(self.query(7), 'c:@F@foo#')
+        self.assertEqual(self.query(14), 'c:@F@bar#')
+
+    def test_past_end_of_token(self):
+        self.assertIsNone(self.query(8))
+        self.assertIsNone(self.query(11))
+        self.assertIsNone(self.query(15))
+
+    def test_before_first_token(self):
+        self.assertIsNone(self.query(4))
+
+    def test_reference_without_length(self):
+        self.add_ref('c:@S@Old', self.file_id, 4, 1, 43)
+        self.commit()
+        ref = yacbi.query_symbol_at(self.root, self.get_path('a.cpp'), 4, 30)
+        self.assertEqual(ref.usr, 'c:@S@Old')
+
+    def test_stored_path(self):
+        ref = yacbi.query_symbol_at(self.root,
+                                    str(self.get_path('a.cpp')),
+                                    3,
+                                    5)
+        self.assertIsInstance(ref.reference.location.filename, unicode)
+
+
+class IndexedSymbolAtTest(ProjectTestCase):
+    def setUp(self):
+        ProjectTestCase.setUp(self)
+        self.write_file('a.cpp',
+                        'struct Leaf { Leaf(); };\n'
+                        'void f() { Leaf l; }\n')
+        self.write_compile_commands('a.cpp')
+        yacbi.index(self.root)
+
+    def query(self, column):
+        ref = yacbi.query_symbol_at(self.root,
+                                    self.get_path('a.cpp'),
+                                    2,
+                                    column)
+        return (ref.usr, ref.reference.kind) if ref else None
+
+    def test_constructor_call_bounded_by_variable_name(self):
+        self.assertEqual(self.query(15), ('c:@S@Leaf', 43))
+        self.assertEqual(self.query(17), ('c:a.cpp@36@F@f#@l', 9))
+        self.assertIsNone(self.query(18))
+
+
+class FileReferencesTest(ProjectTestCase):
+    def test_sorted_by_location(self):
+        file_id = self.add_file('a.cpp')
+        self.add_ref('c:@F@b#', file_id, 2, 1)
+        self.add_ref('c:@F@a#', file_id, 1, 7)
+        self.add_ref('c:@F@c#', file_id, 1, 3)
+        self.commit()
+        refs = yacbi.query_file_references(self.root, self.get_path('a.cpp'))
+        self.assertEqual([(r.usr,
+                           r.reference.location.line,
+                           r.reference.location.column) for r in refs],
+                         [('c:@F@c#', 1, 3),
+                          ('c:@F@a#', 1, 7),
+                          ('c:@F@b#', 2, 1)])
+
+
+class TransitiveIncludesTest(ProjectTestCase):
+    def setUp(self):
+        ProjectTestCase.setUp(self)
+        self.ids = {}
+        for name in ['a.cpp', 'b.cpp', 'x.h', 'y.h', 'z.h']:
+            self.ids[name] = self.add_file(name, name.endswith('.h'))
+        # a cycle between x.h and y.h must not be followed forever
+        for including, included in [('a.cpp', 'x.h'),
+                                    ('x.h', 'y.h'),
+                                    ('y.h', 'x.h'),
+                                    ('b.cpp', 'y.h'),
+                                    ('y.h', 'z.h')]:
+            self.add_include(self.ids[including], self.ids[included])
+        self.commit()
+
+    def walk_includers(self, name):
+        """Follow query_including_files() one level at a time."""
+        includers = set()
+        pending = [self.get_path(name)]
+        while pending:
+            for loc in yacbi.query_including_files(self.root, pending.pop()):
+                if loc.filename not in includers:
+                    includers.add(loc.filename)
+                    pending.append(loc.filename)
+        includers.discard(self.get_path(name))
+        return sorted(includers)
+
+    def test_matches_direct_includers(self):
+        for name in self.ids:
+            self.assertEqual(
+                yacbi.query_transitive_includers(self.root,
+                                                 self.get_path(name)),
+                self.walk_includers(name))
+        self.assertEqual(
+            yacbi.query_transitive_includers(self.root,
+                                             self.get_path('z.h'),
+                                             sources_only=True),
+            [self.get_path('a.cpp'), self.get_path('b.cpp')])
+        self.assertEqual(
+            yacbi.query_transitive_includes(self.root, self.get_path('b.cpp')),
+            [self.get_path('x.h'), self.get_path('y.h'), self.get_path('z.h')])
+
+    def test_graph_reloaded_after_generation_change(self):
+        graph = yacbi._get_include_graph(self.get_db_file(), self.conn)
+        self.assertIs(yacbi._get_include_graph(self.get_db_file(), self.conn),
+                      graph)
+        self.assertEqual(
+            yacbi.query_transitive_includes(self.root, self.get_path('z.h')),
+            [])
+        w_id = self.add_file('w.h', True)
+        self.add_include(self.ids['z.h'], w_id)
+        self.commit()
+        self.assertIsNot(
+            yacbi._get_include_graph(self.get_db_file(), self.conn),
+            graph)
+        self.assertEqual(
+            yacbi.query_transitive_includes(self.root, self.get_path('z.h')),
+            [self.get_path('w.h')])
+        self.assertEqual(
+            yacbi.query_transitive_includers(self.root, self.get_path('w.h')),
+            self.walk_includers('w.h'))
+
+
+class TypeHierarchyTest(ProjectTestCase):
+    # C derives from both B and D, so the hierarchy has a diamond
+    A_EDGES = [('c:@S@B', 'c:@S@A', 1), ('c:@S@D', 'c:@S@A', 2)]
+    B_EDGES = [('c:@S@C', 'c:@S@B', 1),
+               ('c:@S@C', 'c:@S@D', 2),
+               ('c:@S@E', 'c:@S@C', 3)]
+    EXPECTED = [
+        [('c:@S@B', 1, 'lib/a.h', 1),
+         ('c:@S@D', 1, 'lib/a.h', 2),
+         ('c:@S@C', 2, 'lib/b.h', 1),
+         ('c:@S@C', 2, 'lib/b.h', 2),
+         ('c:@S@E', 3, 'lib/b.h', 3)],
+        [('c:@S@B', 1, 'lib/a.h', 1),
+         ('c:@S@D', 1, 'lib/a.h', 2),
+         ('c:@S@C', 2, 'lib/b.h', 1),
+         ('c:@S@C', 2, 'lib/b.h', 2)],
+        [('c:@S@C', 1, 'lib/b.h', 3),
+         ('c:@S@B', 2, 'lib/b.h', 1),
+         ('c:@S@D', 2, 'lib/b.h', 2),
+         ('c:@S@A', 3, 'lib/a.h', 1),
+         ('c:@S@A', 3, 'lib/a.h', 2)],
+        [('c:@S@B', 1, 'lib/b.h', 1),
+         ('c:@S@D', 1, 'lib/b.h', 2)]]
+
+    def add_edges(self, name, edges, conn=None):
+        file_id = self.add_file(name, True, conn)
+        for derived_usr, base_usr, line in edges:
+            self.add_base(derived_usr, base_usr, file_id, line, conn=conn)
+        self.commit(conn)
+
+    def query(self):
+        return [
+            [(r.usr, r.depth, r.location.filename[len(self.root) + 1:],
+              r.location.line)
+             for r in yacbi.query_type_hierarchy(self.root, usr, direction,
+                                                 depth)]
+            for usr, direction, depth in [('c:@S@A', 'derived', None),
+                                          ('c:@S@A', 'derived', 2),
+                                          ('c:@S@E', 'base', None),
+                                          ('c:@S@C', 'base', 1)]]
+
+    def test_single_database(self):
+        self.add_edges('lib/a.h', self.A_EDGES)
+        self.add_edges('lib/b.h', self.B_EDGES)
+        self.assertEqual(self.query(), self.EXPECTED)
+
+    def test_shards(self):
+        self.add_edges('lib/a.h', self.A_EDGES)
+        self.add_edges('lib/b.h', self.B_EDGES, self.add_shard('b', 'lib/b'))
+        self.assertEqual(len(yacbi._get_shards(self.root)), 2)
+        self.assertEqual(self.query(), self.EXPECTED)
@@ -0,0 +1,31 @@
+import yacbi
+
+from tests.helpers import ProjectTestCase
+
+
+class RebuildTest(ProjectTestCase):
+    def setUp(self):
+        ProjectTestCase.setUp(self)
+        self.write_file('a.cpp', 'int f() { return 0; }\n')
+        self.write_file('b.cpp', 'int g() { return 0; }\n')
+        self.write_compile_commands('a.cpp', 'b.cpp')
+
+    def get_paths(self):
+        with yacbi._open_dbs(self.root) as conns:
+            return sorted(path[len(self.root) + 1:]
+                          for conn in conns.itervalues()
+                          for path, in conn.execute(
+                              "SELECT path FROM files"))
+
+    def test_first_run_keeps_files_indexed_before_error(self):
+        self.write_file('b.cpp', 'int g() { return ; }\n')
+        with self.assertRaises(RuntimeError):
+            yacbi.index(self.root, stop_on_error=True)
+        self.assertEqual(self.get_paths(), ['a.cpp'])
+
+    def test_rebuild_leaves_old_database_after_error(self):
+        yacbi.index(self.root)
+        self.write_file('a.cpp', 'int f() { return ; }\n')
+        with self.assertRaises(RuntimeError):
+            yacbi.index(self.root, stop_on_error=True, rebuild=True)
+        self.assertEqual(self.get_paths(), ['a.cpp', 'b.cpp'])
@@ -0,0 +1,64 @@
+import os
+import sqlite3
+
+import yacbi
+
+from tests.helpers import ProjectTestCase
+
+
+class ShardsTest(ProjectTestCase):
+    def setUp(self):
+        ProjectTestCase.setUp(self)
+        self.write_config({'shards': {'app': 'app', 'lib': 'lib'}})
+        os.mkdir(self.get_path('app'))
+        os.mkdir(self.get_path('lib'))
+        self.write_file('common.h', 'int f();\n')
+        self.write_file('main.cpp', 'int main() { return 0; }\n')
+        self.write_file('app/a.cpp',
+                        '#include "../common.h"\nint a() { return f(); }\n')
+        self.write_file('lib/b.cpp',
+                        '#include "../common.h"\n'
+                        'int f() { return 0; }\n'
+                        'int b() { return f(); }\n')
+        self.write_compile_commands('main.cpp', 'app/a.cpp', 'lib/b.cpp')
+        yacbi.index(self.root)
+
+    def get_paths(self, shard):
+        conn = sqlite3.connect(yacbi._get_db_file(self.root, shard))
+        try:
+            return sorted(path[len(self.root) + 1:]
+                          for path, in conn.execute("SELECT path FROM files"))
+        finally:
+            conn.close()
+
+    def test_files_written_to_their_shards(self):
+        self.assertEqual(self.get_paths(None), ['main.cpp'])
+        self.assertEqual(self.get_paths('app'), ['app/a.cpp', 'common.h'])
+        self.assertEqual(self.get_paths('lib'), ['common.h', 'lib/b.cpp'])
+
+    def test_queries_fan_out(self):
+        self.assertEqual(
+            sorted((r.location.filename[len(self.root) + 1:],
+                    r.location.line,
+                    r.kind)
+                   for r in yacbi.query_references(self.root, 'c:@F@f#')),
+            [('app/a.cpp', 2, 103),
+             ('common.h', 1, 8),
+             ('lib/b.cpp', 2, 8),
+             ('lib/b.cpp', 3, 103)])
+        self.assertEqual(
+            [(r.location.filename[len(self.root) + 1:], r.location.line)
+             for r in yacbi.query_definitions(self.root, 'c:@F@f#')],
+            [('lib/b.cpp', 2)])
+
+    def test_shared_header_reported_once(self):
+        self.assertEqual(
+            [(r.usr, r.reference.location.line)
+             for r in yacbi.query_file_references(
+                 self.root, self.get_path('common.h'))],
+            [('c:@F@f#', 1)])
+        self.assertEqual(
+            [(loc.filename[len(self.root) + 1:], loc.line)
+             for loc in yacbi.query_including_files(
+                 self.root, self.get_path('common.h'))],
+            [('app/a.cpp', 1), ('lib/b.cpp', 1)])
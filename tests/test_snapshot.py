@@ -0,0 +1,38 @@
+import yacbi
+
+from tests.helpers import ProjectTestCase
+
+
+class SnapshotTest(ProjectTestCase):
+    def setUp(self):
+        ProjectTestCase.setUp(self)
+        a = self.add_file('a.cpp')
+        b = self.add_file('b.h', is_included=True)
+        self.add_ref('c:@F@foo#', a, 10, 3, 103)
+        self.add_ref('c:@F@foo#', b, 2, 5, 8, True)
+        self.add_ref('c:@F@foo#', a, 4, 1, 8, True)
+        self.add_ref('c:@S@Bar', b, 1, 7, 4, True)
+        self.add_ref('c:@S@Bar', a, 12, 9, 43)
+        self.commit()
+
+    def query(self):
+        yacbi.clear_query_cache()
+        return dict((usr, (yacbi.query_references(self.root, usr),
+                           yacbi.query_definitions(self.root, usr)))
+                    for usr in ('c:@F@foo#', 'c:@S@Bar', 'c:@F@missing#'))
+
+    def test_round_trip(self):
+        expected = self.query()
+        yacbi.create_snapshot(self.root)
+        self.assertIsNotNone(yacbi._get_snapshot(self.root))
+        self.assertEqual(self.query(), expected)
+
+    def test_out_of_date(self):
+        yacbi.create_snapshot(self.root)
+        self.add_ref('c:@F@foo#', self.add_file('c.cpp'), 1, 1, 103)
+        self.commit()
+        self.assertIsNone(yacbi._get_snapshot(self.root))
+        refs = self.query()['c:@F@foo#'][0]
+        self.assertEqual(len(refs), 4)
+        self.assertEqual(refs[-1].location,
+                         yacbi.SourceLocation(self.get_path('c.cpp'), 1, 1))
@@ -0,0 +1,31 @@
+import json
+import os
+
+import yacbi
+
+from tests.helpers import ProjectTestCase
+
+
+class StagingTest(ProjectTestCase):
+    def setUp(self):
+        ProjectTestCase.setUp(self)
+        with open(os.path.join(self.root, '.yacbi', 'config.json'), 'w') as f:
+            json.dump({'reference_chunk_size': 1}, f)
+        self.write_file('a.cpp', 'int f() { return 0; }\n')
+        self.write_file('b.cpp', 'int g() { return 0; }\nint h() { x; }\n')
+        self.write_compile_commands('a.cpp', 'b.cpp')
+
+    def get_symbols(self):
+        with yacbi._open_dbs(self.root) as conns:
+            return sorted(usr
+                          for conn in conns.itervalues()
+                          for usr, in conn.execute(
+                              "SELECT usr FROM symbols"))
+
+    def test_failed_unit_leaves_no_symbols(self):
+        yacbi.index(self.root)
+        self.assertEqual(self.get_symbols(), ['c:@F@f#'])
+
+    def test_failed_unit_leaves_no_symbols_in_rebuild(self):
+        yacbi.index(self.root, rebuild=True)
+        self.assertEqual(self.get_symbols(), ['c:@F@f#'])
@@ -0,0 +1,44 @@
+import yacbi
+
+from tests.helpers import ProjectTestCase
+
+
+class TierTest(ProjectTestCase):
+    def setUp(self):
+        ProjectTestCase.setUp(self)
+        self.write_file('a.h', 'int f();\n')
+        self.write_file('a.cpp', '#include "a.h"\nint g() { return f(); }\n')
+        self.write_compile_commands('a.cpp')
+
+    def get_tiers(self):
+        with yacbi._open_dbs(self.root) as conns:
+            return dict((path[len(self.root) + 1:], tier)
+                        for conn in conns.itervalues()
+                        for path, tier in conn.execute(
+                            "SELECT path, tier FROM files"))
+
+    def get_calls(self):
+        return [(r.location.filename[len(self.root) + 1:], r.location.line)
+                for r in yacbi.query_references(self.root, 'c:@F@f#')
+                if r.kind == 103]
+
+    def test_quick_run_keeps_full_index_of_changed_file(self):
+        yacbi.index(self.root)
+        self.write_file('a.cpp',
+                        '#include "a.h"\n\nint g() { return f(); }\n')
+        self.write_file('b.cpp', '#include "a.h"\nint h() { return f(); }\n')
+        self.write_compile_commands('a.cpp', 'b.cpp')
+        yacbi.index(self.root, tier='quick')
+        self.assertEqual(self.get_tiers(),
+                         {'a.cpp': yacbi._TIERS['full'],
+                          'a.h': yacbi._TIERS['full'],
+                          'b.cpp': yacbi._TIERS['quick']})
+        self.assertEqual(self.get_calls(), [('a.cpp', 3)])
+
+    def test_full_run_upgrades_quick_index(self):
+        yacbi.index(self.root, tier='quick')
+        self.assertEqual(self.get_calls(), [])
+        yacbi.index(self.root)
+        self.assertEqual(set(self.get_tiers().values()),
+                         set([yacbi._TIERS['full']]))
+        self.assertEqual(self.get_calls(), [('a.cpp', 2)])
@@ -0,0 +1,55 @@
+import yacbi
+
+from tests.helpers import ProjectTestCase
+
+
+class UnsavedTest(ProjectTestCase):
+    def setUp(self):
+        ProjectTestCase.setUp(self)
+        self.write_file('a.cpp', 'int f() { return 0; }\n')
+        self.write_file('b.cpp', 'int f();\nint g() { return f(); }\n')
+        self.write_compile_commands('a.cpp', 'b.cpp')
+        yacbi.index(self.root)
+
+    def tearDown(self):
+        yacbi.clear_unsaved(self.root)
+        ProjectTestCase.tearDown(self)
+
+    def get_refs(self):
+        return sorted((r.location.filename[len(self.root) + 1:],
+                       r.location.line)
+                      for r in yacbi.query_references(self.root, 'c:@F@f#'))
+
+    def index_unsaved(self, buffers):
+        diagnostics = yacbi.index_unsaved(
+            self.root,
+            dict((self.get_path(name), contents)
+                 for name, contents in buffers.iteritems()))
+        self.assertEqual(diagnostics, [])
+
+    def test_buffer_masks_indexed_file(self):
+        self.index_unsaved({'a.cpp': '\n\nint f() { return 0; }\n'})
+        self.assertEqual(self.get_refs(),
+                         [('a.cpp', 3), ('b.cpp', 1), ('b.cpp', 2)])
+        self.assertEqual(
+            [d.location.line
+             for d in yacbi.query_definitions(self.root, 'c:@F@f#')],
+            [3])
+
+    def test_buffer_invalidates_cached_queries(self):
+        self.index_unsaved({'a.cpp': '\nint f() { return 0; }\n'})
+        self.assertEqual(self.get_refs(),
+                         [('a.cpp', 2), ('b.cpp', 1), ('b.cpp', 2)])
+        # the same overlay with a later generation
+        self.index_unsaved({'b.cpp': 'int f();\nint g() { return 0; }\n'})
+        self.assertEqual(self.get_refs(), [('a.cpp', 2), ('b.cpp', 1)])
+
+    def test_clear_one_buffer(self):
+        self.index_unsaved({'a.cpp': '\nint f() { return 0; }\n',
+                            'b.cpp': 'int f();\nint g() { return 0; }\n'})
+        self.assertEqual(self.get_refs(), [('a.cpp', 2), ('b.cpp', 1)])
+        yacbi.clear_unsaved(self.root, [self.get_path('a.cpp')])
+        self.assertEqual(self.get_refs(), [('a.cpp', 1), ('b.cpp', 1)])
+        yacbi.clear_unsaved(self.root, [self.get_path('b.cpp')])
+        self.assertEqual(self.get_refs(),
+                         [('a.cpp', 1), ('b.cpp', 1), ('b.cpp', 2)])
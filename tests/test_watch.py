@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+
+import yacbi
+
+from tests.helpers import ProjectTestCase
+
+
+class IncludingSourcesTest(ProjectTestCase):
+    def test_transitive_includers(self):
+        a = self.add_file('a.cpp')
+        b = self.add_file('b.cpp')
+        c = self.add_file('c.cpp')
+        x = self.add_file('x.h', is_included=True)
+        y = self.add_file('y.h', is_included=True)
+        self.add_include(a, x)
+        self.add_include(x, y)
+        self.add_include(b, y)
+        self.add_include(c, x)
+        self.commit()
+        shard_conns = [(None, self.conn)]
+        self.assertEqual(
+            yacbi._find_including_sources(shard_conns,
+                                          [self.get_path('y.h')]),
+            set([self.get_path('a.cpp'),
+                 self.get_path('b.cpp'),
+                 self.get_path('c.cpp')]))
+        self.assertEqual(
+            yacbi._find_including_sources(shard_conns,
+                                          [self.get_path('a.cpp')]),
+            set())
+
+
+class InotifyWatcherTest(ProjectTestCase):
+    def setUp(self):
+        ProjectTestCase.setUp(self)
+        self.outside = os.path.realpath(tempfile.mkdtemp())
+        os.makedirs(os.path.join(self.outside, 'sub'))
+        os.makedirs(self.get_path('src/deep'))
+        self.watcher = yacbi._InotifyWatcher([self.root], [self.outside])
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.outside)
+        ProjectTestCase.tearDown(self)
+
+    def test_watched_dirs(self):
+        self.assertEqual(sorted(self.watcher._dirs.values()),
+                         sorted([self.outside,
+                                 self.root,
+                                 self.get_path('src'),
+                                 self.get_path('src/deep')]))
+
+    def test_changes(self):
+        self.write_file('src/deep/a.h', '')
+        with open(os.path.join(self.outside, 'b.h'), 'w'):
+            pass
+        os.makedirs(os.path.join(self.outside, 'new'))
+        changes = set()
+        while True:
+            batch = self.watcher.read_changes(0.2)
+            if not batch:
+                break
+            changes.update(batch)
+        self.assertEqual(changes,
+                         set([self.get_path('src/deep/a.h'),
+                              os.path.join(self.outside, 'b.h')]))
+        self.assertNotIn(os.path.join(self.outside, 'new'),
+                         self.watcher._dirs.values())
@@ -16,30 +16,70 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
-import clang.cindex
+import array
 import collections
+import contextlib
+import ctypes
+import ctypes.util
 import datetime
 import fnmatch
+import functools
+import hashlib
+import heapq
 import itertools
 import json
 import logging
+import mmap
 import os
+import Queue
 import re
+import select
+import shutil
 import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
 
 
 __all__ = [
     'logger',
     'SourceLocation',
     'Reference',
+    'SymbolReference',
+    'TypeRelation',
+    'Diagnostic',
+    'Failure',
+    'QueryCacheStats',
+    'QueryCancelledError',
+    'QueryFuture',
+    'AsyncProject',
     'initialize_project',
     'index',
+    'index_files',
+    'watch',
+    'index_unsaved',
+    'clear_unsaved',
+    'merge_indices',
+    'create_snapshot',
+    'export_index',
+    'configure_query_cache',
+    'clear_query_cache',
+    'get_query_cache_stats',
     'get_root_for_path',
     'query_compile_args',
     'query_definitions',
     'query_references',
+    'query_symbol_at',
+    'query_file_references',
     'query_subtypes',
+    'query_type_hierarchy',
     'query_including_files',
+    'query_transitive_includers',
+    'query_transitive_includes',
+    'query_failures',
     ]
 
 
@@ -52,6 +92,13 @@ except ImportError:
             pass
 
 
+try:
+    import resource
+except ImportError:
+    # windows
+    resource = None
+
+
 logger = logging.getLogger('yacbi')
 logger.addHandler(_NullLogHandler())
 
@@ -85,6 +132,20 @@ Reference = collections.namedtuple(
     'Reference', ['location', 'is_definition', 'kind', 'description'])
 
 
+SymbolReference = collections.namedtuple(
+    'SymbolReference', ['usr', 'reference'])
+
+
+TypeRelation = collections.namedtuple(
+    'TypeRelation', ['usr', 'depth', 'location'])
+
+
+Diagnostic = collections.namedtuple('Diagnostic', ['location', 'spelling'])
+
+
+Failure = collections.namedtuple('Failure', ['filename', 'diagnostics'])
+
+
 _KIND_TO_DESC = {
     1: 'type declaration',
     2: 'struct declaration',
@@ -125,6 +186,12 @@ _KIND_TO_DESC = {
 }
 
 
+_BASE_SPECIFIER_KIND = 44
+
+
+_MACRO_DEFINITION_KIND = 501
+
+
 _PATH_ARGS = (
     '-include',
     '-isystem',
@@ -235,6 +302,16 @@ def _is_cpp_source(path):
     return ext in _CPP_EXTENSIONS
 
 
+def _import_clang():
+    """Return the clang.cindex module, importing it on first use.
+
+    Loading libclang is slow and queries do not need it, so only code that
+    parses files or reads the compilation database imports it.
+    """
+    import clang.cindex
+    return clang.cindex
+
+
 class _CompilationDatabase(object):
     """Wrapper around clang.cindex.CompilationDatabase."""
 
@@ -259,12 +336,16 @@ class _CompilationDatabase(object):
                     key = os.path.join(cwd, key)
                 path = os.path.normpath(key)
                 self._path_to_key[path] = key
-        self._db = clang.cindex.CompilationDatabase.fromDirectory(root)
+        self._db = _import_clang().CompilationDatabase.fromDirectory(root)
 
     def get_all_files(self):
         """Return a set of all files present in this compilation database."""
         return set(self._path_to_key.keys())
 
+    def has_file(self, filename):
+        """Check if a file is present in this compilation database."""
+        return filename in self._path_to_key
+
     def get_compile_command(self, filename):
         """Return compile command for a given file or None if not found."""
         key = self._path_to_key.get(filename, None)
@@ -281,6 +362,32 @@ class _CompilationDatabase(object):
         return _CompileCommand(filename, args, ccmd.directory, False)
 
 
+class _CompilationDatabaseView(object):
+    """Part of a compilation database that contains only selected files."""
+
+    def __init__(self, comp_db, paths):
+        """Initialize a new instance.
+
+        Arguments:
+        comp_db -- the whole compilation database
+        paths -- set of files present in this view
+        """
+        self._comp_db = comp_db
+        self._paths = paths
+
+    def get_all_files(self):
+        """Return a set of all files present in this view."""
+        return set(self._paths)
+
+    def has_file(self, filename):
+        """Check if a file is present in this view."""
+        return filename in self._paths
+
+    def get_compile_command(self, filename):
+        """Return compile command for a given file or None if not found."""
+        return self._comp_db.get_compile_command(filename)
+
+
 def get_root_for_path(path):
     """Return a Yacbi project root for a given path or None if not found.
 
@@ -300,16 +407,72 @@ def get_root_for_path(path):
         current_dir = new_dir
 
 
-def _init_db(root):
+def _get_db_file(root, shard=None):
+    """Return a path to a Yacbi database.
+
+    Arguments:
+    root -- Yacbi project root
+    shard -- name of an index shard or None for the main database
+    """
+    if shard is None:
+        return os.path.join(root, ".yacbi", "index.db")
+    return os.path.join(root, ".yacbi", "index.{0}.db".format(shard))
+
+
+def _get_shards(root):
+    """Return a list of shard names of a Yacbi project.
+
+    The main database is represented by None and is always the first one.
+    """
+    return [None] + sorted(_read_config(root).shards)
+
+
+def _init_db(root, shard=None):
     """Initialize a Yacbi database.
 
     Arguments:
     root -- Yacbi project root
+    shard -- name of an index shard or None for the main database
     """
-    dbfile = os.path.join(root, ".yacbi", "index.db")
+    dbfile = _get_db_file(root, shard)
     conn = sqlite3.connect(
         dbfile,
         detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+    _create_schema(conn)
+
+
+# stored in the user_version of databases with a complete schema; databases
+# with a lower version are migrated by _connect_to_db()
+_SCHEMA_VERSION = 1
+
+
+# columns added to tables after their creation, in order
+_ADDED_COLUMNS = [
+    # databases created before indexing tiers hold full indices
+    ('files', 'tier', 'INTEGER NOT NULL DEFAULT 2'),
+    # seconds spent on parsing and traversing the file's translation unit
+    ('files', 'parse_time', 'REAL'),
+    ('files', 'traverse_time', 'REAL'),
+    # generation of the index in which the file was last written
+    ('files', 'generation', 'INTEGER NOT NULL DEFAULT 0'),
+    # spelling of the symbol, unknown for symbols indexed before
+    ('symbols', 'name', 'VARCHAR'),
+    # length of the referencing token, unknown for references indexed before
+    ('refs', 'length', 'INTEGER'),
+    ]
+
+
+def _create_schema(conn, with_indices=True):
+    """Create all missing tables and indices of a Yacbi database.
+
+    The temporary staged_refs table is created as well, because it is per
+    connection and cannot be created in the middle of a transaction.
+
+    Arguments:
+    conn -- connection to the database
+    with_indices -- False to leave out secondary indices, e.g. when they
+                    are cheaper to create after bulk inserts
+    """
     cur = conn.cursor()
     cur.executescript("""
     PRAGMA foreign_keys=ON;
@@ -320,6 +483,10 @@ def _init_db(root):
       working_dir VARCHAR NOT NULL,
       last_update DATETIME NOT NULL,
       is_included BOOL NOT NULL,
+      tier INTEGER NOT NULL DEFAULT 2,
+      parse_time REAL,
+      traverse_time REAL,
+      generation INTEGER NOT NULL DEFAULT 0,
       PRIMARY KEY (id),
       UNIQUE (path)
     );
@@ -345,6 +512,7 @@ def _init_db(root):
     CREATE TABLE IF NOT EXISTS symbols (
       id INTEGER NOT NULL,
       usr VARCHAR NOT NULL,
+      name VARCHAR,
       PRIMARY KEY (id),
       UNIQUE (usr)
     );
@@ -356,338 +524,3468 @@ def _init_db(root):
       "column" INTEGER NOT NULL,
       kind INTEGER NOT NULL,
       is_definition BOOL NOT NULL,
+      length INTEGER,
       PRIMARY KEY (symbol_id, file_id, line, "column"),
       FOREIGN KEY (symbol_id) REFERENCES symbols (id) ON DELETE CASCADE,
       FOREIGN KEY (file_id) REFERENCES files (id) ON DELETE CASCADE
     );
+
+    CREATE TABLE IF NOT EXISTS inheritance (
+      derived_symbol_id INTEGER NOT NULL,
+      base_symbol_id INTEGER NOT NULL,
+      file_id INTEGER NOT NULL,
+      line INTEGER NOT NULL,
+      "column" INTEGER NOT NULL,
+      PRIMARY KEY (derived_symbol_id, base_symbol_id, file_id, line, "column"),
+      FOREIGN KEY (derived_symbol_id) REFERENCES symbols (id)
+        ON DELETE CASCADE,
+      FOREIGN KEY (base_symbol_id) REFERENCES symbols (id) ON DELETE CASCADE,
+      FOREIGN KEY (file_id) REFERENCES files (id) ON DELETE CASCADE
+    );
+
+    CREATE TABLE IF NOT EXISTS meta (
+      key VARCHAR NOT NULL,
+      value INTEGER NOT NULL,
+      PRIMARY KEY (key)
+    );
+
+    INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0);
+
+    CREATE TABLE IF NOT EXISTS failures (
+      id INTEGER NOT NULL,
+      path VARCHAR NOT NULL,
+      fingerprint VARCHAR NOT NULL,
+      last_attempt DATETIME NOT NULL,
+      PRIMARY KEY (id),
+      UNIQUE (path)
+    );
+
+    CREATE TABLE IF NOT EXISTS failure_dependencies (
+      failure_id INTEGER NOT NULL,
+      path VARCHAR NOT NULL,
+      PRIMARY KEY (failure_id, path),
+      FOREIGN KEY (failure_id) REFERENCES failures (id) ON DELETE CASCADE
+    );
+
+    CREATE TABLE IF NOT EXISTS failure_diagnostics (
+      id INTEGER NOT NULL,
+      failure_id INTEGER NOT NULL,
+      path VARCHAR NOT NULL,
+      line INTEGER NOT NULL,
+      "column" INTEGER NOT NULL,
+      spelling VARCHAR NOT NULL,
+      PRIMARY KEY (id),
+      FOREIGN KEY (failure_id) REFERENCES failures (id) ON DELETE CASCADE
+    );
+
+    CREATE TEMP TABLE IF NOT EXISTS staged_refs (
+      stage_id INTEGER NOT NULL,
+      symbol_id INTEGER NOT NULL,
+      line INTEGER NOT NULL,
+      "column" INTEGER NOT NULL,
+      data INTEGER NOT NULL
+    );
+
+    CREATE INDEX IF NOT EXISTS temp.staged_refs_by_stage
+      ON staged_refs (stage_id);
     """)
+    columns = {}
+    for table, column, definition in _ADDED_COLUMNS:
+        if table not in columns:
+            cur.execute("PRAGMA table_info({0})".format(table))
+            columns[table] = set(tup[1] for tup in cur.fetchall())
+        if column not in columns[table]:
+            cur.execute("ALTER TABLE {0} ADD COLUMN {1} {2}".format(
+                table, column, definition))
+    if with_indices:
+        cur.executescript("""
+        CREATE INDEX IF NOT EXISTS refs_by_location
+          ON refs (file_id, line, "column");
+
+        CREATE INDEX IF NOT EXISTS compile_args_by_file
+          ON compile_args (file_id);
+
+        CREATE INDEX IF NOT EXISTS includes_by_included
+          ON includes (included_file_id);
+
+        CREATE INDEX IF NOT EXISTS inheritance_by_base
+          ON inheritance (base_symbol_id);
+
+        CREATE INDEX IF NOT EXISTS inheritance_by_file
+          ON inheritance (file_id);
+        """)
+        cur.execute("PRAGMA user_version = {0}".format(_SCHEMA_VERSION))
     conn.commit()
 
 
-def _connect_to_db(root):
+def _connect_to_db(root, shard=None):
     """Return a connection to the existing Yacbi database.
 
+    Databases created by older versions are migrated to the current schema.
+
     Arguments:
     root -- Yacbi project root
+    shard -- name of an index shard or None for the main database
     """
-    dbfile = os.path.join(root, ".yacbi", "index.db")
+    dbfile = _get_db_file(root, shard)
     if not os.path.isfile(dbfile):
         raise RuntimeError("no such file: {0}".format(dbfile))
     conn = sqlite3.connect(
         dbfile,
         detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+    cur = conn.cursor()
+    cur.execute("PRAGMA user_version")
+    if cur.fetchone()[0] < _SCHEMA_VERSION:
+        try:
+            _create_schema(conn)
+        except sqlite3.OperationalError, e:
+            logger.warning("%s: cannot update the database schema: %s",
+                           dbfile,
+                           e)
     return conn
 
 
-def initialize_project(root):
-    yacbi_dir = os.path.join(root, ".yacbi")
-    if os.path.exists(yacbi_dir):
-        if not os.path.isdir(yacbi_dir):
-            raise RuntimeError(
-                "{0} exists but is not a directory".format(yacbi_dir))
-    else:
-        os.makedirs(yacbi_dir)
-    _init_db(root)
-
-
-def query_compile_args(root, filename):
-    """Return a list of compile arguments for a given file.
+def _connect_to_shard(root, shard):
+    """Return a connection to a Yacbi database, creating a missing shard.
 
     Arguments:
-    root -- root directory of a Yacbi project
-    filename -- absolute, normalized file path
+    root -- Yacbi project root
+    shard -- name of an index shard or None for the main database
     """
-    with _connect_to_db(root) as conn:
-        cur = conn.cursor()
-        cur.execute("""SELECT id FROM files WHERE path = ?""", (filename,))
-        file_id = cur.fetchone()
-        if file_id is None:
-            return None
-        cur.execute("""
-                    SELECT arg FROM compile_args
-                    WHERE file_id = ?
-                    ORDER BY id""",
-                    file_id)
-        return [tup[0] for tup in cur.fetchall()]
+    if shard is not None and not os.path.isfile(_get_db_file(root, shard)):
+        _connect_to_db(root).close()
+        _init_db(root, shard)
+    return _connect_to_db(root, shard)
 
 
-def query_definitions(root, usr):
-    """Return a list of references (definitions only) for a given USR.
+class _ReadOnlyConnections(object):
+    """Read-only database connections kept open by a query worker thread."""
 
-    Arguments:
-    root -- root directory of a Yacbi project
-    usr -- Clang's Unified Symbol Reference
-    """
-    with _connect_to_db(root) as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT id FROM symbols WHERE usr = ? LIMIT 1", (usr,))
-        symbol_id = cur.fetchone()
-        if not symbol_id:
-            return []
-        cur.execute("""
-            SELECT
-                f.path,
-                r.line,
-                r."column",
-                r.kind
-            FROM
-                refs r LEFT OUTER JOIN
-                files f ON (r.file_id = f.id)
-            WHERE
-                r.is_definition = 1 AND
-                r.symbol_id = ?
-            ORDER BY
-                f.path ASC,
-                r.line ASC,
-                r."column" ASC
-        """, symbol_id)
-        return [Reference(SourceLocation(*t[0:3]),
-                          kind=t[3],
-                          description=_KIND_TO_DESC.get(t[3], "???"),
-                          is_definition=True)
-                for t in cur.fetchall()]
+    def __init__(self):
+        self._conns = {}
+        self._lock = threading.Lock()
 
+    def open_dbs(self, root):
+        """Return an ordered dictionary like the one yielded by _open_dbs().
 
-def query_references(root, usr):
-    """Return a list of all references for a given USR.
+        Connections are reopened if a database file has been replaced.
+
+        Arguments:
+        root -- Yacbi project root
+        """
+        conns = collections.OrderedDict()
+        for shard in _get_shards(root):
+            dbfile = _get_db_file(root, shard)
+            try:
+                inode = os.stat(dbfile).st_ino
+            except OSError:
+                if shard is None:
+                    raise RuntimeError("no such file: {0}".format(dbfile))
+                continue
+            entry = self._conns.get(dbfile, None)
+            if entry is None or entry[0] != inode:
+                conn = _connect_to_db(root, shard)
+                conn.execute("PRAGMA query_only=ON")
+                with self._lock:
+                    self._conns[dbfile] = (inode, conn)
+                if entry is not None:
+                    entry[1].close()
+                entry = (inode, conn)
+            conns[dbfile] = entry[1]
+        return conns
+
+    def interrupt(self):
+        """Abort queries running on any of the connections."""
+        with self._lock:
+            for _, conn in self._conns.itervalues():
+                conn.interrupt()
+
+    def close(self):
+        with self._lock:
+            for _, conn in self._conns.itervalues():
+                conn.close()
+            self._conns.clear()
+
+
+_thread_state = threading.local()
+
+
+@contextlib.contextmanager
+def _open_dbs(root):
+    """Open connections to all databases of a Yacbi project.
+
+    Yield an ordered dictionary that maps database files to connections.
+    Shards that have not been indexed yet are skipped.  Query worker threads
+    of AsyncProject reuse their own read-only connections.
 
     Arguments:
-    root -- root directory of a Yacbi project
-    usr -- Clang's Unified Symbol Reference
+    root -- Yacbi project root
     """
-    with _connect_to_db(root) as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT id FROM symbols WHERE usr = ? LIMIT 1", (usr,))
-        symbol_id = cur.fetchone()
-        if not symbol_id:
-            return []
-        cur.execute("""
-            SELECT
-                f.path,
-                r.line,
-                r."column",
-                r.kind,
-                r.is_definition
-            FROM
-                refs r LEFT OUTER JOIN
-                files f ON (r.file_id = f.id)
-            WHERE
-                r.symbol_id = ?
-            ORDER BY
-                r.is_definition DESC,
-                f.path ASC,
-                r.line ASC,
-                r."column" ASC
-        """, symbol_id)
-        return [Reference(SourceLocation(*t[0:3]),
-                          kind=t[3],
-                          description=_KIND_TO_DESC.get(t[3], "???"),
-                          is_definition=t[4])
-                for t in cur.fetchall()]
+    worker_conns = getattr(_thread_state, 'connections', None)
+    if worker_conns is not None:
+        yield worker_conns.open_dbs(root)
+        return
+    conns = collections.OrderedDict()
+    try:
+        for shard in _get_shards(root):
+            dbfile = _get_db_file(root, shard)
+            if shard is None or os.path.isfile(dbfile):
+                conns[dbfile] = _connect_to_db(root, shard)
+        yield conns
+    finally:
+        for conn in conns.itervalues():
+            conn.close()
 
 
-def query_subtypes(root, usr):
-    """Return a list of all subtypes for a given USR.
+def _query_each_db(root, query, *args):
+    """Run a query on every database of a Yacbi project.
+
+    Return a list of results, one for each database.
 
     Arguments:
-    root -- root directory of a Yacbi project
-    usr -- Clang's Unified Symbol Reference
+    root -- Yacbi project root
+    query -- function that takes a cursor and args
     """
-    with _connect_to_db(root) as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT id FROM symbols WHERE usr = ? LIMIT 1", (usr,))
-        symbol_id = cur.fetchone()
-        if not symbol_id:
-            return []
-        cur.execute("""
-            SELECT
-                f.path,
-                r.line,
-                r."column",
-                r.kind,
-                r.is_definition
-            FROM
-                refs r LEFT OUTER JOIN
-                files f ON (r.file_id = f.id)
-            WHERE
-                r.symbol_id = ? AND r.kind = 44
-            ORDER BY
-                f.path ASC,
-                r.line ASC,
-                r."column" ASC
-        """, symbol_id)
-        return [Reference(SourceLocation(*t[0:3]),
-                          kind=t[3],
-                          description=_KIND_TO_DESC.get(t[3], "???"),
-                          is_definition=t[4])
-                for t in cur.fetchall()]
+    with _open_dbs(root) as conns:
+        return [query(conn.cursor(), *args) for conn in conns.itervalues()]
 
 
-def query_including_files(root, included_file):
-    """Return a list locations where a given file is being included.
+class _Overlay(object):
+    """In-memory index of unsaved editor buffers of a Yacbi project.
 
-    Arguments:
-    root -- root directory of a Yacbi project
-    included_file -- Clang's Unified Symbol Reference
+    The overlay uses the same schema as project databases.  Files in paths
+    have been indexed from unsaved buffers and their data in the databases is
+    hidden from queries.  Other files are present only as targets of
+    inclusions.
     """
-    with _connect_to_db(root) as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT id FROM files WHERE path = ? LIMIT 1",
-                    (included_file,))
-        file_id = cur.fetchone()
-        if not file_id:
-            return []
-        cur.execute("""
-            SELECT
-                f.path,
-                i.line,
-                i."column"
-            FROM
-                includes i LEFT OUTER JOIN
-                files f ON (i.including_file_id = f.id)
-            WHERE
-                i.included_file_id = ?
-            ORDER BY
-                f.path ASC,
-                i.line ASC
-        """, file_id)
-        return [SourceLocation(*t) for t in cur.fetchall()]
 
+    def __init__(self):
+        self.conn = sqlite3.connect(
+            ':memory:',
+            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+            check_same_thread=False)
+        _create_schema(self.conn)
+        self.lock = threading.Lock()
+        self.paths = frozenset()
+        self.generation = 0
+        self.buffers = {}
+        self._comp_db = None
+        self._comp_db_mtime = None
 
-_Config = collections.namedtuple('_Config',
-                                 ['extra_args',
-                                  'banned_args',
-                                  'overrides',
-                                  'inline_files',
-                                  'ignored_errors'])
+    def query(self, query, *args):
+        """Run a per-database query function on the overlay."""
+        with self.lock:
+            return query(self.conn.cursor(), *args)
 
+    def get_compilation_database(self, root, config):
+        """Return the compilation database, loading it only if it changed."""
+        mtime = os.path.getmtime(os.path.join(root, 'compile_commands.json'))
+        if self._comp_db is None or self._comp_db_mtime != mtime:
+            self._comp_db = _CompilationDatabase(root,
+                                                 config.extra_args,
+                                                 config.banned_args)
+            self._comp_db_mtime = mtime
+        return self._comp_db
 
-def _read_config(root):
-    config_path = os.path.join(root, ".yacbi", "config.json")
-    js = {}
-    if os.path.isfile(config_path):
-        with open(config_path, 'r') as config_fd:
-            js = json.load(config_fd)
-    inline_files = set([_make_absolute_path(root, inl)
-                        for inl in js.get('inline_files', [])])
-    return _Config(js.get('extra_args', []),
-                   js.get('banned_args', []),
-                   js.get('overrides', []),
-                   inline_files,
-                   js.get('ignored_errors', []))
 
+_overlays = {}
 
-def _find_ignore_pattern(error_spelling, ignored_errors):
-    for pattern in ignored_errors:
-        if re.search(pattern, error_spelling):
-            return pattern
+
+_overlays_lock = threading.Lock()
+
+
+def _get_result_path(result):
+    """Return the file a query result comes from or None if not known."""
+    if isinstance(result, SymbolReference):
+        result = result.reference
+    if isinstance(result, (Reference, TypeRelation)):
+        result = result.location
+    if isinstance(result, SourceLocation):
+        return result.filename
     return None
 
 
-def index(root,
-          stop_on_error=False,
-          rollback_on_error=False):
-    config = _read_config(root)
-    compilation_db = _CompilationDatabase(
-        root,
-        config.extra_args,
-        config.banned_args)
-    with _connect_to_db(root) as conn:
-        file_manager = _FileManager(root,
-                                    conn,
-                                    compilation_db,
-                                    config.inline_files)
-        for cmd in file_manager:
-            logger.info("indexing %s", cmd.filename)
-            indexer = Indexer(file_manager, cmd)
-            try:
-                indexer.index()
-            except Exception, e:
-                logger.error("%s: %s", cmd.filename, e)
-                if stop_on_error:
-                    if not rollback_on_error:
-                        conn.commit()
-                    raise RuntimeError("stopping due to: {0}".format(e))
-                continue
-            relevant_errors = []
-            for e in indexer.errors:
-                logger.error("%s:%d:%d: %s",
-                             e.location.filename,
-                             e.location.line,
-                             e.location.column,
-                             e.spelling)
-                ignore_pattern = _find_ignore_pattern(e.spelling,
-                                                      config.ignored_errors)
-                if ignore_pattern:
-                    logger.info('ignoring error: "%s" due to "%s"',
-                                e.spelling,
-                                ignore_pattern)
-                else:
-                    relevant_errors.append(e)
-            if not relevant_errors:
-                file_manager.save_indices(indexer.idx_by_path.values())
-            elif stop_on_error:
-                if not rollback_on_error:
-                    conn.commit()
-                raise RuntimeError("stopping due to: {0}".format(e.spelling))
-        file_manager.remove_orphaned_includes()
-        conn.commit()
+def _apply_overlay(root, results, query, *args):
+    """Add results of a query on the overlay to results from databases.
 
+    Results from databases that come from files indexed from unsaved buffers
+    are dropped.
 
-_LocationInFile = collections.namedtuple('_LocationInFile', ['line', 'column'])
+    Arguments:
+    root -- Yacbi project root
+    results -- list of results, one for each database
+    query -- function that has produced the results
+    """
+    overlay = _overlays.get(root, None)
+    if overlay is None:
+        return results
+    paths = overlay.paths
+    masked = [overlay.query(query, *args)]
+    for result in results:
+        if isinstance(result, list):
+            masked.append([r for r in result
+                           if _get_result_path(r) not in paths])
+        elif _get_result_path(result) not in paths:
+            masked.append(result)
+    return masked
 
 
-_ReferenceData = collections.namedtuple(
-    '_ReferenceData', ['is_definition', 'kind'])
+def _query_each_db_with_overlay(root, query, *args):
+    """Run a query on every database and on unsaved buffers of a project."""
+    return _apply_overlay(root,
+                          _query_each_db(root, query, *args),
+                          query,
+                          *args)
 
 
-_Error = collections.namedtuple(
-    '_Error', ['spelling', 'location', 'disable_option'])
+def _get_db_signature(conns):
+    """Return a digest of the generations of databases opened by _open_dbs().
 
+    The signature changes every time any of the databases is updated.
+    """
+    digest = hashlib.sha1()
+    for dbfile, conn in conns.iteritems():
+        digest.update(os.path.basename(dbfile))
+        digest.update('\0{0}\0'.format(_query_generation(conn)))
+    return digest.digest()
 
-_FileInclusion = collections.namedtuple(
-    '_FileInclusion', ['included_path', 'line', 'column'])
 
+def _get_db_states(root):
+    """Return a list of inode numbers, mtimes and sizes of the databases."""
+    states = []
+    for shard in _get_shards(root):
+        try:
+            st = os.stat(_get_db_file(root, shard))
+        except OSError:
+            st = None
+        if st is not None:
+            states.append((st.st_ino, st.st_mtime, st.st_size))
+        elif shard is None:
+            return None
+    return states
 
-class _Index(object):
-    def __init__(self, cmd):
-        self.filename = cmd.filename
-        self.cwd = cmd.current_dir
-        self.args = cmd.args
-        self.includes = set()
-        self.references_by_usr = {}
-        self.file_id = None
-        self.is_included = cmd.is_included
-        if not self.args.has_x and _is_cpp_source(self.filename):
-            all_args = ['-x', 'c++']
-            all_args.extend(self.args.all_args)
-            self.child_args = _CompileArgs(all_args, self.cwd, True)
-        else:
-            self.child_args = self.args
 
-    def add_reference(self, usr, loc, ref):
-        refs = self.references_by_usr.get(usr, None)
-        if refs is None:
-            refs = {loc: ref}
-            self.references_by_usr[usr] = refs
-        else:
-            old_ref = refs.get(loc, None)
-            if old_ref is None or ref > old_ref:
-                refs[loc] = ref
+_db_signatures = {}
 
-    def add_include(self, inc):
-        self.includes.add(inc)
 
-    def make_child_compile_command(self, child_filename):
-        return _CompileCommand(child_filename, self.child_args, self.cwd, True)
+def _get_current_signature(root):
+    """Return a digest of the generations of all databases of a Yacbi project.
+
+    Checking generations needs a connection to each database, so the digest
+    is recomputed only when a database file has been modified since the last
+    check.  Return None if the project has no database.
+
+    Arguments:
+    root -- Yacbi project root
+    """
+    db_states = _get_db_states(root)
+    if db_states is None:
+        return None
+    known = _db_signatures.get(root, None)
+    if known is not None and known[0] == db_states:
+        return known[1]
+    with _open_dbs(root) as conns:
+        signature = _get_db_signature(conns)
+    _db_signatures[root] = (db_states, signature)
+    return signature
+
+
+QueryCacheStats = collections.namedtuple(
+    'QueryCacheStats', ['hits', 'misses', 'entries', 'size', 'max_size'])
+
+
+def _estimate_size(value):
+    """Return an approximate number of bytes used by a query result."""
+    size = sys.getsizeof(value)
+    if isinstance(value, (tuple, list)):
+        for item in value:
+            size += _estimate_size(item)
+    return size
+
+
+# returned by _QueryCache.get() for results that are not cached, because
+# None is a valid result
+_MISSING = object()
+
+
+class _QueryCache(object):
+    """Bounded LRU cache of query results.
+
+    Every entry remembers the signature of the databases it was computed
+    from and is dropped as soon as the signature changes.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, signature):
+        """Return a cached result or _MISSING if there is none."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] != signature:
+                if entry is not None:
+                    self.size -= entry[2]
+                self.misses += 1
+                return _MISSING
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, signature, result):
+        size = _estimate_size(result)
+        with self._lock:
+            if size > self.max_size:
+                return
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self.size -= old_entry[2]
+            self._entries[key] = (signature, result, size)
+            self.size += size
+            self._shrink(self.max_size)
+
+    def resize(self, max_size):
+        with self._lock:
+            self.max_size = max_size
+            self._shrink(max_size)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def get_stats(self):
+        with self._lock:
+            return QueryCacheStats(self.hits,
+                                   self.misses,
+                                   len(self._entries),
+                                   self.size,
+                                   self.max_size)
+
+    def _shrink(self, max_size):
+        while self.size > max_size:
+            _, entry = self._entries.popitem(last=False)
+            self.size -= entry[2]
+
+
+_DEFAULT_QUERY_CACHE_SIZE = 64 * 1024 * 1024
+
+
+_query_cache = _QueryCache(_DEFAULT_QUERY_CACHE_SIZE)
+
+
+def configure_query_cache(max_size):
+    """Set the maximum size of the query result cache.
+
+    Arguments:
+    max_size -- approximate memory limit in bytes (0 disables the cache)
+    """
+    _query_cache.resize(max_size)
+
+
+def clear_query_cache():
+    """Drop all cached query results and reset the statistics."""
+    _query_cache.clear()
+
+
+def get_query_cache_stats():
+    """Return QueryCacheStats with hit counts and size of the query cache."""
+    return _query_cache.get_stats()
+
+
+def _cached_query(query):
+    """Decorate a query function to cache its results in _query_cache.
+
+    The decorated function must take a project root as its first argument
+    and return a result that is not modified by callers.
+    """
+    @functools.wraps(query)
+    def cached_query(root, *args, **kwargs):
+        if _query_cache.max_size <= 0:
+            return query(root, *args, **kwargs)
+        signature = _get_current_signature(root)
+        if signature is None:
+            return query(root, *args, **kwargs)
+        overlay = _overlays.get(root, None)
+        if overlay is not None:
+            signature = (signature, id(overlay), overlay.generation)
+        key = (query.__name__, root, args, tuple(sorted(kwargs.items())))
+        result = _query_cache.get(key, signature)
+        if result is _MISSING:
+            result = query(root, *args, **kwargs)
+            _query_cache.put(key, signature, result)
+        if isinstance(result, list):
+            return list(result)
+        return result
+    return cached_query
+
+
+def _merge_sorted(results, sort_key):
+    """Merge lists of query results that come from several databases.
+
+    Each list must be sorted by sort_key.  Results found in more than one
+    database (e.g. references in a header indexed by several shards) are
+    reported only once.
+    """
+    if len(results) == 1:
+        return results[0]
+    merged = []
+    for _, result in heapq.merge(*[[(sort_key(r), r) for r in rs]
+                                   for rs in results]):
+        if not merged or merged[-1] != result:
+            merged.append(result)
+    return merged
+
+
+def _query_generation(conn):
+    """Return the index generation stored in a Yacbi database.
+
+    The generation is incremented every time index() commits its changes.
+    Databases that could not be migrated to a schema with generations are
+    at generation 0.
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT value FROM meta WHERE key = 'generation'")
+    except sqlite3.OperationalError:
+        return 0
+    generation = cur.fetchone()
+    if not generation:
+        return 0
+    return generation[0]
+
+
+def _commit_index(conn):
+    """Increment the index generation and commit the transaction."""
+    cur = conn.cursor()
+    cur.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+    conn.commit()
+
+
+def initialize_project(root):
+    yacbi_dir = os.path.join(root, ".yacbi")
+    if os.path.exists(yacbi_dir):
+        if not os.path.isdir(yacbi_dir):
+            raise RuntimeError(
+                "{0} exists but is not a directory".format(yacbi_dir))
+    else:
+        os.makedirs(yacbi_dir)
+    for shard in _get_shards(root):
+        _init_db(root, shard)
+
+
+def _query_compile_args(cur, filename):
+    cur.execute("""SELECT id FROM files WHERE path = ?""", (filename,))
+    file_id = cur.fetchone()
+    if file_id is None:
+        return None
+    cur.execute("""
+                SELECT arg FROM compile_args
+                WHERE file_id = ?
+                ORDER BY id""",
+                file_id)
+    return [tup[0] for tup in cur.fetchall()]
+
+
+@_cached_query
+def query_compile_args(root, filename):
+    """Return a list of compile arguments for a given file.
+
+    Arguments:
+    root -- root directory of a Yacbi project
+    filename -- absolute, normalized file path
+    """
+    overlay = _overlays.get(root, None)
+    if overlay is not None and filename in overlay.paths:
+        return overlay.query(_query_compile_args, filename)
+    for args in _query_each_db(root, _query_compile_args, filename):
+        if args is not None:
+            return args
+    return None
+
+
+def _query_definitions(cur, usr):
+    cur.execute("SELECT id FROM symbols WHERE usr = ? LIMIT 1", (usr,))
+    symbol_id = cur.fetchone()
+    if not symbol_id:
+        return []
+    cur.execute("""
+        SELECT
+            f.path,
+            r.line,
+            r."column",
+            r.kind
+        FROM
+            refs r LEFT OUTER JOIN
+            files f ON (r.file_id = f.id)
+        WHERE
+            r.is_definition = 1 AND
+            r.symbol_id = ?
+        ORDER BY
+            f.path ASC,
+            r.line ASC,
+            r."column" ASC
+    """, symbol_id)
+    return [Reference(SourceLocation(*t[0:3]),
+                      kind=t[3],
+                      description=_KIND_TO_DESC.get(t[3], "???"),
+                      is_definition=True)
+            for t in cur.fetchall()]
+
+
+@_cached_query
+def query_definitions(root, usr):
+    """Return a list of references (definitions only) for a given USR.
+
+    Arguments:
+    root -- root directory of a Yacbi project
+    usr -- Clang's Unified Symbol Reference
+    """
+    snapshot = _get_snapshot(root)
+    if snapshot is not None:
+        results = _apply_overlay(root,
+                                 [snapshot.query_definitions(usr)],
+                                 _query_definitions,
+                                 usr)
+    else:
+        results = _query_each_db_with_overlay(root, _query_definitions, usr)
+    return _merge_sorted(results, lambda r: r.location)
+
+
+def _query_references(cur, usr):
+    cur.execute("SELECT id FROM symbols WHERE usr = ? LIMIT 1", (usr,))
+    symbol_id = cur.fetchone()
+    if not symbol_id:
+        return []
+    cur.execute("""
+        SELECT
+            f.path,
+            r.line,
+            r."column",
+            r.kind,
+            r.is_definition
+        FROM
+            refs r LEFT OUTER JOIN
+            files f ON (r.file_id = f.id)
+        WHERE
+            r.symbol_id = ?
+        ORDER BY
+            r.is_definition DESC,
+            f.path ASC,
+            r.line ASC,
+            r."column" ASC
+    """, symbol_id)
+    return [Reference(SourceLocation(*t[0:3]),
+                      kind=t[3],
+                      description=_KIND_TO_DESC.get(t[3], "???"),
+                      is_definition=t[4])
+            for t in cur.fetchall()]
+
+
+@_cached_query
+def query_references(root, usr):
+    """Return a list of all references for a given USR.
+
+    Arguments:
+    root -- root directory of a Yacbi project
+    usr -- Clang's Unified Symbol Reference
+    """
+    snapshot = _get_snapshot(root)
+    if snapshot is not None:
+        results = _apply_overlay(root,
+                                 [snapshot.query_references(usr)],
+                                 _query_references,
+                                 usr)
+    else:
+        results = _query_each_db_with_overlay(root, _query_references, usr)
+    return _merge_sorted(results,
+                         lambda r: (not r.is_definition, r.location))
+
+
+def _query_symbol_at(cur, filename, line, column):
+    cur.execute("SELECT id, path FROM files WHERE path = ? LIMIT 1",
+                (filename,))
+    file_row = cur.fetchone()
+    if not file_row:
+        return None
+    file_id, path = file_row
+    cur.execute("""
+        SELECT
+            s.usr,
+            r.line,
+            r."column",
+            r.kind,
+            r.is_definition
+        FROM
+            refs r INNER JOIN
+            symbols s ON (r.symbol_id = s.id)
+        WHERE
+            r.file_id = ? AND
+            r.line = ? AND
+            r."column" <= ? AND
+            (r.length IS NULL OR r."column" + r.length > ?)
+        ORDER BY
+            r."column" DESC,
+            r.kind ASC
+        LIMIT 1
+    """, (file_id, line, column, column))
+    t = cur.fetchone()
+    if not t:
+        return None
+    return SymbolReference(t[0],
+                           Reference(SourceLocation(path, t[1], t[2]),
+                                     kind=t[3],
+                                     description=_KIND_TO_DESC.get(t[3],
+                                                                   "???"),
+                                     is_definition=t[4]))
+
+
+@_cached_query
+def query_symbol_at(root, filename, line, column):
+    """Return a symbol reference at a given location or None if not found.
+
+    The returned reference is the one that starts closest to, but not after
+    the given location on the same line and whose token reaches the
+    location, so the location may point anywhere inside the token.
+    References indexed before token lengths were recorded are not bounded.
+
+    Arguments:
+    root -- root directory of a Yacbi project
+    filename -- absolute, normalized file path
+    line -- line number (starting from 1)
+    column -- column number (starting from 1, in bytes)
+    """
+    refs = [r for r in _query_each_db_with_overlay(root,
+                                                   _query_symbol_at,
+                                                   filename,
+                                                   line,
+                                                   column)
+            if r is not None]
+    if not refs:
+        return None
+    return min(refs, key=lambda r: (-r.reference.location.column,
+                                    r.reference.kind,
+                                    r.usr))
+
+
+def _query_file_references(cur, filename):
+    cur.execute("SELECT id FROM files WHERE path = ? LIMIT 1",
+                (filename,))
+    file_id = cur.fetchone()
+    if not file_id:
+        return []
+    cur.execute("""
+        SELECT
+            s.usr,
+            r.line,
+            r."column",
+            r.kind,
+            r.is_definition
+        FROM
+            refs r INNER JOIN
+            symbols s ON (r.symbol_id = s.id)
+        WHERE
+            r.file_id = ?
+        ORDER BY
+            r.line ASC,
+            r."column" ASC,
+            r.kind ASC,
+            s.usr ASC
+    """, file_id)
+    return [SymbolReference(t[0],
+                            Reference(SourceLocation(filename, *t[1:3]),
+                                      kind=t[3],
+                                      description=_KIND_TO_DESC.get(t[3],
+                                                                    "???"),
+                                      is_definition=t[4]))
+            for t in cur.fetchall()]
+
+
+@_cached_query
+def query_file_references(root, filename):
+    """Return a list of all symbol references located in a given file.
+
+    Arguments:
+    root -- root directory of a Yacbi project
+    filename -- absolute, normalized file path
+    """
+    return _merge_sorted(
+        _query_each_db_with_overlay(root, _query_file_references, filename),
+        lambda r: (r.reference.location, r.reference.kind, r.usr))
+
+
+def _query_subtypes(cur, usr):
+    cur.execute("SELECT id FROM symbols WHERE usr = ? LIMIT 1", (usr,))
+    symbol_id = cur.fetchone()
+    if not symbol_id:
+        return []
+    cur.execute("""
+        SELECT
+            f.path,
+            r.line,
+            r."column",
+            r.kind,
+            r.is_definition
+        FROM
+            refs r LEFT OUTER JOIN
+            files f ON (r.file_id = f.id)
+        WHERE
+            r.symbol_id = ? AND r.kind = 44
+        ORDER BY
+            f.path ASC,
+            r.line ASC,
+            r."column" ASC
+    """, symbol_id)
+    return [Reference(SourceLocation(*t[0:3]),
+                      kind=t[3],
+                      description=_KIND_TO_DESC.get(t[3], "???"),
+                      is_definition=t[4])
+            for t in cur.fetchall()]
+
+
+@_cached_query
+def query_subtypes(root, usr):
+    """Return a list of all subtypes for a given USR.
+
+    Arguments:
+    root -- root directory of a Yacbi project
+    usr -- Clang's Unified Symbol Reference
+    """
+    return _merge_sorted(_query_each_db_with_overlay(root,
+                                                     _query_subtypes,
+                                                     usr),
+                         lambda r: r.location)
+
+
+_HIERARCHY_COLUMNS = {
+    'derived': ('base_symbol_id', 'derived_symbol_id'),
+    'base': ('derived_symbol_id', 'base_symbol_id'),
+}
+
+
+_MAX_HIERARCHY_DEPTH = 256
+
+
+_MAX_QUERY_PARAMS = 500
+
+
+def _query_type_hierarchy(cur, usr, columns, depth):
+    cur.execute("SELECT id FROM symbols WHERE usr = ? LIMIT 1", (usr,))
+    symbol_id = cur.fetchone()
+    if not symbol_id:
+        return []
+    cur.execute("""
+        WITH RECURSIVE hierarchy (symbol_id, depth) AS (
+            SELECT ?, 0
+            UNION
+            SELECT
+                i.{1},
+                h.depth + 1
+            FROM
+                inheritance i INNER JOIN
+                hierarchy h ON (i.{0} = h.symbol_id)
+            WHERE
+                h.depth < ?
+        )
+        SELECT
+            s.usr,
+            MIN(h.depth) + 1,
+            f.path,
+            i.line,
+            i."column"
+        FROM
+            inheritance i INNER JOIN
+            hierarchy h ON (i.{0} = h.symbol_id) INNER JOIN
+            symbols s ON (i.{1} = s.id) LEFT OUTER JOIN
+            files f ON (i.file_id = f.id)
+        GROUP BY
+            i.derived_symbol_id,
+            i.base_symbol_id,
+            i.file_id,
+            i.line,
+            i."column"
+        ORDER BY
+            2 ASC,
+            3 ASC,
+            4 ASC,
+            5 ASC
+    """.format(*columns), (symbol_id[0], depth - 1))
+    return [TypeRelation(t[0], t[1], SourceLocation(*t[2:5]))
+            for t in cur.fetchall()]
+
+
+def _query_type_relations(cur, usrs, columns):
+    relations = []
+    usrs = list(usrs)
+    for i in xrange(0, len(usrs), _MAX_QUERY_PARAMS):
+        chunk = usrs[i:i + _MAX_QUERY_PARAMS]
+        cur.execute("""
+            SELECT
+                s.usr,
+                r.usr,
+                f.path,
+                i.line,
+                i."column"
+            FROM
+                inheritance i INNER JOIN
+                symbols s ON (i.{0} = s.id) INNER JOIN
+                symbols r ON (i.{1} = r.id) LEFT OUTER JOIN
+                files f ON (i.file_id = f.id)
+            WHERE
+                s.usr IN ({2})
+        """.format(columns[0], columns[1], ', '.join('?' * len(chunk))),
+            chunk)
+        relations.extend(cur.fetchall())
+    return relations
+
+
+def _walk_type_hierarchy(curs, usr, columns, depth, overlay=None):
+    """Walk a type hierarchy spread over several databases level by level."""
+    relations = set()
+    visited = set([usr])
+    frontier = visited
+    for level in xrange(1, depth + 1):
+        edges = set()
+        for cur in curs:
+            edges.update(_query_type_relations(cur, frontier, columns))
+        if overlay is not None:
+            paths = overlay.paths
+            edges = set(e for e in edges if e[2] not in paths)
+            edges.update(overlay.query(_query_type_relations,
+                                       frontier,
+                                       columns))
+        frontier = set()
+        for _, related_usr, path, line, column in edges:
+            relations.add(TypeRelation(related_usr,
+                                       level,
+                                       SourceLocation(path, line, column)))
+            if related_usr not in visited:
+                visited.add(related_usr)
+                frontier.add(related_usr)
+        if not frontier:
+            break
+    return sorted(relations, key=lambda r: (r.depth, r.location, r.usr))
+
+
+@_cached_query
+def query_type_hierarchy(root, usr, direction='derived', depth=None):
+    """Return a list of types transitively derived from or base of a given USR.
+
+    Every inheritance edge reachable from the given type is reported once, as
+    the related type, its distance from the given type and the location of the
+    base specifier.  The list is sorted by depth, then by location.
+
+    Arguments:
+    root -- root directory of a Yacbi project
+    usr -- Clang's Unified Symbol Reference of a type
+    direction -- 'derived' for subtypes or 'base' for supertypes
+    depth -- maximum depth to follow (None for no limit)
+    """
+    columns = _HIERARCHY_COLUMNS.get(direction, None)
+    if columns is None:
+        raise ValueError("invalid direction: {0}".format(direction))
+    if depth is None:
+        depth = _MAX_HIERARCHY_DEPTH
+    if depth < 1:
+        return []
+    overlay = _overlays.get(root, None)
+    with _open_dbs(root) as conns:
+        if len(conns) == 1 and overlay is None:
+            return _query_type_hierarchy(conns.values()[0].cursor(),
+                                         usr,
+                                         columns,
+                                         depth)
+        return _walk_type_hierarchy([conn.cursor()
+                                     for conn in conns.values()],
+                                    usr,
+                                    columns,
+                                    depth,
+                                    overlay)
+
+
+def _query_including_files(cur, included_file):
+    cur.execute("SELECT id FROM files WHERE path = ? LIMIT 1",
+                (included_file,))
+    file_id = cur.fetchone()
+    if not file_id:
+        return []
+    cur.execute("""
+        SELECT
+            f.path,
+            i.line,
+            i."column"
+        FROM
+            includes i LEFT OUTER JOIN
+            files f ON (i.including_file_id = f.id)
+        WHERE
+            i.included_file_id = ?
+        ORDER BY
+            f.path ASC,
+            i.line ASC,
+            i."column" ASC
+    """, file_id)
+    return [SourceLocation(*t) for t in cur.fetchall()]
+
+
+@_cached_query
+def query_including_files(root, included_file):
+    """Return a list locations where a given file is being included.
+
+    Arguments:
+    root -- root directory of a Yacbi project
+    included_file -- Clang's Unified Symbol Reference
+    """
+    return _merge_sorted(
+        _query_each_db_with_overlay(root,
+                                    _query_including_files,
+                                    included_file),
+        lambda loc: loc)
+
+
+class _IncludeGraph(object):
+    """Array-backed graph of inclusions between files of a Yacbi database.
+
+    Files are identified by dense integers assigned in path order, and both
+    edge directions are stored as adjacency arrays (offsets into a flat array
+    of targets), so the graph stays compact and cheap to traverse.
+    """
+
+    def __init__(self, conn):
+        self.generation = _query_generation(conn)
+        cur = conn.cursor()
+        cur.execute("SELECT id, path, is_included FROM files ORDER BY path")
+        node_by_file_id = {}
+        self.paths = []
+        self.is_included = bytearray()
+        for file_id, path, is_included in cur.fetchall():
+            node_by_file_id[file_id] = len(self.paths)
+            self.paths.append(path)
+            self.is_included.append(1 if is_included else 0)
+        self._node_by_path = dict((p, n) for n, p in enumerate(self.paths))
+        cur.execute("""
+                    SELECT DISTINCT
+                      including_file_id,
+                      included_file_id
+                    FROM includes""")
+        edges = [(node_by_file_id[a], node_by_file_id[b])
+                 for a, b in cur.fetchall()]
+        self._includes = self._make_adjacency(edges)
+        self._includers = self._make_adjacency([(b, a) for a, b in edges])
+
+    def _make_adjacency(self, edges):
+        offsets = array.array('i', [0] * (len(self.paths) + 1))
+        for source, _ in edges:
+            offsets[source + 1] += 1
+        for node in xrange(len(self.paths)):
+            offsets[node + 1] += offsets[node]
+        targets = array.array('i', [0] * len(edges))
+        fill = array.array('i', offsets)
+        for source, target in edges:
+            targets[fill[source]] = target
+            fill[source] += 1
+        return offsets, targets
+
+    def _walk(self, adjacency, path):
+        start = self._node_by_path.get(path, None)
+        if start is None:
+            return []
+        offsets, targets = adjacency
+        visited = bytearray(len(self.paths))
+        visited[start] = 1
+        stack = [start]
+        pop = stack.pop
+        push = stack.append
+        reached = []
+        add = reached.append
+        while stack:
+            node = pop()
+            for target in targets[offsets[node]:offsets[node + 1]]:
+                if not visited[target]:
+                    visited[target] = 1
+                    push(target)
+                    add(target)
+        reached.sort()
+        return reached
+
+    def get_includers(self, path, sources_only):
+        return [self.paths[n]
+                for n in self._walk(self._includers, path)
+                if not (sources_only and self.is_included[n])]
+
+    def get_includes(self, path):
+        return [self.paths[n] for n in self._walk(self._includes, path)]
+
+
+_include_graphs = {}
+
+
+def _get_include_graph(dbfile, conn):
+    """Return an include graph of a Yacbi database, loading it if needed.
+
+    Loaded graphs are kept in memory until the index generation changes.
+    """
+    graph = _include_graphs.get(dbfile, None)
+    if graph is None or graph.generation != _query_generation(conn):
+        graph = _IncludeGraph(conn)
+        _include_graphs[dbfile] = graph
+    return graph
+
+
+@_cached_query
+def query_transitive_includers(root, included_file, sources_only=False):
+    """Return a sorted list of files directly or indirectly including a file.
+
+    Arguments:
+    root -- root directory of a Yacbi project
+    included_file -- absolute, normalized file path
+    sources_only -- if True, return only translation units
+    """
+    includers = set()
+    with _open_dbs(root) as conns:
+        for dbfile, conn in conns.iteritems():
+            graph = _get_include_graph(dbfile, conn)
+            includers.update(graph.get_includers(included_file, sources_only))
+    return sorted(includers)
+
+
+@_cached_query
+def query_transitive_includes(root, including_file):
+    """Return a sorted list of files directly or indirectly included by a file.
+
+    Arguments:
+    root -- root directory of a Yacbi project
+    including_file -- absolute, normalized file path
+    """
+    includes = set()
+    with _open_dbs(root) as conns:
+        for dbfile, conn in conns.iteritems():
+            graph = _get_include_graph(dbfile, conn)
+            includes.update(graph.get_includes(including_file))
+    return sorted(includes)
+
+
+def _query_failures(cur):
+    cur.execute("""
+        SELECT
+            f.path,
+            d.path,
+            d.line,
+            d."column",
+            d.spelling
+        FROM
+            failures f LEFT OUTER JOIN
+            failure_diagnostics d ON (d.failure_id = f.id)
+        ORDER BY
+            f.path ASC,
+            d.id ASC
+    """)
+    failures = []
+    for t in cur.fetchall():
+        if not failures or failures[-1].filename != t[0]:
+            failures.append(Failure(t[0], []))
+        if t[1] is not None:
+            failures[-1].diagnostics.append(
+                Diagnostic(SourceLocation(*t[1:4]), t[4]))
+    return [Failure(f.filename, tuple(f.diagnostics)) for f in failures]
+
+
+@_cached_query
+def query_failures(root):
+    """Return a list of files that could not be indexed due to errors.
+
+    Each Failure holds a tuple of the diagnostics that made the file fail.
+
+    Arguments:
+    root -- root directory of a Yacbi project
+    """
+    return _merge_sorted(_query_each_db(root, _query_failures),
+                         lambda f: f.filename)
+
+
+# tag kinds of cursor kinds written to tags files, for definitions and other
+# declarations (None if only definitions are written)
+_CTAGS_KINDS = {
+    2: ('s', None),
+    3: ('u', None),
+    4: ('c', None),
+    5: ('g', None),
+    6: ('m', 'm'),
+    7: ('e', 'e'),
+    8: ('f', 'p'),
+    9: ('v', 'x'),
+    20: ('t', 't'),
+    21: ('f', 'p'),
+    22: ('n', 'n'),
+    24: ('f', 'p'),
+    25: ('f', 'p'),
+    26: ('f', 'p'),
+    30: ('f', 'p'),
+    31: ('c', None),
+    32: ('c', None),
+    33: ('n', 'n'),
+    36: ('t', 't'),
+    501: ('d', 'd'),
+}
+
+
+class _CtagsWriter(object):
+    """Writes definitions and declarations in the extended ctags format.
+
+    Tags are written in the order of files, so the tags file is marked as
+    unsorted.  Symbols without a name (indexed before names were recorded)
+    are left out.
+    """
+
+    def __init__(self, output):
+        self.output = output
+
+    def begin(self, generation):
+        self.output.write("!_TAG_FILE_FORMAT\t2\t/extended format/\n")
+        self.output.write(
+            "!_TAG_FILE_SORTED\t0\t/0=unsorted, 1=sorted, 2=foldcase/\n")
+        self.output.write("!_TAG_PROGRAM_NAME\tyacbi\t//\n")
+
+    def write_file(self, path, generation, refs):
+        path = _to_utf8(path)
+        for line, column, usr, name, kind, is_definition in refs:
+            tag_kinds = _CTAGS_KINDS.get(kind, None)
+            if not name or not tag_kinds:
+                continue
+            tag_kind = tag_kinds[0] if is_definition else tag_kinds[1]
+            if tag_kind:
+                self.output.write("{0}\t{1}\t{2};\"\t{3}\n".format(
+                    _to_utf8(name), path, line, tag_kind))
+
+
+class _JsonLinesWriter(object):
+    """Writes the index as JSON objects, one per line.
+
+    The first object holds the generation of the index.  Every file is
+    followed by all of its references, so that consumers of incremental
+    exports can replace what they know about the file.  The name of a
+    reference is null if its symbol was indexed before names were recorded.
+    """
+
+    def __init__(self, output):
+        self.output = output
+
+    def begin(self, generation):
+        self._write({'type': 'index', 'generation': generation})
+
+    def write_file(self, path, generation, refs):
+        self._write({'type': 'file', 'path': path, 'generation': generation})
+        for line, column, usr, name, kind, is_definition in refs:
+            self._write({'type': 'ref',
+                         'path': path,
+                         'line': line,
+                         'column': column,
+                         'usr': usr,
+                         'name': name,
+                         'kind': kind,
+                         'description': _KIND_TO_DESC.get(kind, "???"),
+                         'is_definition': bool(is_definition)})
+
+    def _write(self, obj):
+        self.output.write(json.dumps(obj, sort_keys=True))
+        self.output.write("\n")
+
+
+_EXPORT_WRITERS = {'ctags': _CtagsWriter, 'jsonl': _JsonLinesWriter}
+
+
+def _iter_export_files(conn, db_number, path_prefix, since):
+    conditions = []
+    params = []
+    if path_prefix:
+        # a range of paths can be looked up in the index of unique paths
+        conditions.append("path >= ? AND path < ?")
+        params.append(path_prefix)
+        params.append(path_prefix[:-1] + unichr(ord(path_prefix[-1]) + 1))
+    if since is not None:
+        conditions.append("generation > ?")
+        params.append(since)
+    query = "SELECT path, generation, id FROM files"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY path"
+    cur = conn.cursor()
+    cur.execute(query, params)
+    for path, generation, file_id in cur:
+        yield path, generation, db_number, file_id
+
+
+def _iter_export_refs(conn, file_id):
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT
+            r.line,
+            r."column",
+            s.usr,
+            s.name,
+            r.kind,
+            r.is_definition
+        FROM
+            refs r INNER JOIN
+            symbols s ON (r.symbol_id = s.id)
+        WHERE
+            r.file_id = ?
+        ORDER BY
+            r.line ASC,
+            r."column" ASC,
+            s.usr ASC
+    """, (file_id,))
+    return cur
+
+
+def export_index(root, output, fmt='jsonl', path_prefix=None, since=None):
+    """Write cross-references of a Yacbi project to a file.
+
+    Files are read one by one in the order of paths and their references are
+    written as soon as they are read, so memory use does not depend on the
+    size of the index.  All databases are read in one transaction each, so
+    an export is consistent even if the project is being indexed.
+
+    Incremental exports do not report files removed from the index, so
+    consumers that need to forget them have to make a full export.  Symbols
+    indexed before names were recorded have no name until the files that
+    refer to them are indexed again, e.g. by index() with rebuild.
+    Return the generation that should be given as since to the next export.
+    If the project has shards, which count generations on their own, the
+    lowest one is returned, so some files may be exported again.  A header
+    indexed by several shards is exported once, with the references stored
+    by one of them.
+
+    Arguments:
+    root -- root directory of a Yacbi project
+    output -- file object the cross-references are written to
+    fmt -- 'ctags' or 'jsonl'
+    path_prefix -- export only files whose paths start with this prefix
+    since -- export only files indexed after this generation of the index
+    """
+    writer_type = _EXPORT_WRITERS.get(fmt, None)
+    if writer_type is None:
+        raise ValueError("invalid export format: {0}".format(fmt))
+    writer = writer_type(output)
+    if path_prefix:
+        prefix = os.path.abspath(path_prefix)
+        if path_prefix.endswith(os.path.sep) and prefix != os.path.sep:
+            prefix += os.path.sep
+        if not isinstance(prefix, unicode):
+            prefix = prefix.decode(sys.getfilesystemencoding() or 'utf-8')
+        path_prefix = prefix
+    with _open_dbs(root) as conns:
+        conns = conns.values()
+        try:
+            for conn in conns:
+                conn.execute("BEGIN")
+            generation = min(_query_generation(conn) for conn in conns)
+            writer.begin(generation)
+            files = heapq.merge(*[_iter_export_files(conn,
+                                                     i,
+                                                     path_prefix,
+                                                     since)
+                                  for i, conn in enumerate(conns)])
+            last_path = None
+            for path, file_generation, db_number, file_id in files:
+                if path == last_path:
+                    # a header indexed by several shards
+                    continue
+                last_path = path
+                writer.write_file(path,
+                                  file_generation,
+                                  _iter_export_refs(conns[db_number],
+                                                    file_id))
+        finally:
+            # connections of query workers outlive the export and would go
+            # on reading this version of the index
+            for conn in conns:
+                conn.rollback()
+    return generation
+
+
+_SNAPSHOT_MAGIC = 'YACBISNP'
+
+
+_SNAPSHOT_VERSION = 1
+
+
+# magic, version, signature, number of paths, symbols and references,
+# and positions of: references, path offsets, path data, USR offsets,
+# USR data, first reference of each symbol, number of definitions of each
+# symbol
+_SNAPSHOT_HEADER = struct.Struct('<8sI20sIIIQQQQQQQ')
+
+
+# path id, line, column, kind, is definition
+_SNAPSHOT_REF = struct.Struct('<IIIHBx')
+
+
+_UINT32 = struct.Struct('<I')
+
+
+_UINT32_PAIR = struct.Struct('<II')
+
+
+def _get_snapshot_file(root):
+    """Return a path to the query snapshot of a Yacbi project."""
+    return os.path.join(root, ".yacbi", "snapshot.bin")
+
+
+def _to_utf8(text):
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+
+def _from_utf8(text):
+    if isinstance(text, str):
+        return text.decode('utf-8', 'replace')
+    return text
+
+
+def _write_uint32_array(output, values):
+    values = array.array('I', values)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    values.tofile(output)
+
+
+def _iter_snapshot_refs(cur):
+    cur.execute("""
+        SELECT
+            s.usr,
+            r.is_definition,
+            f.path,
+            r.line,
+            r."column",
+            r.kind
+        FROM
+            refs r INNER JOIN
+            symbols s ON (r.symbol_id = s.id) INNER JOIN
+            files f ON (r.file_id = f.id)
+        ORDER BY
+            s.usr ASC,
+            r.is_definition DESC,
+            f.path ASC,
+            r.line ASC,
+            r."column" ASC
+    """)
+    for usr, is_definition, path, line, column, kind in cur:
+        yield (_to_utf8(usr),
+               0 if is_definition else 1,
+               _to_utf8(path),
+               line,
+               column,
+               kind)
+
+
+def create_snapshot(root):
+    """Compile the index of a Yacbi project into a read-only query snapshot.
+
+    The snapshot contains a sorted table of symbols, the references of each
+    symbol and a table of paths, laid out so that query_references() and
+    query_definitions() can answer from a memory-mapped file with a binary
+    search.  It is used until the index changes, after which the queries go
+    back to the databases until a new snapshot is created.
+
+    Arguments:
+    root -- root directory of a Yacbi project
+    """
+    snapshot_file = _get_snapshot_file(root)
+    tmp_file = snapshot_file + '.tmp'
+    with _open_dbs(root) as conns:
+        signature = _get_db_signature(conns)
+        paths = set()
+        for conn in conns.itervalues():
+            paths.update(_to_utf8(t[0])
+                         for t in conn.execute("SELECT path FROM files"))
+        paths = sorted(paths)
+        path_ids = dict((p, i) for i, p in enumerate(paths))
+        usr_offsets = array.array('I', [0])
+        ref_starts = array.array('I', [0])
+        def_counts = array.array('I')
+        usr_data = tempfile.TemporaryFile()
+        with open(tmp_file, 'wb') as output:
+            output.write('\0' * _SNAPSHOT_HEADER.size)
+            refs_pos = output.tell()
+            buf = []
+            last = None
+            ref_count = 0
+            for ref in heapq.merge(*[_iter_snapshot_refs(conn.cursor())
+                                     for conn in conns.itervalues()]):
+                if ref == last:
+                    continue
+                usr, not_definition, path, line, column, kind = ref
+                if last is None or usr != last[0]:
+                    if last is not None:
+                        ref_starts.append(ref_count)
+                    usr_data.write(usr)
+                    usr_offsets.append(usr_offsets[-1] + len(usr))
+                    def_counts.append(0)
+                if not not_definition:
+                    def_counts[-1] += 1
+                buf.append(_SNAPSHOT_REF.pack(path_ids[path],
+                                              line,
+                                              column,
+                                              kind,
+                                              0 if not_definition else 1))
+                if len(buf) >= 65536:
+                    output.write(''.join(buf))
+                    buf = []
+                ref_count += 1
+                last = ref
+            output.write(''.join(buf))
+            if last is not None:
+                ref_starts.append(ref_count)
+            path_offsets_pos = output.tell()
+            offset = 0
+            path_offsets = array.array('I', [0])
+            for path in paths:
+                offset += len(path)
+                path_offsets.append(offset)
+            _write_uint32_array(output, path_offsets)
+            path_data_pos = output.tell()
+            output.write(''.join(paths))
+            usr_offsets_pos = output.tell()
+            _write_uint32_array(output, usr_offsets)
+            usr_data_pos = output.tell()
+            usr_data.seek(0)
+            shutil.copyfileobj(usr_data, output)
+            usr_data.close()
+            ref_starts_pos = output.tell()
+            _write_uint32_array(output, ref_starts)
+            def_counts_pos = output.tell()
+            _write_uint32_array(output, def_counts)
+            output.seek(0)
+            output.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC,
+                                               _SNAPSHOT_VERSION,
+                                               signature,
+                                               len(paths),
+                                               len(def_counts),
+                                               ref_count,
+                                               refs_pos,
+                                               path_offsets_pos,
+                                               path_data_pos,
+                                               usr_offsets_pos,
+                                               usr_data_pos,
+                                               ref_starts_pos,
+                                               def_counts_pos))
+    os.rename(tmp_file, snapshot_file)
+
+
+class _Snapshot(object):
+    """Memory-mapped query snapshot created by create_snapshot()."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot_fd:
+            st = os.fstat(snapshot_fd.fileno())
+            self._mm = mmap.mmap(snapshot_fd.fileno(),
+                                 0,
+                                 access=mmap.ACCESS_READ)
+        self.file_id = (st.st_ino, st.st_mtime, st.st_size)
+        (magic,
+         version,
+         self.signature,
+         self._path_count,
+         self._symbol_count,
+         _,
+         self._refs_pos,
+         self._path_offsets_pos,
+         self._path_data_pos,
+         self._usr_offsets_pos,
+         self._usr_data_pos,
+         self._ref_starts_pos,
+         self._def_counts_pos) = _SNAPSHOT_HEADER.unpack_from(self._mm, 0)
+        if magic != _SNAPSHOT_MAGIC or version != _SNAPSHOT_VERSION:
+            raise RuntimeError("{0}: unsupported snapshot format".format(path))
+        self._paths = {}
+
+    def _get_usr(self, symbol):
+        start, end = _UINT32_PAIR.unpack_from(self._mm,
+                                              self._usr_offsets_pos +
+                                              symbol * _UINT32.size)
+        return self._mm[self._usr_data_pos + start:self._usr_data_pos + end]
+
+    def _get_path(self, path_id):
+        path = self._paths.get(path_id, None)
+        if path is None:
+            start, end = _UINT32_PAIR.unpack_from(self._mm,
+                                                  self._path_offsets_pos +
+                                                  path_id * _UINT32.size)
+            path = self._mm[self._path_data_pos + start:
+                            self._path_data_pos + end].decode('utf-8')
+            self._paths[path_id] = path
+        return path
+
+    def _find_symbol(self, usr):
+        usr = _to_utf8(usr)
+        lo = 0
+        hi = self._symbol_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._get_usr(mid) < usr:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._symbol_count and self._get_usr(lo) == usr:
+            return lo
+        return None
+
+    def _get_refs(self, usr, definitions_only):
+        symbol = self._find_symbol(usr)
+        if symbol is None:
+            return
+        start, end = _UINT32_PAIR.unpack_from(self._mm,
+                                              self._ref_starts_pos +
+                                              symbol * _UINT32.size)
+        if definitions_only:
+            (def_count,) = _UINT32.unpack_from(self._mm,
+                                               self._def_counts_pos +
+                                               symbol * _UINT32.size)
+            end = start + def_count
+        for i in xrange(start, end):
+            path_id, line, column, kind, is_definition = \
+                _SNAPSHOT_REF.unpack_from(self._mm,
+                                          self._refs_pos +
+                                          i * _SNAPSHOT_REF.size)
+            yield (self._get_path(path_id), line, column, kind, is_definition)
+
+    def query_definitions(self, usr):
+        return [Reference(SourceLocation(*t[0:3]),
+                          kind=t[3],
+                          description=_KIND_TO_DESC.get(t[3], "???"),
+                          is_definition=True)
+                for t in self._get_refs(usr, True)]
+
+    def query_references(self, usr):
+        return [Reference(SourceLocation(*t[0:3]),
+                          kind=t[3],
+                          description=_KIND_TO_DESC.get(t[3], "???"),
+                          is_definition=t[4])
+                for t in self._get_refs(usr, False)]
+
+
+_snapshots = {}
+
+
+def _get_snapshot(root):
+    """Return the query snapshot of a Yacbi project or None if not usable.
+
+    Arguments:
+    root -- Yacbi project root
+    """
+    snapshot_file = _get_snapshot_file(root)
+    try:
+        st = os.stat(snapshot_file)
+    except OSError:
+        return None
+    snapshot = _snapshots.get(root, None)
+    if (snapshot is None or
+            snapshot.file_id != (st.st_ino, st.st_mtime, st.st_size)):
+        snapshot = _Snapshot(snapshot_file)
+        _snapshots[root] = snapshot
+    if snapshot.signature != _get_current_signature(root):
+        logger.debug("%s: snapshot is out of date", snapshot_file)
+        return None
+    return snapshot
+
+
+class QueryCancelledError(RuntimeError):
+    """Raised by QueryFuture.result() for a cancelled query."""
+
+
+class QueryFuture(object):
+    """Result of a query submitted to AsyncProject.
+
+    Callbacks added with add_done_callback() run on a worker thread, so an
+    event loop should hand the result over to its own thread, e.g. with
+    call_soon_threadsafe().
+    """
+
+    _PENDING, _RUNNING, _FINISHED = range(3)
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._state = QueryFuture._PENDING
+        self._cancelled = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._conns = None
+
+    def cancel(self):
+        """Cancel the query unless it has already finished.
+
+        A running query is interrupted.  Return True if the query has been
+        cancelled.
+        """
+        with self._condition:
+            if self._state == QueryFuture._FINISHED:
+                return self._cancelled
+            self._cancelled = True
+            if self._state == QueryFuture._RUNNING:
+                self._conns.interrupt()
+                return True
+        self._finish(None, None)
+        return True
+
+    def cancelled(self):
+        with self._condition:
+            return self._cancelled
+
+    def done(self):
+        with self._condition:
+            return self._state == QueryFuture._FINISHED
+
+    def result(self, timeout=None):
+        """Wait for the query to finish and return its result.
+
+        Arguments:
+        timeout -- number of seconds to wait or None to wait indefinitely
+        """
+        with self._condition:
+            if self._state != QueryFuture._FINISHED:
+                self._condition.wait(timeout)
+            if self._state != QueryFuture._FINISHED:
+                raise RuntimeError("query has not finished in time")
+            if self._cancelled:
+                raise QueryCancelledError("query cancelled")
+            if self._exc_info is not None:
+                exc_type, exc_value, exc_traceback = self._exc_info
+                raise exc_type, exc_value, exc_traceback
+            return self._result
+
+    def add_done_callback(self, callback):
+        """Call a function with this future as soon as it is done.
+
+        Arguments:
+        callback -- function that takes a QueryFuture
+        """
+        with self._condition:
+            if self._state != QueryFuture._FINISHED:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _start(self, conns):
+        with self._condition:
+            if self._state != QueryFuture._PENDING:
+                return False
+            self._state = QueryFuture._RUNNING
+            self._conns = conns
+            return True
+
+    def _finish(self, result, exc_info):
+        with self._condition:
+            if self._state == QueryFuture._FINISHED:
+                return
+            self._state = QueryFuture._FINISHED
+            self._conns = None
+            if not self._cancelled:
+                self._result = result
+                self._exc_info = exc_info
+            callbacks = self._callbacks
+            self._callbacks = []
+            self._condition.notify_all()
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logger.exception("query callback failed")
+
+
+class AsyncProject(object):
+    """Run queries of a Yacbi project on a pool of worker threads.
+
+    Every worker keeps its own read-only connections to the project
+    databases, so many queries can be in flight at once without blocking
+    the caller.  Any public query function can be called as a method
+    without the root argument and returns a QueryFuture:
+
+        with AsyncProject(root) as project:
+            future = project.query_references(usr)
+            refs = future.result()
+    """
+
+    def __init__(self, root, workers=4):
+        """Start worker threads.
+
+        Arguments:
+        root -- root directory of a Yacbi project
+        workers -- number of queries that can run at the same time
+        """
+        self.root = root
+        self._queue = Queue.Queue()
+        self._threads = []
+        for _ in xrange(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getattr__(self, name):
+        if not name.startswith('query_') or name not in __all__:
+            raise AttributeError(name)
+        return functools.partial(self.submit, globals()[name])
+
+    def submit(self, query, *args, **kwargs):
+        """Schedule a query and return its QueryFuture.
+
+        Arguments:
+        query -- query function that takes the project root and args
+        """
+        if not self._threads:
+            raise RuntimeError("project has been closed")
+        future = QueryFuture()
+        self._queue.put((future, query, args, kwargs))
+        return future
+
+    def index_unsaved(self, buffers):
+        """Schedule index_unsaved() and return its QueryFuture."""
+        return self.submit(index_unsaved, buffers)
+
+    def close(self):
+        """Cancel pending queries and stop worker threads."""
+        threads = self._threads
+        self._threads = []
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def _work(self):
+        conns = _ReadOnlyConnections()
+        _thread_state.connections = conns
+        try:
+            while True:
+                job = self._queue.get()
+                if job is None:
+                    break
+                future, query, args, kwargs = job
+                if not self._threads:
+                    future.cancel()
+                    continue
+                if not future._start(conns):
+                    continue
+                try:
+                    result = query(self.root, *args, **kwargs)
+                except Exception:
+                    # the traceback is raised again by result()
+                    future._finish(None, sys.exc_info())
+                else:
+                    future._finish(result, None)
+        finally:
+            _thread_state.connections = None
+            conns.close()
+
+
+_TIERS = {'quick': 1, 'full': 2}
+
+
+def _get_tier(name):
+    """Return the number of an indexing tier stored in the files table.
+
+    The quick tier parses files without function bodies and stores only
+    declarations, so that definitions can be looked up long before the full
+    tier, which stores all references, is done.
+
+    Arguments:
+    name -- 'quick' or 'full'
+    """
+    tier = _TIERS.get(name, None)
+    if tier is None:
+        raise ValueError("invalid tier: {0}".format(name))
+    return tier
+
+
+_Config = collections.namedtuple('_Config',
+                                 ['extra_args',
+                                  'banned_args',
+                                  'overrides',
+                                  'inline_files',
+                                  'ignored_errors',
+                                  'shards',
+                                  'quick_tier_macros',
+                                  'reference_chunk_size'])
+
+
+_DEFAULT_REFERENCE_CHUNK_SIZE = 1000000
+
+
+_SHARD_NAME_RE = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+_configs = {}
+
+
+def _read_config(root):
+    """Return the configuration of a Yacbi project.
+
+    Parsed configurations are kept in memory until the mtime or size of the
+    config file changes.  They are shared, so callers must not modify them.
+    """
+    config_path = os.path.join(root, ".yacbi", "config.json")
+    try:
+        st = os.stat(config_path)
+        state = (st.st_mtime, st.st_size)
+    except OSError:
+        state = None
+    known = _configs.get(root, None)
+    if known is not None and known[0] == state:
+        return known[1]
+    config = _parse_config(root, config_path if state else None)
+    _configs[root] = (state, config)
+    return config
+
+
+def _parse_config(root, config_path):
+    js = {}
+    if config_path is not None:
+        with open(config_path, 'r') as config_fd:
+            js = json.load(config_fd)
+    inline_files = set([_make_absolute_path(root, inl)
+                        for inl in js.get('inline_files', [])])
+    shards = {}
+    for name, prefix in js.get('shards', {}).iteritems():
+        if not _SHARD_NAME_RE.match(name):
+            raise RuntimeError("invalid shard name: {0}".format(name))
+        shards[name] = _make_absolute_path(root, prefix)
+    reference_chunk_size = js.get('reference_chunk_size',
+                                  _DEFAULT_REFERENCE_CHUNK_SIZE)
+    if reference_chunk_size is not None and (
+            not isinstance(reference_chunk_size, (int, long)) or
+            reference_chunk_size < 1):
+        raise RuntimeError("invalid reference chunk size: {0}".format(
+            reference_chunk_size))
+    return _Config(js.get('extra_args', []),
+                   js.get('banned_args', []),
+                   js.get('overrides', []),
+                   inline_files,
+                   js.get('ignored_errors', []),
+                   shards,
+                   js.get('quick_tier_macros', True),
+                   reference_chunk_size)
+
+
+def _find_shard(shards, path):
+    """Return a name of the shard that owns a path or None for the main one.
+
+    A path belongs to the shard with the longest matching directory prefix.
+    """
+    found = None
+    found_prefix = ''
+    for name, prefix in shards.iteritems():
+        if ((path == prefix or path.startswith(prefix + os.path.sep)) and
+                len(prefix) > len(found_prefix)):
+            found = name
+            found_prefix = prefix
+    return found
+
+
+def _split_compilation_database(config, compilation_db):
+    """Return a list of (shard, compilation database) pairs of a project.
+
+    Each shard gets a view of the compilation database that contains only the
+    source files it owns.
+    """
+    if not config.shards:
+        return [(None, compilation_db)]
+    paths_by_shard = dict((shard, set()) for shard in config.shards)
+    paths_by_shard[None] = set()
+    for path in compilation_db.get_all_files():
+        paths_by_shard[_find_shard(config.shards, path)].add(path)
+    return [(shard, _CompilationDatabaseView(compilation_db,
+                                             paths_by_shard[shard]))
+            for shard in [None] + sorted(config.shards)]
+
+
+def _find_ignore_pattern(error_spelling, ignored_errors):
+    for pattern in ignored_errors:
+        if re.search(pattern, error_spelling):
+            return pattern
+    return None
+
+
+_INCLUDE_DIR_ARGS = ('-I', '-isystem', '-iquote')
+
+
+def _get_include_dirs(args):
+    """Return a list of include directories given in compile arguments."""
+    dirs = []
+    itr = iter(args)
+    for arg in itr:
+        for dir_arg in _INCLUDE_DIR_ARGS:
+            if arg == dir_arg:
+                dirs.append(next(itr, ''))
+                break
+            elif arg.startswith(dir_arg):
+                dirs.append(arg[len(dir_arg):])
+                break
+    return dirs
+
+
+def _make_fingerprint(cmd, dependencies):
+    """Return a fingerprint of the inputs of a compile command.
+
+    The fingerprint covers the compile arguments and the mtimes and sizes of
+    the given files.  Files that do not exist are part of it too, so that
+    creating a previously missing header changes it.
+
+    Arguments:
+    cmd -- compile command
+    dependencies -- paths of the source file, all files it includes and
+                    headers it failed to find
+    """
+    def state(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return '-'
+        return '{0!r} {1}'.format(st.st_mtime, st.st_size)
+
+    digest = hashlib.sha1()
+
+    def update(*parts):
+        for part in parts:
+            if isinstance(part, unicode):
+                part = part.encode('utf-8')
+            digest.update(part)
+            digest.update('\0')
+
+    update(cmd.current_dir, *cmd.args.all_args)
+    for path in sorted(set(dependencies)):
+        update(path, state(path))
+    return digest.hexdigest()
+
+
+_MISSING_HEADER_RE = re.compile(r"^'(.+)' file not found$")
+
+
+def _get_missing_header_paths(cmd, errors):
+    """Return the paths where headers that could not be found were looked for.
+
+    Arguments:
+    cmd -- compile command
+    errors -- list of _Error tuples
+    """
+    paths = set()
+    include_dirs = [os.path.join(cmd.current_dir, d)
+                    for d in _get_include_dirs(cmd.args.all_args)]
+    for e in errors:
+        m = _MISSING_HEADER_RE.match(e.spelling)
+        if not m:
+            continue
+        dirs = [os.path.dirname(e.location.filename)] + include_dirs
+        for d in dirs:
+            paths.add(os.path.normpath(os.path.join(d, m.group(1))))
+    return paths
+
+
+def index(root,
+          stop_on_error=False,
+          rollback_on_error=False,
+          retry_failed=False,
+          partition=None,
+          tier='full',
+          priority_paths=None,
+          recent=None,
+          rebuild=False):
+    tier = _get_tier(tier)
+    priority_paths = set(os.path.abspath(p) for p in priority_paths or [])
+    recent_since = None
+    if recent is not None:
+        recent_since = time.time() - recent
+    config = _read_config(root)
+    compilation_db = _CompilationDatabase(
+        root,
+        config.extra_args,
+        config.banned_args)
+    if partition is not None:
+        compilation_db = _select_partition(root, compilation_db, *partition)
+    for shard, comp_db in _split_compilation_database(config,
+                                                      compilation_db):
+        conn = _connect_to_shard(root, shard)
+        try:
+            with conn:
+                _create_schema(conn)
+                if not rebuild:
+                    file_manager = _FileManager(root,
+                                                conn,
+                                                comp_db,
+                                                config.inline_files,
+                                                tier,
+                                                priority_paths,
+                                                recent_since)
+                    _run_indexers(conn,
+                                  config,
+                                  file_manager,
+                                  stop_on_error,
+                                  rollback_on_error,
+                                  retry_failed)
+                    continue
+                generation = _query_generation(conn)
+        finally:
+            conn.close()
+        _rebuild_db(root,
+                    shard,
+                    generation,
+                    config,
+                    _BulkFileManager(root,
+                                     None,
+                                     comp_db,
+                                     config.inline_files,
+                                     tier,
+                                     priority_paths,
+                                     recent_since),
+                    stop_on_error,
+                    rollback_on_error)
+
+
+def _rebuild_db(root,
+                shard,
+                generation,
+                config,
+                file_manager,
+                stop_on_error,
+                rollback_on_error):
+    """Index all files into a new database and replace the old one with it.
+
+    The new database is filled by _BulkFileManager without secondary indices
+    and foreign key checks, which are not needed to fill a file nobody else
+    uses.  Indices are created before orphaned headers are removed and
+    foreign keys are checked at the end, then the new database is renamed
+    over the old one, so readers keep using the old database until then.
+    If indexing stops due to an error, the new database is removed, even if
+    rollback_on_error is not set, and the old database is left untouched.
+
+    Arguments:
+    root -- Yacbi project root
+    shard -- name of an index shard or None for the main database
+    generation -- generation of the old database
+    config -- project configuration
+    file_manager -- _BulkFileManager without a connection
+    stop_on_error -- stop when an error occurs
+    rollback_on_error -- rollback the transaction when an error occurs
+    """
+    dbfile = _get_db_file(root, shard)
+    new_dbfile = dbfile + '.rebuild'
+    if os.path.exists(new_dbfile):
+        os.remove(new_dbfile)
+    logger.info("rebuilding %s", dbfile)
+    conn = sqlite3.connect(
+        new_dbfile,
+        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+    try:
+        _create_schema(conn, with_indices=False)
+        cur = conn.cursor()
+        cur.execute("PRAGMA foreign_keys=OFF")
+        cur.execute("PRAGMA synchronous=OFF")
+        # readers of the old database must see the generation change
+        cur.execute("UPDATE meta SET value = ? WHERE key = 'generation'",
+                    (generation,))
+        conn.commit()
+        file_manager.start(conn)
+        _run_indexers(conn,
+                      config,
+                      file_manager,
+                      stop_on_error,
+                      rollback_on_error,
+                      True)
+        cur.execute("PRAGMA foreign_key_check")
+        if cur.fetchone() is not None:
+            raise RuntimeError(
+                "{0}: foreign key check failed".format(new_dbfile))
+        conn.close()
+        with open(new_dbfile, 'rb+') as new_db_fd:
+            os.fsync(new_db_fd.fileno())
+        os.rename(new_dbfile, dbfile)
+    except BaseException:
+        conn.close()
+        os.remove(new_dbfile)
+        raise
+
+
+def _select_partition(root, compilation_db, number, count):
+    """Return a view of a compilation database with one partition of files.
+
+    Files are assigned to partitions by a hash of their paths relative to the
+    project root, so every machine that indexes the same project computes the
+    same partitions.  An index built from a partition is meant to be merged
+    with the other ones by merge_indices().
+
+    Arguments:
+    root -- Yacbi project root
+    compilation_db -- the whole compilation database
+    number -- number of the partition, from 1 to count
+    count -- number of partitions
+    """
+    if count < 1 or not 1 <= number <= count:
+        raise ValueError("invalid partition: {0}/{1}".format(number, count))
+    paths = set()
+    for path in compilation_db.get_all_files():
+        key = os.path.relpath(path, root)
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        if (zlib.crc32(key) & 0xffffffff) % count == number - 1:
+            paths.add(path)
+    return _CompilationDatabaseView(compilation_db, paths)
+
+
+def index_files(root,
+                paths,
+                stop_on_error=False,
+                rollback_on_error=False):
+    """Update the index for given files only.
+
+    Unlike index(), this does not scan all files of the project.  Only the
+    given files and the headers they claim are reindexed, whether they have
+    changed or failed before or not, so the run takes about as long as
+    parsing them.
+
+    Arguments:
+    root -- root directory of a Yacbi project
+    paths -- list of source or header files to reindex
+    stop_on_error -- stop when an error occurs
+    rollback_on_error -- rollback the transaction when an error occurs
+    """
+    config = _read_config(root)
+    compilation_db = _CompilationDatabase(
+        root,
+        config.extra_args,
+        config.banned_args)
+    paths = set(os.path.abspath(p) for p in paths)
+    shard_conns = _connect_to_shards(root, config, compilation_db)
+    try:
+        unknown_paths = _index_paths(root,
+                                     config,
+                                     compilation_db,
+                                     shard_conns,
+                                     paths,
+                                     stop_on_error,
+                                     rollback_on_error)
+    finally:
+        for _, conn in shard_conns:
+            conn.close()
+    for path in sorted(unknown_paths):
+        logger.warning("%s: file is neither in the compilation database "
+                       "nor in the index", path)
+
+
+def _connect_to_shards(root, config, compilation_db):
+    """Return a list of (view, connection) for every shard of a project.
+
+    Arguments:
+    root -- Yacbi project root
+    config -- project configuration
+    compilation_db -- the whole compilation database
+    """
+    shard_conns = []
+    try:
+        for shard, comp_db in _split_compilation_database(config,
+                                                          compilation_db):
+            conn = _connect_to_shard(root, shard)
+            shard_conns.append((comp_db, conn))
+            _create_schema(conn)
+    except Exception:
+        for _, conn in shard_conns:
+            conn.close()
+        raise
+    return shard_conns
+
+
+def _index_paths(root,
+                 config,
+                 compilation_db,
+                 shard_conns,
+                 paths,
+                 stop_on_error,
+                 rollback_on_error):
+    """Reindex given files in every shard they belong to.
+
+    Return a set of paths that belong to no shard.
+
+    Arguments:
+    root -- Yacbi project root
+    config -- project configuration
+    compilation_db -- the whole compilation database
+    shard_conns -- list returned by _connect_to_shards()
+    paths -- set of absolute paths of files to reindex
+    stop_on_error -- stop when an error occurs
+    rollback_on_error -- rollback the transaction when an error occurs
+    """
+    unknown_paths = set(paths)
+    for comp_db, conn in shard_conns:
+        with conn:
+            shard_paths = [p for p in paths
+                           if comp_db.has_file(p) or
+                           (not compilation_db.has_file(p) and
+                            _is_indexed(conn, p))]
+            unknown_paths.difference_update(shard_paths)
+            if not shard_paths:
+                continue
+            file_manager = _TargetedFileManager(root,
+                                                conn,
+                                                comp_db,
+                                                config.inline_files,
+                                                shard_paths)
+            _run_indexers(conn,
+                          config,
+                          file_manager,
+                          stop_on_error,
+                          rollback_on_error,
+                          True)
+    return unknown_paths
+
+
+def _is_indexed(conn, path):
+    """Check if a file is present in a Yacbi database."""
+    cur = conn.cursor()
+    cur.execute("SELECT 1 FROM files WHERE path = ? LIMIT 1", (path,))
+    return cur.fetchone() is not None
+
+
+_WATCH_IGNORED_DIRS = frozenset(['.yacbi', '.git', '.hg', '.svn'])
+
+
+def _iter_watched_dirs(top):
+    """Yield a directory and all its subdirectories that should be watched."""
+    for dirpath, dirnames, _ in os.walk(top):
+        dirnames[:] = [d for d in dirnames if d not in _WATCH_IGNORED_DIRS]
+        yield dirpath
+
+
+class _InotifyWatcher(object):
+    """Reports changes of files in directory trees using Linux inotify."""
+
+    _IN_MODIFY = 0x2
+    _IN_ATTRIB = 0x4
+    _IN_CLOSE_WRITE = 0x8
+    _IN_MOVED_FROM = 0x40
+    _IN_MOVED_TO = 0x80
+    _IN_CREATE = 0x100
+    _IN_DELETE = 0x200
+    _IN_Q_OVERFLOW = 0x4000
+    _IN_IGNORED = 0x8000
+    _IN_ISDIR = 0x40000000
+    _IN_CLOEXEC = 0x80000
+
+    _EVENT = struct.Struct('iIII')
+
+    def __init__(self, trees, dirs=()):
+        """Start watching given directory trees and directories.
+
+        Raise OSError if inotify is not available.
+
+        Arguments:
+        trees -- list of directories to watch recursively
+        dirs -- list of directories to watch without their subdirectories
+        """
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError("C library not found")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError("inotify is not available")
+        self._fd = self._libc.inotify_init1(self._IN_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._dirs = {}
+        self._trees = set()
+        try:
+            for top in trees:
+                self._add_tree(top)
+            for dirpath in dirs:
+                self._add_dir(dirpath)
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def read_changes(self, timeout):
+        """Return a set of changed paths or None if events have been lost.
+
+        Arguments:
+        timeout -- number of seconds to wait for a change (None for no limit)
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+        data = os.read(self._fd, 65536)
+        changes = set()
+        overflow = False
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = self._EVENT.unpack_from(data, pos)
+            pos += self._EVENT.size
+            name = data[pos:pos + length].rstrip('\0')
+            pos += length
+            if mask & self._IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if mask & self._IN_IGNORED:
+                self._dirs.pop(wd, None)
+                self._trees.discard(wd)
+                continue
+            dirpath = self._dirs.get(wd, None)
+            if dirpath is None or not name:
+                continue
+            if isinstance(dirpath, unicode):
+                name = name.decode(sys.getfilesystemencoding(), 'replace')
+            path = os.path.join(dirpath, name)
+            if mask & self._IN_ISDIR:
+                if (mask & (self._IN_CREATE | self._IN_MOVED_TO) and
+                        wd in self._trees and
+                        name not in _WATCH_IGNORED_DIRS):
+                    # files may have been created before the watch was added
+                    self._add_tree(path)
+                    for subdir, _, filenames in os.walk(path):
+                        changes.update(os.path.join(subdir, f)
+                                       for f in filenames)
+                continue
+            changes.add(path)
+        if overflow:
+            logger.warning("inotify queue overflow, changes have been lost")
+            return None
+        return changes
+
+    def _add_tree(self, top):
+        for dirpath in _iter_watched_dirs(top):
+            self._trees.add(self._add_dir(dirpath))
+
+    def _add_dir(self, dirpath):
+        flags = (self._IN_MODIFY | self._IN_ATTRIB | self._IN_CLOSE_WRITE |
+                 self._IN_MOVED_FROM | self._IN_MOVED_TO | self._IN_CREATE |
+                 self._IN_DELETE)
+        encoded_path = dirpath
+        if isinstance(encoded_path, unicode):
+            encoded_path = encoded_path.encode(sys.getfilesystemencoding())
+        wd = self._libc.inotify_add_watch(self._fd, encoded_path, flags)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno,
+                          "{0}: {1}".format(dirpath, os.strerror(errno)))
+        self._dirs[wd] = dirpath
+        return wd
+
+
+class _PollingWatcher(object):
+    """Reports changes of files by checking their modification times."""
+
+    def __init__(self, paths, interval):
+        """Start watching given files.
+
+        Arguments:
+        paths -- set of files to watch
+        interval -- number of seconds between checks
+        """
+        self._interval = interval
+        self._states = {}
+        self.set_paths(paths)
+
+    def close(self):
+        pass
+
+    def set_paths(self, paths):
+        """Replace the set of watched files."""
+        self._states = dict((path, self._states.get(path, None) or
+                             self._get_state(path))
+                            for path in paths)
+
+    def read_changes(self, timeout):
+        """Return a set of changed paths.
+
+        Arguments:
+        timeout -- number of seconds to wait for a change (None for no limit)
+        """
+        waited = 0.0
+        while True:
+            changes = set()
+            for path, state in self._states.iteritems():
+                new_state = self._get_state(path)
+                if new_state != state:
+                    self._states[path] = new_state
+                    changes.add(path)
+            if changes or (timeout is not None and waited >= timeout):
+                return changes
+            delay = self._interval
+            if timeout is not None:
+                delay = min(delay, timeout - waited)
+            time.sleep(delay)
+            waited += delay
+
+    @staticmethod
+    def _get_state(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return (None, None)
+        return (st.st_mtime, st.st_size)
+
+
+def _get_watched_paths(root, compilation_db, conns):
+    """Return a set of files that the polling watcher should check.
+
+    Arguments:
+    root -- Yacbi project root
+    compilation_db -- the whole compilation database
+    conns -- connections to the databases of the project
+    """
+    paths = compilation_db.get_all_files()
+    paths.add(os.path.join(root, 'compile_commands.json'))
+    paths.add(os.path.join(root, '.yacbi', 'config.json'))
+    for conn in conns:
+        cur = conn.cursor()
+        cur.execute("SELECT path FROM files")
+        paths.update(tup[0] for tup in cur.fetchall())
+    return paths
+
+
+def _make_watcher(root, compilation_db, poll_interval):
+    """Return an inotify watcher or a polling one if it is not available.
+
+    The project root is watched recursively.  Directories of sources outside
+    of it are watched without their subdirectories, which may be huge.
+    """
+    if poll_interval is None:
+        dirs = set([os.path.join(root, '.yacbi')])
+        for path in compilation_db.get_all_files():
+            dirname = os.path.dirname(path)
+            if not dirname.startswith(root + os.path.sep):
+                dirs.add(dirname)
+        try:
+            return _InotifyWatcher([root], sorted(dirs))
+        except OSError, e:
+            logger.warning("cannot use inotify (%s), falling back to polling",
+                           e)
+            poll_interval = _DEFAULT_POLL_INTERVAL
+    with _open_dbs(root) as conns:
+        return _PollingWatcher(_get_watched_paths(root,
+                                                  compilation_db,
+                                                  conns.values()),
+                               poll_interval)
+
+
+_DEFAULT_POLL_INTERVAL = 2.0
+
+
+def _find_including_sources(shard_conns, paths):
+    """Return sources including any of given headers directly or indirectly."""
+    sources = set()
+    for _, conn in shard_conns:
+        cur = conn.cursor()
+        for path in paths:
+            cur.execute("""
+                        WITH RECURSIVE includers (file_id) AS (
+                          SELECT id FROM files
+                          WHERE path = ? AND is_included
+                          UNION
+                          SELECT i.including_file_id
+                          FROM includes i
+                          INNER JOIN includers c ON (
+                            i.included_file_id = c.file_id)
+                        )
+                        SELECT f.path
+                        FROM files f
+                        INNER JOIN includers c ON (f.id = c.file_id)
+                        WHERE NOT f.is_included""",
+                        (path,))
+            sources.update(tup[0] for tup in cur.fetchall())
+    return sources
+
+
+def _find_affected_failures(shard_conns, paths):
+    """Return a set of failed files that depend on any of given paths."""
+    failed = set()
+    for _, conn in shard_conns:
+        cur = conn.cursor()
+        for path in paths:
+            cur.execute("""
+                        SELECT
+                          f.path
+                        FROM failure_dependencies d
+                        INNER JOIN failures f ON (d.failure_id = f.id)
+                        WHERE d.path = ?""",
+                        (path,))
+            failed.update(tup[0] for tup in cur.fetchall())
+    return failed
+
+
+def watch(root,
+          debounce=1.0,
+          poll_interval=None,
+          stop_on_error=False,
+          rollback_on_error=False):
+    """Keep the index up to date until interrupted.
+
+    After an initial index() run, changes of files are watched with inotify
+    or, if it is not available or poll_interval is given, by polling.  The
+    watches are set up before index() starts, so changes made while it runs
+    are not lost.  Changes are collected until no new ones arrive for
+    debounce seconds and then the changed files and all sources including
+    changed headers are reindexed.  The compilation database
+    and connections to the databases are kept between batches.  A change of
+    the compilation database or the configuration, as well as lost inotify
+    events, leads to a complete index() run.
+
+    Arguments:
+    root -- root directory of a Yacbi project
+    debounce -- number of seconds without changes that ends a batch
+    poll_interval -- number of seconds between checks when polling
+    stop_on_error -- stop when an error occurs
+    rollback_on_error -- rollback the transaction when an error occurs
+    """
+    reload_paths = set([os.path.join(root, 'compile_commands.json'),
+                        os.path.join(root, '.yacbi', 'config.json')])
+    yacbi_dir = os.path.join(root, '.yacbi') + os.path.sep
+    watcher = None
+    shard_conns = []
+    try:
+        changes = None
+        while True:
+            if changes is None or changes & reload_paths:
+                for _, conn in shard_conns:
+                    conn.close()
+                shard_conns = []
+                config = _read_config(root)
+                compilation_db = _CompilationDatabase(
+                    root,
+                    config.extra_args,
+                    config.banned_args)
+                if watcher is not None:
+                    watcher.close()
+                watcher = _make_watcher(root, compilation_db, poll_interval)
+                index(root, stop_on_error, rollback_on_error)
+                shard_conns = _connect_to_shards(root, config, compilation_db)
+                if isinstance(watcher, _PollingWatcher):
+                    watcher.set_paths(_get_watched_paths(
+                        root,
+                        compilation_db,
+                        [conn for _, conn in shard_conns]))
+                logger.info("watching %s", root)
+            elif changes:
+                changes.update(_find_including_sources(shard_conns, changes))
+                changes.update(_find_affected_failures(shard_conns, changes))
+                logger.info("reindexing %d changed files", len(changes))
+                _index_paths(root,
+                             config,
+                             compilation_db,
+                             shard_conns,
+                             changes,
+                             stop_on_error,
+                             rollback_on_error)
+                if isinstance(watcher, _PollingWatcher):
+                    watcher.set_paths(_get_watched_paths(
+                        root,
+                        compilation_db,
+                        [conn for _, conn in shard_conns]))
+            changes = set()
+            while changes is not None:
+                batch = watcher.read_changes(debounce if changes else None)
+                if batch is None:
+                    changes = None
+                elif batch:
+                    changes.update(p for p in batch
+                                   if not p.startswith(yacbi_dir) or
+                                   p in reload_paths)
+                elif changes:
+                    break
+    finally:
+        for _, conn in shard_conns:
+            conn.close()
+        if watcher is not None:
+            watcher.close()
+
+
+def _query_compile_command(conn, path):
+    """Return the compile command stored for a file in a Yacbi database."""
+    cur = conn.cursor()
+    cur.execute("""
+                SELECT
+                  id,
+                  working_dir,
+                  is_included
+                FROM files
+                WHERE path = ?""",
+                (path,))
+    file_id, cwd, is_included = cur.fetchone()
+    cur.execute("""
+                SELECT arg
+                FROM compile_args
+                WHERE file_id = ?
+                ORDER BY id""",
+                (file_id,))
+    args = [tup[0] for tup in cur.fetchall()]
+    return _CompileCommand(path,
+                           _make_compile_args(cwd, args, [], []),
+                           cwd,
+                           is_included)
+
+
+def index_unsaved(root, buffers):
+    """Index contents of unsaved editor buffers without touching the database.
+
+    Every buffer is parsed with the compile command of its file and with all
+    buffers given so far passed to Clang as unsaved files.  Indices of the
+    buffered files are kept in memory and take precedence over the database
+    in queries until clear_unsaved() is called.  Transitive includes are
+    still answered from the database only.
+
+    Return a list of Diagnostic for errors found while parsing.
+
+    Arguments:
+    root -- root directory of a Yacbi project
+    buffers -- dictionary that maps file paths to contents of the buffers
+    """
+    with _overlays_lock:
+        return _index_unsaved(root, buffers)
+
+
+def _index_unsaved(root, buffers):
+    overlay = _overlays.get(root, None)
+    if overlay is None:
+        overlay = _Overlay()
+    config = _read_config(root)
+    comp_db = overlay.get_compilation_database(root, config)
+    buffers = dict((os.path.abspath(path), contents)
+                   for path, contents in buffers.iteritems())
+    all_buffers = dict(overlay.buffers)
+    all_buffers.update(buffers)
+    unsaved_files = all_buffers.items()
+    file_manager = _OverlayFileManager(root, overlay.conn, set(buffers))
+    indices = []
+    diagnostics = []
+    with _open_dbs(root) as conns:
+        # sources first, so that headers are indexed as parts of them
+        for path in sorted(buffers, key=lambda p: comp_db.has_file(p),
+                           reverse=True):
+            if path in file_manager.visited:
+                continue
+            cmd = comp_db.get_compile_command(path)
+            if cmd is None:
+                for conn in conns.itervalues():
+                    if _is_indexed(conn, path):
+                        cmd = _query_compile_command(conn, path)
+                        break
+            if cmd is None:
+                logger.warning("%s: file is neither in the compilation "
+                               "database nor in the index", path)
+                continue
+            file_manager.visited.add(path)
+            logger.info("indexing unsaved %s", path)
+            indexer = Indexer(file_manager,
+                              cmd,
+                              unsaved_files=unsaved_files)
+            indexer.index()
+            indices.extend(indexer.idx_by_path.itervalues())
+            diagnostics.extend(Diagnostic(e.location, e.spelling)
+                               for e in indexer.errors)
+    with overlay.lock:
+        file_manager.save_indices(indices)
+        overlay.conn.commit()
+        overlay.buffers = all_buffers
+        overlay.paths = overlay.paths.union(idx.filename for idx in indices)
+        overlay.generation += 1
+    _overlays[root] = overlay
+    return diagnostics
+
+
+def clear_unsaved(root, paths=None):
+    """Forget unsaved buffers given to index_unsaved().
+
+    Arguments:
+    root -- root directory of a Yacbi project
+    paths -- list of files whose buffers have been saved or discarded
+             (None for all of them)
+    """
+    with _overlays_lock:
+        _clear_unsaved(root, paths)
+
+
+def _clear_unsaved(root, paths):
+    overlay = _overlays.get(root, None)
+    if overlay is None:
+        return
+    if paths is None:
+        del _overlays[root]
+        return
+    paths = set(os.path.abspath(p) for p in paths)
+    with overlay.lock:
+        cur = overlay.conn.cursor()
+        for path in paths:
+            cur.execute("SELECT id FROM files WHERE path = ? LIMIT 1",
+                        (path,))
+            file_id = cur.fetchone()
+            if file_id:
+                cur.execute("DELETE FROM refs WHERE file_id = ?", file_id)
+                cur.execute("DELETE FROM inheritance WHERE file_id = ?",
+                            file_id)
+                cur.execute("DELETE FROM includes WHERE including_file_id = ?",
+                            file_id)
+        overlay.conn.commit()
+        overlay.buffers = dict((path, contents)
+                               for path, contents
+                               in overlay.buffers.iteritems()
+                               if path not in paths)
+        overlay.paths = overlay.paths.difference(paths)
+        overlay.generation += 1
+    if not overlay.paths:
+        del _overlays[root]
+
+
+def _run_indexers(conn,
+                  config,
+                  file_manager,
+                  stop_on_error,
+                  rollback_on_error,
+                  retry_failed):
+    stats = _IndexingStats()
+    for cmd in file_manager:
+        if not retry_failed and file_manager.is_known_failure(cmd):
+            logger.info("skipping %s: it failed before and has not changed",
+                        cmd.filename)
+            continue
+        logger.info("indexing %s", cmd.filename)
+        indexer = Indexer(file_manager,
+                          cmd,
+                          config.quick_tier_macros,
+                          reference_chunk_size=config.reference_chunk_size)
+        try:
+            indexer.index()
+        except Exception, e:
+            logger.error("%s: %s", cmd.filename, e)
+            file_manager.save_failure(
+                cmd,
+                indexer.dependencies,
+                [_Error(str(e), SourceLocation(cmd.filename, 0, 0), None)])
+            if stop_on_error:
+                if not rollback_on_error:
+                    _commit_index(conn)
+                raise RuntimeError("stopping due to: {0}".format(e))
+            continue
+        relevant_errors = []
+        for e in indexer.errors:
+            logger.error("%s:%d:%d: %s",
+                         e.location.filename,
+                         e.location.line,
+                         e.location.column,
+                         e.spelling)
+            ignore_pattern = _find_ignore_pattern(e.spelling,
+                                                  config.ignored_errors)
+            if ignore_pattern:
+                logger.info('ignoring error: "%s" due to "%s"',
+                            e.spelling,
+                            ignore_pattern)
+            else:
+                relevant_errors.append(e)
+        if not relevant_errors:
+            file_manager.save_indices(indexer.idx_by_path.values())
+            file_manager.remove_failure(cmd.filename)
+            stats.add(indexer.src_index, indexer.peak_reference_size)
+            continue
+        file_manager.save_failure(cmd, indexer.dependencies, relevant_errors)
+        if stop_on_error:
+            if not rollback_on_error:
+                _commit_index(conn)
+            raise RuntimeError("stopping due to: {0}".format(e.spelling))
+    file_manager.remove_orphaned_includes()
+    _commit_index(conn)
+    stats.log()
+
+
+class _IndexingStats(object):
+    """Summary of time spent on indexing files in one run."""
+
+    _LONGEST_COUNT = 5
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.count = 0
+        self.parse_time = 0.0
+        self.traverse_time = 0.0
+        self.longest = []
+        self.peak_reference_size = 0
+        self.peak_reference_path = None
+
+    def add(self, idx, reference_size):
+        self.count += 1
+        if reference_size > self.peak_reference_size:
+            self.peak_reference_size = reference_size
+            self.peak_reference_path = idx.filename
+        self.parse_time += idx.parse_time
+        self.traverse_time += idx.traverse_time
+        item = (idx.parse_time + idx.traverse_time, idx.filename)
+        if len(self.longest) < self._LONGEST_COUNT:
+            heapq.heappush(self.longest, item)
+        else:
+            heapq.heappushpop(self.longest, item)
+
+    def log(self):
+        if not self.count:
+            return
+        logger.info("indexed %d files in %.1fs "
+                    "(parsing %.1fs, traversing %.1fs)",
+                    self.count,
+                    time.time() - self.start_time,
+                    self.parse_time,
+                    self.traverse_time)
+        for duration, path in sorted(self.longest, reverse=True):
+            logger.info("  %.1fs %s", duration, path)
+        logger.info("peak memory: %.1f MiB RSS, %.1f MiB of references "
+                    "buffered for %s",
+                    _get_peak_rss() / 1048576.0,
+                    self.peak_reference_size / 1048576.0,
+                    self.peak_reference_path)
+
+
+def _get_peak_rss():
+    """Return the peak resident set size of the process in bytes."""
+    if resource is None:
+        return 0
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes everywhere but on OS X
+    if sys.platform != 'darwin':
+        peak_rss *= 1024
+    return peak_rss
+
+
+def merge_indices(output, inputs):
+    """Merge Yacbi databases into one.
+
+    The output database is created if it does not exist.  A file indexed in
+    more than one database (e.g. a header included from several partitions)
+    is taken from the one where it is a source file, then from the one where
+    it has been indexed by a higher tier and finally from the one where it
+    was indexed most recently.  Inputs are only read, so they may be
+    read-only or created by older versions.
+
+    Arguments:
+    output -- path to the resulting database
+    inputs -- list of paths to databases that should be merged into output
+    """
+    conn = sqlite3.connect(
+        output,
+        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+    try:
+        _create_schema(conn)
+        conn.isolation_level = None
+        for dbfile in inputs:
+            if not os.path.isfile(dbfile):
+                raise RuntimeError("no such file: {0}".format(dbfile))
+            logger.info("merging %s", dbfile)
+            _merge_db(conn, dbfile)
+    finally:
+        conn.close()
+
+
+def _merge_db(conn, dbfile):
+    """Merge a database into another one.
+
+    Arguments:
+    conn -- connection to the resulting database in autocommit mode
+    dbfile -- path to the database that should be merged
+    """
+    cur = conn.cursor()
+    cur.execute("ATTACH DATABASE ? AS src", (dbfile,))
+    try:
+        _create_source_views(cur)
+        cur.executescript("""
+            CREATE TEMP TABLE merged_files (
+              src_id INTEGER NOT NULL,
+              dst_id INTEGER,
+              take BOOL NOT NULL,
+              PRIMARY KEY (src_id)
+            );
+
+            CREATE TEMP TABLE merged_symbols (
+              src_id INTEGER NOT NULL,
+              dst_id INTEGER NOT NULL,
+              PRIMARY KEY (src_id)
+            );
+
+            CREATE TEMP TABLE merged_failures (
+              src_id INTEGER NOT NULL,
+              dst_id INTEGER,
+              PRIMARY KEY (src_id)
+            );
+            """)
+        cur.execute("BEGIN")
+        try:
+            for statement in _MERGE_STATEMENTS:
+                cur.execute(statement)
+            cur.execute("""
+                UPDATE main.meta SET value = value + 1
+                WHERE key = 'generation'""")
+            cur.execute("COMMIT")
+        except:
+            cur.execute("ROLLBACK")
+            raise
+    finally:
+        cur.executescript("""
+            DROP TABLE IF EXISTS temp.merged_files;
+            DROP TABLE IF EXISTS temp.merged_symbols;
+            DROP TABLE IF EXISTS temp.merged_failures;
+            """)
+        for table in _MERGED_TABLES:
+            cur.execute("DROP VIEW IF EXISTS temp.src_{0}".format(table))
+        cur.execute("DETACH DATABASE src")
+
+
+# tables read from merged databases
+_MERGED_TABLES = ['files',
+                  'compile_args',
+                  'symbols',
+                  'refs',
+                  'inheritance',
+                  'includes',
+                  'failures',
+                  'failure_dependencies',
+                  'failure_diagnostics']
+
+
+def _create_source_views(cur):
+    """Create views with the current schema of tables of the src database.
+
+    The src database may have been created by an older version.  Its missing
+    columns are filled with their defaults and missing tables are empty.
+    """
+    defaults = dict(((table, column), definition)
+                    for table, column, definition in _ADDED_COLUMNS)
+    for table in _MERGED_TABLES:
+        cur.execute("PRAGMA main.table_info({0})".format(table))
+        columns = [tup[1] for tup in cur.fetchall()]
+        cur.execute("PRAGMA src.table_info({0})".format(table))
+        src_columns = set(tup[1] for tup in cur.fetchall())
+        exprs = []
+        for column in columns:
+            if column in src_columns:
+                exprs.append('"{0}"'.format(column))
+                continue
+            m = re.search(r'DEFAULT (\S+)',
+                          defaults.get((table, column), ''))
+            exprs.append('{0} AS "{1}"'.format(m.group(1) if m else 'NULL',
+                                               column))
+        if src_columns:
+            source = "FROM src.{0}".format(table)
+        else:
+            source = "WHERE 0"
+        cur.execute("CREATE TEMP VIEW src_{0} AS SELECT {1} {2}".format(
+            table, ', '.join(exprs), source))
+
+
+_MERGE_STATEMENTS = [
+    # decide which copy of each file is kept
+    """
+    INSERT INTO temp.merged_files (src_id, dst_id, take)
+    SELECT
+      s.id,
+      f.id,
+      f.id IS NULL OR
+      s.is_included < f.is_included OR
+      (s.is_included = f.is_included AND
+       (s.tier > f.tier OR
+        (s.tier = f.tier AND s.last_update > f.last_update)))
+    FROM temp.src_files s
+    LEFT OUTER JOIN main.files f ON (s.path = f.path)
+    """,
+    # drop data of files that are replaced
+    """
+    DELETE FROM main.refs WHERE file_id IN (
+      SELECT dst_id FROM temp.merged_files WHERE take)
+    """,
+    """
+    DELETE FROM main.inheritance WHERE file_id IN (
+      SELECT dst_id FROM temp.merged_files WHERE take)
+    """,
+    """
+    DELETE FROM main.compile_args WHERE file_id IN (
+      SELECT dst_id FROM temp.merged_files WHERE take)
+    """,
+    """
+    DELETE FROM main.includes WHERE including_file_id IN (
+      SELECT dst_id FROM temp.merged_files WHERE take)
+    """,
+    """
+    UPDATE main.files SET
+      working_dir = (
+        SELECT s.working_dir FROM temp.src_files s
+        WHERE s.path = main.files.path),
+      last_update = (
+        SELECT s.last_update FROM temp.src_files s
+        WHERE s.path = main.files.path),
+      is_included = (
+        SELECT s.is_included FROM temp.src_files s
+        WHERE s.path = main.files.path),
+      tier = (
+        SELECT s.tier FROM temp.src_files s
+        WHERE s.path = main.files.path),
+      parse_time = (
+        SELECT s.parse_time FROM temp.src_files s
+        WHERE s.path = main.files.path),
+      traverse_time = (
+        SELECT s.traverse_time FROM temp.src_files s
+        WHERE s.path = main.files.path),
+      generation = (
+        SELECT value + 1 FROM main.meta WHERE key = 'generation')
+    WHERE id IN (SELECT dst_id FROM temp.merged_files WHERE take)
+    """,
+    # add new files
+    """
+    INSERT INTO main.files (
+      path,
+      working_dir,
+      last_update,
+      is_included,
+      tier,
+      parse_time,
+      traverse_time,
+      generation)
+    SELECT
+      s.path,
+      s.working_dir,
+      s.last_update,
+      s.is_included,
+      s.tier,
+      s.parse_time,
+      s.traverse_time,
+      (SELECT value + 1 FROM main.meta WHERE key = 'generation')
+    FROM temp.src_files s
+    INNER JOIN temp.merged_files m ON (s.id = m.src_id)
+    WHERE m.dst_id IS NULL
+    ORDER BY s.path
+    """,
+    """
+    UPDATE temp.merged_files SET dst_id = (
+      SELECT f.id
+      FROM temp.src_files s
+      INNER JOIN main.files f ON (s.path = f.path)
+      WHERE s.id = temp.merged_files.src_id)
+    WHERE dst_id IS NULL
+    """,
+    # map symbols
+    """
+    INSERT OR IGNORE INTO main.symbols (usr, name)
+    SELECT usr, name FROM temp.src_symbols ORDER BY usr
+    """,
+    """
+    UPDATE main.symbols SET name = (
+      SELECT s.name FROM temp.src_symbols s WHERE s.usr = main.symbols.usr)
+    WHERE name IS NULL
+    """,
+    """
+    INSERT INTO temp.merged_symbols (src_id, dst_id)
+    SELECT s.id, d.id
+    FROM temp.src_symbols s
+    INNER JOIN main.symbols d ON (s.usr = d.usr)
+    """,
+    # copy data of files that are taken
+    """
+    INSERT INTO main.compile_args (file_id, arg)
+    SELECT m.dst_id, a.arg
+    FROM temp.src_compile_args a
+    INNER JOIN temp.merged_files m ON (a.file_id = m.src_id)
+    WHERE m.take
+    ORDER BY a.id
+    """,
+    """
+    INSERT INTO main.refs (
+      symbol_id,
+      file_id,
+      line,
+      "column",
+      kind,
+      is_definition,
+      length)
+    SELECT
+      ms.dst_id,
+      mf.dst_id,
+      r.line,
+      r."column",
+      r.kind,
+      r.is_definition,
+      r.length
+    FROM temp.src_refs r
+    INNER JOIN temp.merged_files mf ON (r.file_id = mf.src_id)
+    INNER JOIN temp.merged_symbols ms ON (r.symbol_id = ms.src_id)
+    WHERE mf.take
+    ORDER BY 1, 2, 3, 4
+    """,
+    """
+    INSERT INTO main.inheritance (
+      derived_symbol_id,
+      base_symbol_id,
+      file_id,
+      line,
+      "column")
+    SELECT md.dst_id, mb.dst_id, mf.dst_id, i.line, i."column"
+    FROM temp.src_inheritance i
+    INNER JOIN temp.merged_files mf ON (i.file_id = mf.src_id)
+    INNER JOIN temp.merged_symbols md ON (i.derived_symbol_id = md.src_id)
+    INNER JOIN temp.merged_symbols mb ON (i.base_symbol_id = mb.src_id)
+    WHERE mf.take
+    ORDER BY 1, 2, 3, 4, 5
+    """,
+    """
+    INSERT OR IGNORE INTO main.includes (
+      including_file_id,
+      included_file_id,
+      line,
+      "column")
+    SELECT mi.dst_id, md.dst_id, i.line, i."column"
+    FROM temp.src_includes i
+    INNER JOIN temp.merged_files mi ON (i.including_file_id = mi.src_id)
+    INNER JOIN temp.merged_files md ON (i.included_file_id = md.src_id)
+    WHERE mi.take
+    ORDER BY 1, 2, 3, 4
+    """,
+    # files indexed now do not fail anymore; failures of other files are kept
+    # unless they are already known
+    """
+    DELETE FROM main.failures WHERE path IN (
+      SELECT s.path
+      FROM temp.src_files s
+      INNER JOIN temp.merged_files m ON (s.id = m.src_id)
+      WHERE m.take)
+    """,
+    """
+    INSERT INTO temp.merged_failures (src_id)
+    SELECT s.id
+    FROM temp.src_failures s
+    WHERE
+      NOT EXISTS (SELECT 1 FROM main.failures f WHERE f.path = s.path) AND
+      NOT EXISTS (SELECT 1 FROM main.files f WHERE f.path = s.path)
+    """,
+    """
+    INSERT INTO main.failures (path, fingerprint, last_attempt)
+    SELECT s.path, s.fingerprint, s.last_attempt
+    FROM temp.src_failures s
+    INNER JOIN temp.merged_failures m ON (s.id = m.src_id)
+    """,
+    """
+    UPDATE temp.merged_failures SET dst_id = (
+      SELECT f.id
+      FROM temp.src_failures s
+      INNER JOIN main.failures f ON (s.path = f.path)
+      WHERE s.id = temp.merged_failures.src_id)
+    """,
+    """
+    INSERT INTO main.failure_dependencies (failure_id, path)
+    SELECT m.dst_id, d.path
+    FROM temp.src_failure_dependencies d
+    INNER JOIN temp.merged_failures m ON (d.failure_id = m.src_id)
+    """,
+    """
+    INSERT INTO main.failure_diagnostics (
+      failure_id,
+      path,
+      line,
+      "column",
+      spelling)
+    SELECT m.dst_id, d.path, d.line, d."column", d.spelling
+    FROM temp.src_failure_diagnostics d
+    INNER JOIN temp.merged_failures m ON (d.failure_id = m.src_id)
+    ORDER BY d.id
+    """,
+]
+
+
+_LocationInFile = collections.namedtuple('_LocationInFile', ['line', 'column'])
+
+
+# length is the number of bytes of the referencing token, 0 if unknown
+_ReferenceData = collections.namedtuple(
+    '_ReferenceData', ['is_definition', 'kind', 'length'])
+
+
+# longest token length that fits into packed reference data
+_MAX_TOKEN_LENGTH = 0x7fff
+
+
+def _pack_reference_data(is_definition, kind, length):
+    """Pack reference data into an int that compares like _ReferenceData."""
+    return is_definition << 31 | kind << 15 | min(length, _MAX_TOKEN_LENGTH)
+
+
+def _unpack_reference_data(data):
+    """Return (is_definition, kind, length or None) of packed data."""
+    return bool(data >> 31), data >> 15 & 0xffff, data & 0x7fff or None
+
+
+_Error = collections.namedtuple(
+    '_Error', ['spelling', 'location', 'disable_option'])
+
+
+_FileInclusion = collections.namedtuple(
+    '_FileInclusion', ['included_path', 'line', 'column'])
+
+
+class _UsrTable(object):
+    """USRs interned for all files indexed as a part of one source file."""
+
+    def __init__(self):
+        self.clear()
+
+    def intern(self, usr, name=None):
+        usr_id = self.ids.get(usr, None)
+        if usr_id is None:
+            usr_id = len(self.usrs)
+            self.ids[usr] = usr_id
+            self.usrs.append(usr)
+            self.names.append(name or None)
+            self.size += len(usr) + len(name or '')
+        return usr_id
+
+    def clear(self):
+        self.ids = {}
+        self.usrs = []
+        self.names = []
+        self.size = 0
+
+
+class _ReferenceStore(object):
+    """References of one file kept in arrays of unsigned ints.
+
+    A reference takes four ints (USR id, line, column and _ReferenceData
+    packed into one by _pack_reference_data()) instead of a dict entry with
+    two namedtuples.  Duplicates are kept until rows are read.
+    """
+
+    def __init__(self, usrs):
+        self.usrs = usrs
+        self.clear()
+
+    def __len__(self):
+        return len(self.usr_ids)
+
+    def add(self, usr, loc, ref, name=None):
+        usr_id = self.usrs.ids.get(usr, None)
+        if usr_id is None:
+            usr_id = self.usrs.intern(usr, name)
+        self.usr_ids.append(usr_id)
+        self.lines.append(loc.line)
+        self.columns.append(loc.column)
+        self.data.append(_pack_reference_data(*ref))
+
+    def clear(self):
+        self.usr_ids = array.array('I')
+        self.lines = array.array('I')
+        self.columns = array.array('I')
+        self.data = array.array('I')
+
+    def get_size(self):
+        return len(self.usr_ids) * 4 * self.usr_ids.itemsize
+
+    def iter_by_usr(self):
+        """Yield (usr, name, [(line, column, data), ...]).
+
+        data is (is_definition, kind, length or None).
+
+        Only the greatest _ReferenceData of every location is yielded.
+        """
+        # all four values packed into one int sort by location and then by
+        # _ReferenceData, so the last one of every location is the greatest
+        keys = [usr_id << 96 | line << 64 | column << 32 | data
+                for usr_id, line, column, data
+                in itertools.izip(self.usr_ids,
+                                  self.lines,
+                                  self.columns,
+                                  self.data)]
+        keys.sort()
+        usrs = self.usrs.usrs
+        names = self.usrs.names
+        usr_id = None
+        last_loc = None
+        rows = []
+        for key in keys:
+            loc = key >> 32
+            row = (loc >> 32 & 0xffffffff,
+                   loc & 0xffffffff,
+                   _unpack_reference_data(key & 0xffffffff))
+            if loc == last_loc:
+                rows[-1] = row
+                continue
+            last_loc = loc
+            if loc >> 64 != usr_id:
+                if rows:
+                    yield usrs[usr_id], names[usr_id], rows
+                usr_id = loc >> 64
+                rows = []
+            rows.append(row)
+        if rows:
+            yield usrs[usr_id], names[usr_id], rows
+
+
+class _Index(object):
+    def __init__(self, cmd, usrs=None, tier=None):
+        self.filename = cmd.filename
+        self.cwd = cmd.current_dir
+        self.args = cmd.args
+        self.includes = set()
+        self.bases = set()
+        if usrs is None:
+            usrs = _UsrTable()
+        self.usrs = usrs
+        self.references = _ReferenceStore(usrs)
+        # set when some references have been moved to staged_refs
+        self.stage_id = None
+        self.file_id = None
+        self.is_included = cmd.is_included
+        self.parse_time = None
+        self.traverse_time = None
+        # None for the tier of the file manager
+        self.tier = tier
+        if not self.args.has_x and _is_cpp_source(self.filename):
+            all_args = ['-x', 'c++']
+            all_args.extend(self.args.all_args)
+            self.child_args = _CompileArgs(all_args, self.cwd, True)
+        else:
+            self.child_args = self.args
+
+    def add_reference(self, usr, loc, ref, name=None):
+        self.references.add(usr, loc, ref, name)
+
+    def add_include(self, inc):
+        self.includes.add(inc)
+
+    def add_base(self, derived_usr, base_usr, loc):
+        self.bases.add((derived_usr, base_usr, loc))
+
+    def make_child_compile_command(self, child_filename):
+        return _CompileCommand(child_filename, self.child_args, self.cwd, True)
 
 
 class _FileManager(object):
+    # files may have been indexed before, so their old rows must be deleted
+    replaces_rows = True
+
+    _stage_ids = itertools.count(1)
+
+    # id of the first symbol added for references staged since the last
+    # translation unit was saved or rejected
+    first_staged_symbol_id = None
+
     class File(object):
-        def __init__(self, path, last_update, is_included):
+        def __init__(self, path, last_update, is_included, tier):
             self.path = path
             self.last_update = last_update
             self.is_included = is_included
+            self.tier = tier
 
         def needs_update(self):
             return self.get_mtime() >= self.last_update
@@ -695,14 +3993,28 @@ class _FileManager(object):
         def get_mtime(self):
             return datetime.datetime.fromtimestamp(os.path.getmtime(self.path))
 
-    def __init__(self, root, conn, comp_db, inlines):
+    def __init__(self,
+                 root,
+                 conn,
+                 comp_db,
+                 inlines,
+                 tier,
+                 priority_paths=(),
+                 recent_since=None):
         self.root = root + os.path.sep
         self.conn = conn
         self.comp_db = comp_db
         self.inlines = inlines
+        self.tier = tier
+        self.priority_paths = frozenset(priority_paths)
+        self.recent_since = recent_since
+        self.queue = None
         self.visited = set()
         self.now = datetime.datetime.now()
         files = self._query_existing_files()
+        # a quick run must not throw away full indices of changed files
+        self.higher_tiers = dict((f.path, f.tier) for f in files
+                                 if f.tier > tier and not f.is_included)
         comp_db_paths = self.comp_db.get_all_files()
         src_paths = set()
         removed_paths = set()
@@ -722,12 +4034,15 @@ class _FileManager(object):
             else:
                 logger.warning("%s: file not found", f)
         removed_paths.update(self._remove_files(paths_to_remove))
+        self._remove_stale_failures(
+            comp_db_paths.union(f.path for f in files
+                                if f.path not in removed_paths))
         self.sources_to_update = set()
         self.headers_to_update = set()
         self.inlines_to_update = set()
         for f in files:
             if f.path not in removed_paths:
-                if f.needs_update():
+                if f.needs_update() or f.tier < self.tier:
                     if f.is_included:
                         if self._is_inline(f.path):
                             self.inlines_to_update.add(f.path)
@@ -762,14 +4077,135 @@ class _FileManager(object):
     def __iter__(self):
         return self
 
+    def get_tier(self, path):
+        """Return the tier at which a source file should be indexed.
+
+        Sources indexed at a higher tier than the one of this run before
+        are indexed at that tier again.
+        """
+        return self.higher_tiers.get(path, self.tier)
+
     def save_indices(self, indices):
         for idx in indices:
-            file_id = self._save_file(idx.filename, idx.cwd, idx.is_included)
+            file_id = self._save_file(idx.filename,
+                                      idx.cwd,
+                                      idx.is_included,
+                                      idx.parse_time,
+                                      idx.traverse_time,
+                                      idx.tier)
             idx.file_id = file_id
             self._save_args(file_id, idx.args.all_args)
-            self._save_refs(file_id, idx.references_by_usr)
+            if idx.stage_id is not None:
+                # the rest has to be merged with references staged before
+                self.stage_references(idx)
+            self._save_refs(file_id, idx.references)
+            if idx.stage_id is not None:
+                self._save_staged_refs(file_id, idx.stage_id)
+            self._save_bases(file_id, idx.bases)
         for idx in indices:
             self._save_includes(idx)
+        self.first_staged_symbol_id = None
+
+    def stage_references(self, idx):
+        """Move references of an index to the staged_refs temporary table.
+
+        Staged references are saved together with the index by
+        save_indices() or dropped by save_failure(), so that a huge
+        translation unit does not have to keep all references in memory.
+        """
+        if idx.stage_id is None:
+            idx.stage_id = next(self._stage_ids)
+        if self.first_staged_symbol_id is None:
+            self.first_staged_symbol_id = self._get_next_symbol_id()
+        cur = self.conn.cursor()
+        for usr, name, rows in idx.references.iter_by_usr():
+            symbol_id = self._save_symbol(usr, name)
+            cur.executemany("""
+                            INSERT INTO temp.staged_refs (
+                              stage_id,
+                              symbol_id,
+                              line,
+                              "column",
+                              data)
+                            VALUES (?, ?, ?, ?, ?)""",
+                            [(idx.stage_id,
+                              symbol_id,
+                              line,
+                              column,
+                              _pack_reference_data(is_definition,
+                                                   kind,
+                                                   length or 0))
+                             for line, column, (is_definition, kind, length)
+                             in rows])
+        idx.references.clear()
+
+    def is_known_failure(self, cmd):
+        cur = self.conn.cursor()
+        cur.execute("""
+                    SELECT
+                      id,
+                      fingerprint
+                    FROM failures
+                    WHERE path = ?""",
+                    (cmd.filename,))
+        failure = cur.fetchone()
+        if not failure:
+            return False
+        failure_id, fingerprint = failure
+        cur.execute("""
+                    SELECT path
+                    FROM failure_dependencies
+                    WHERE failure_id = ?""",
+                    (failure_id,))
+        dependencies = [tup[0] for tup in cur.fetchall()]
+        return _make_fingerprint(cmd, dependencies) == fingerprint
+
+    def save_failure(self, cmd, dependencies, errors):
+        dependencies = set(dependencies)
+        dependencies.add(cmd.filename)
+        dependencies.update(cmd.args.includes)
+        dependencies.update(_get_missing_header_paths(cmd, errors))
+        self.remove_failure(cmd.filename)
+        cur = self.conn.cursor()
+        cur.execute("DELETE FROM temp.staged_refs")
+        if self.first_staged_symbol_id is not None:
+            # no other translation unit refers to them yet
+            self._remove_symbols_since(self.first_staged_symbol_id)
+            self.first_staged_symbol_id = None
+        cur.execute("""
+                    INSERT INTO failures (
+                      path,
+                      fingerprint,
+                      last_attempt)
+                    VALUES (?, ?, ?)""",
+                    (cmd.filename,
+                     _make_fingerprint(cmd, dependencies),
+                     self.now))
+        failure_id = cur.lastrowid
+        cur.executemany("""
+                        INSERT INTO failure_dependencies (
+                          failure_id,
+                          path)
+                        VALUES (?, ?)""",
+                        [(failure_id, path) for path in dependencies])
+        cur.executemany("""
+                        INSERT INTO failure_diagnostics (
+                          failure_id,
+                          path,
+                          line,
+                          "column",
+                          spelling)
+                        VALUES (?, ?, ?, ?, ?)""",
+                        [(failure_id,
+                          e.location.filename,
+                          e.location.line,
+                          e.location.column,
+                          e.spelling)
+                         for e in errors])
+
+    def remove_failure(self, path):
+        cur = self.conn.cursor()
+        cur.execute("DELETE FROM failures WHERE path = ?", (path,))
 
     def remove_orphaned_includes(self):
         #
@@ -790,7 +4226,15 @@ class _FileManager(object):
             for inc in orphans:
                 cur.execute("DELETE FROM files WHERE id = ?", inc)
 
-    def _save_file(self, path, cwd, is_included):
+    def _save_file(self,
+                   path,
+                   cwd,
+                   is_included,
+                   parse_time=None,
+                   traverse_time=None,
+                   tier=None):
+        if tier is None:
+            tier = self.tier
         cur = self.conn.cursor()
         cur.execute("SELECT id FROM files WHERE path = ? LIMIT 1", (path,))
         file_id = cur.fetchone()
@@ -800,19 +4244,44 @@ class _FileManager(object):
                           path,
                           working_dir,
                           last_update,
-                          is_included)
-                        VALUES (?, ?, ?, ?)""",
-                        (path, cwd, self.now, is_included))
+                          is_included,
+                          tier,
+                          parse_time,
+                          traverse_time,
+                          generation)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, (
+                          SELECT value + 1 FROM meta
+                          WHERE key = 'generation'))""",
+                        (path,
+                         cwd,
+                         self.now,
+                         is_included,
+                         tier,
+                         parse_time,
+                         traverse_time))
             file_id = cur.lastrowid
         else:
             file_id = file_id[0]
+            # headers indexed as parts of other files keep their own times
             cur.execute("""
                         UPDATE files SET
                           working_dir = ?,
                           last_update = ?,
-                          is_included = ?
+                          is_included = ?,
+                          tier = ?,
+                          parse_time = COALESCE(?, parse_time),
+                          traverse_time = COALESCE(?, traverse_time),
+                          generation = (
+                            SELECT value + 1 FROM meta
+                            WHERE key = 'generation')
                         WHERE id = ?""",
-                        (cwd, self.now, is_included, file_id))
+                        (cwd,
+                         self.now,
+                         is_included,
+                         tier,
+                         parse_time,
+                         traverse_time,
+                         file_id))
         return file_id
 
     def _save_args(self, file_id, args):
@@ -829,20 +4298,37 @@ class _FileManager(object):
                             VALUES (?, ?)""",
                             [(file_id, arg) for arg in args])
 
-    def _save_refs(self, file_id, refs_by_usr):
+    def _get_next_symbol_id(self):
+        cur = self.conn.cursor()
+        cur.execute("SELECT IFNULL(MAX(id), 0) + 1 FROM symbols")
+        return cur.fetchone()[0]
+
+    def _remove_symbols_since(self, symbol_id):
+        cur = self.conn.cursor()
+        cur.execute("DELETE FROM symbols WHERE id >= ?", (symbol_id,))
+
+    def _save_symbol(self, usr, name=None):
+        cur = self.conn.cursor()
+        cur.execute("""
+                    SELECT id, name FROM symbols
+                    WHERE usr = ? LIMIT 1""",
+                    (usr,))
+        symbol = cur.fetchone()
+        if symbol is None:
+            cur.execute("INSERT INTO symbols (usr, name) VALUES (?, ?)",
+                        (usr, name))
+            return cur.lastrowid
+        symbol_id, old_name = symbol
+        if name is not None and old_name is None:
+            cur.execute("UPDATE symbols SET name = ? WHERE id = ?",
+                        (name, symbol_id))
+        return symbol_id
+
+    def _save_refs(self, file_id, refs):
         cur = self.conn.cursor()
         cur.execute("DELETE FROM refs WHERE file_id = ?", (file_id,))
-        for usr, refs in refs_by_usr.iteritems():
-            cur.execute("""
-                        SELECT id FROM symbols
-                        WHERE usr = ? LIMIT 1""",
-                        (usr,))
-            symbol_id = cur.fetchone()
-            if symbol_id is None:
-                cur.execute("INSERT INTO symbols (usr) VALUES (?)", (usr,))
-                symbol_id = cur.lastrowid
-            else:
-                symbol_id = symbol_id[0]
+        for usr, name, rows in refs.iter_by_usr():
+            symbol_id = self._save_symbol(usr, name)
             cur.executemany(
                 """
                 INSERT INTO refs (
@@ -851,21 +4337,71 @@ class _FileManager(object):
                   line,
                   "column",
                   kind,
-                  is_definition)
-                VALUES (?, ?, ?, ?, ?, ?)""",
+                  is_definition,
+                  length)
+                VALUES (?, ?, ?, ?, ?, ?, ?)""",
                 [(symbol_id,
+                  file_id,
+                  line,
+                  column,
+                  kind,
+                  is_definition,
+                  length)
+                 for line, column, (is_definition, kind, length) in rows])
+
+    def _save_staged_refs(self, file_id, stage_id):
+        cur = self.conn.cursor()
+        cur.execute("""
+                    INSERT INTO refs (
+                      symbol_id,
+                      file_id,
+                      line,
+                      "column",
+                      kind,
+                      is_definition,
+                      length)
+                    SELECT
+                      symbol_id,
+                      ?,
+                      line,
+                      "column",
+                      MAX(data) >> 15 & 65535,
+                      MAX(data) >> 31,
+                      NULLIF(MAX(data) & 32767, 0)
+                    FROM temp.staged_refs
+                    WHERE stage_id = ?
+                    GROUP BY symbol_id, line, "column"
+                    """,
+                    (file_id, stage_id))
+        cur.execute("DELETE FROM temp.staged_refs WHERE stage_id = ?",
+                    (stage_id,))
+
+    def _save_bases(self, file_id, bases):
+        cur = self.conn.cursor()
+        cur.execute("DELETE FROM inheritance WHERE file_id = ?", (file_id,))
+        if bases:
+            cur.executemany(
+                """
+                INSERT INTO inheritance (
+                  derived_symbol_id,
+                  base_symbol_id,
+                  file_id,
+                  line,
+                  "column")
+                VALUES (?, ?, ?, ?, ?)""",
+                [(self._save_symbol(derived_usr),
+                  self._save_symbol(base_usr),
                   file_id,
                   l.line,
-                  l.column,
-                  r.kind,
-                  r.is_definition)
-                 for l, r in refs.iteritems()])
+                  l.column)
+                 for derived_usr, base_usr, l in bases])
 
     def _save_includes(self, idx):
         cur = self.conn.cursor()
-        cur.execute("""
-                    DELETE FROM includes WHERE including_file_id = ?""",
-                    (idx.file_id,))
+        if self.replaces_rows:
+            cur.execute("""
+                        DELETE FROM includes WHERE including_file_id = ?""",
+                        (idx.file_id,))
         inc_values = []
         for inc in idx.includes:
             path = inc.included_path
@@ -895,29 +4431,65 @@ class _FileManager(object):
                             inc_values)
 
     def next(self):
-        if self.sources_to_add:
-            path = self.sources_to_add.pop()
-            self.visited.add(path)
-            return self.comp_db.get_compile_command(path)
-        elif self.sources_to_update:
-            path = self.sources_to_update.pop()
+        if self.queue is None:
+            self.queue = self._make_queue()
+        while self.queue:
+            _, _, phase, path = heapq.heappop(self.queue)
+            pending = self._get_phases()[phase]
+            if path not in pending:
+                # claimed by a file indexed before
+                continue
+            pending.remove(path)
+            if pending is self.inlines_to_update:
+                path = self._query_including_file(path)
+                if not path:
+                    continue
+                self.visited.add(path)
+                return self._query_compile_command(path)
             self.visited.add(path)
+            if pending is self.headers_to_update:
+                return self._query_compile_command(path)
             cmd = self.comp_db.get_compile_command(path)
-            if not cmd:
+            if not cmd and pending is self.sources_to_update:
                 cmd = self._query_compile_command(path)
             return cmd
-        elif self.headers_to_update:
-            path = self.headers_to_update.pop()
-            self.visited.add(path)
-            return self._query_compile_command(path)
-        else:
-            while self.inlines_to_update:
-                inline_path = self.inlines_to_update.pop()
-                path = self._query_including_file(inline_path)
-                if path:
-                    self.visited.add(path)
-                    return self._query_compile_command(path)
-            raise StopIteration
+        raise StopIteration
+
+    # new and updated sources are ordered together
+    _PHASE_RANKS = (0, 0, 1, 2)
+
+    def _get_phases(self):
+        return (self.sources_to_add,
+                self.sources_to_update,
+                self.headers_to_update,
+                self.inlines_to_update)
+
+    def _make_queue(self):
+        """Return a heap of files to index.
+
+        Prioritized files go first.  Otherwise sources go before headers,
+        which may be claimed by them.
+        """
+        queue = []
+        for phase, paths in enumerate(self._get_phases()):
+            rank = self._PHASE_RANKS[phase]
+            for path in paths:
+                queue.append((not self._is_prioritized(path),
+                              rank,
+                              phase,
+                              path))
+        heapq.heapify(queue)
+        return queue
+
+    def _is_prioritized(self, path):
+        if path in self.priority_paths:
+            return True
+        if self.recent_since is None:
+            return False
+        try:
+            return os.path.getmtime(path) >= self.recent_since
+        except OSError:
+            return False
 
     def _query_existing_files(self):
         cur = self.conn.cursor()
@@ -925,7 +4497,8 @@ class _FileManager(object):
                     SELECT
                       path,
                       last_update as "last_update [timestamp]",
-                      is_included
+                      is_included,
+                      tier
                     FROM files
                     ORDER BY path""")
         return [self.File(*tup) for tup in cur.fetchall()]
@@ -959,27 +4532,7 @@ class _FileManager(object):
         return including_file_path[0]
 
     def _query_compile_command(self, path):
-        cur = self.conn.cursor()
-        cur.execute("""
-                    SELECT
-                      id,
-                      working_dir,
-                      is_included
-                    FROM files
-                    WHERE path = ?""",
-                    (path,))
-        file_id, cwd, is_included = cur.fetchone()
-        cur.execute("""
-                    SELECT arg
-                    FROM compile_args
-                    WHERE file_id = ?
-                    ORDER BY id""",
-                    (file_id,))
-        args = [tup[0] for tup in cur.fetchall()]
-        return _CompileCommand(path,
-                               _make_compile_args(cwd, args, [], []),
-                               cwd,
-                               is_included)
+        return _query_compile_command(self.conn, path)
 
     def _remove_files(self, paths):
         cur = self.conn.cursor()
@@ -1002,6 +4555,7 @@ class _FileManager(object):
             else:
                 cur.execute("DELETE FROM files WHERE id = ?", file_id)
                 removed.add(path)
+            self.remove_failure(path)
         return removed
 
     def _remove_non_existent_file(self, path):
@@ -1011,53 +4565,449 @@ class _FileManager(object):
         file_id = cur.fetchone()
         if file_id:
             cur.execute("DELETE FROM files WHERE id = ?", file_id)
+        self.remove_failure(path)
+
+    def _remove_stale_failures(self, known_paths):
+        cur = self.conn.cursor()
+        cur.execute("SELECT path FROM failures")
+        for path in [tup[0] for tup in cur.fetchall()]:
+            if path not in known_paths:
+                self.remove_failure(path)
+
+
+class _BulkFileManager(_FileManager):
+    """File manager that fills an empty database created by _rebuild_db().
+
+    No file has been indexed before, so nothing is deleted before saving.
+    Symbol ids are kept in memory and rows are inserted in large batches
+    sorted by primary keys.  The connection is given later by start(), when
+    all settings of the new database are in place.
+    """
+
+    replaces_rows = False
+
+    _BATCH_SIZE = 500000
+
+    def __init__(self,
+                 root,
+                 conn,
+                 comp_db,
+                 inlines,
+                 tier,
+                 priority_paths=(),
+                 recent_since=None):
+        self.root = root + os.path.sep
+        self.conn = conn
+        self.comp_db = comp_db
+        self.inlines = inlines
+        self.tier = tier
+        self.priority_paths = frozenset(priority_paths)
+        self.recent_since = recent_since
+        self.queue = None
+        self.higher_tiers = {}
+        self.visited = set()
+        self.now = datetime.datetime.now()
+        self.sources_to_add = set()
+        for path in self.comp_db.get_all_files():
+            if os.path.exists(path):
+                self.sources_to_add.add(path)
+            else:
+                logger.warning("%s: file not found", path)
+        self.sources_to_update = set()
+        self.headers_to_update = set()
+        self.inlines_to_update = set()
+        self.symbol_ids = {}
+        self.new_symbols = []
+        self.new_args = []
+        self.new_refs = []
+        self.new_bases = []
+
+    def start(self, conn):
+        self.conn = conn
+
+    def save_indices(self, indices):
+        _FileManager.save_indices(self, indices)
+        if len(self.new_refs) >= self._BATCH_SIZE:
+            self.flush()
+
+    def remove_orphaned_includes(self):
+        self.flush()
+        # orphans are deleted with their rows by cascades, which need foreign
+        # keys and indices
+        logger.info("creating indices")
+        _create_schema(self.conn)
+        self.conn.cursor().execute("PRAGMA foreign_keys=ON")
+        _FileManager.remove_orphaned_includes(self)
+
+    def flush(self):
+        """Insert all buffered rows into the database."""
+        cur = self.conn.cursor()
+        cur.executemany("""
+                        INSERT INTO symbols (
+                          id,
+                          usr,
+                          name)
+                        VALUES (?, ?, ?)""",
+                        self.new_symbols)
+        cur.executemany("""
+                        INSERT INTO compile_args (
+                          file_id,
+                          arg)
+                        VALUES (?, ?)""",
+                        self.new_args)
+        self.new_refs.sort()
+        cur.executemany("""
+                        INSERT INTO refs (
+                          symbol_id,
+                          file_id,
+                          line,
+                          "column",
+                          kind,
+                          is_definition,
+                          length)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                        self.new_refs)
+        self.new_bases.sort()
+        cur.executemany("""
+                        INSERT INTO inheritance (
+                          derived_symbol_id,
+                          base_symbol_id,
+                          file_id,
+                          line,
+                          "column")
+                        VALUES (?, ?, ?, ?, ?)""",
+                        self.new_bases)
+        self.new_symbols = []
+        self.new_args = []
+        self.new_refs = []
+        self.new_bases = []
+
+    def _get_next_symbol_id(self):
+        return len(self.symbol_ids) + 1
+
+    def _remove_symbols_since(self, symbol_id):
+        self.symbol_ids = dict((usr, i)
+                               for usr, i in self.symbol_ids.iteritems()
+                               if i < symbol_id)
+        self.new_symbols = [s for s in self.new_symbols if s[0] < symbol_id]
+        _FileManager._remove_symbols_since(self, symbol_id)
+
+    def _save_symbol(self, usr, name=None):
+        symbol_id = self.symbol_ids.get(usr, None)
+        if symbol_id is None:
+            symbol_id = len(self.symbol_ids) + 1
+            self.symbol_ids[usr] = symbol_id
+            self.new_symbols.append((symbol_id, usr, name))
+        return symbol_id
+
+    def _save_args(self, file_id, args):
+        self.new_args.extend((file_id, arg) for arg in args)
+
+    def _save_refs(self, file_id, refs):
+        for usr, name, rows in refs.iter_by_usr():
+            symbol_id = self._save_symbol(usr, name)
+            self.new_refs.extend(
+                (symbol_id, file_id, line, column, kind, is_definition, length)
+                for line, column, (is_definition, kind, length) in rows)
+
+    def _save_bases(self, file_id, bases):
+        self.new_bases.extend((self._save_symbol(derived_usr),
+                               self._save_symbol(base_usr),
+                               file_id,
+                               l.line,
+                               l.column)
+                              for derived_usr, base_usr, l in bases)
+
+
+class _TargetedFileManager(_FileManager):
+    """File manager that updates only given files and headers they claim.
+
+    Instead of loading all files of the project, it looks up only the files
+    it is asked about.
+    """
+
+    def __init__(self, root, conn, comp_db, inlines, paths):
+        self.root = root + os.path.sep
+        self.conn = conn
+        self.comp_db = comp_db
+        self.inlines = inlines
+        self.tier = _TIERS['full']
+        self.priority_paths = frozenset()
+        self.recent_since = None
+        self.queue = None
+        self.higher_tiers = {}
+        self.visited = set()
+        self.now = datetime.datetime.now()
+        self.orphan_candidates = set()
+        self.sources_to_add = set()
+        self.sources_to_update = set()
+        self.headers_to_update = set()
+        self.inlines_to_update = set()
+        for path in paths:
+            f = self._query_file(path)
+            if not os.path.exists(path):
+                logger.warning("%s: file not found", path)
+                if f:
+                    self._remember_includes(path)
+                    self._remove_non_existent_file(path)
+            elif self.comp_db.has_file(path):
+                if f is None or f.is_included:
+                    self.sources_to_add.add(path)
+                else:
+                    self.sources_to_update.add(path)
+            elif f is None:
+                continue
+            elif not f.is_included:
+                self._remember_includes(path)
+                self._remove_files([path])
+            elif self._is_inline(path):
+                self.inlines_to_update.add(path)
+            else:
+                self.headers_to_update.add(path)
+
+    def should_index(self, path):
+        if (path in self.visited or
+                path in self.inlines_to_update or
+                path in self.headers_to_update or
+                path in self.sources_to_add or
+                path in self.sources_to_update):
+            return _FileManager.should_index(self, path)
+        self.visited.add(path)
+        if not path.startswith(self.root):
+            return False
+        f = self._query_file(path)
+        return f is None or (bool(f.is_included) and
+                             (f.needs_update() or f.tier < self.tier))
+
+    def remove_orphaned_includes(self):
+        cur = self.conn.cursor()
+        while self.orphan_candidates:
+            file_id = self.orphan_candidates.pop()
+            cur.execute("""
+                        SELECT EXISTS (
+                            SELECT 1
+                            FROM includes
+                            WHERE included_file_id = ?
+                            LIMIT 1)""",
+                        (file_id,))
+            if cur.fetchone()[0]:
+                continue
+            cur.execute("""
+                        SELECT path
+                        FROM files
+                        WHERE id = ? AND is_included = 1""",
+                        (file_id,))
+            path = cur.fetchone()
+            if path:
+                self._remember_includes(path[0])
+                cur.execute("DELETE FROM files WHERE id = ?", (file_id,))
+
+    def _save_includes(self, idx):
+        self._remember_includes(idx.filename)
+        _FileManager._save_includes(self, idx)
+
+    def _remember_includes(self, path):
+        cur = self.conn.cursor()
+        cur.execute("""
+                    SELECT
+                      i.included_file_id
+                    FROM includes i
+                    INNER JOIN files f ON (i.including_file_id = f.id)
+                    WHERE
+                      f.path = ?""",
+                    (path,))
+        self.orphan_candidates.update(tup[0] for tup in cur.fetchall())
+
+    def _query_file(self, path):
+        cur = self.conn.cursor()
+        cur.execute("""
+                    SELECT
+                      path,
+                      last_update as "last_update [timestamp]",
+                      is_included,
+                      tier
+                    FROM files
+                    WHERE path = ?""",
+                    (path,))
+        f = cur.fetchone()
+        if f is None:
+            return None
+        return self.File(*f)
+
+
+class _OverlayFileManager(_FileManager):
+    """File manager that saves indices of unsaved buffers into an overlay.
+
+    Only the buffered files are indexed.  Files included from them are saved
+    without any data, so that the inclusions can be recorded.
+    """
+
+    def __init__(self, root, conn, paths):
+        self.root = root + os.path.sep
+        self.conn = conn
+        self.paths = paths
+        self.tier = _TIERS['full']
+        self.higher_tiers = {}
+        self.visited = set()
+        self.now = datetime.datetime.now()
+
+    def should_index(self, path):
+        if path in self.visited or path not in self.paths:
+            return False
+        self.visited.add(path)
+        return True
+
+    def _save_includes(self, idx):
+        cur = self.conn.cursor()
+        for inc in idx.includes:
+            cur.execute("SELECT 1 FROM files WHERE path = ? LIMIT 1",
+                        (inc.included_path,))
+            if cur.fetchone() is None:
+                self._save_file(inc.included_path, idx.cwd, True)
+        _FileManager._save_includes(self, idx)
+
+
+# identifiers, destructor names and single characters of other tokens
+_TOKEN_RE = re.compile(r"~?\w+|\S")
 
 
 class Indexer(object):
-    def __init__(self, file_manager, cmd):
+    def __init__(self,
+                 file_manager,
+                 cmd,
+                 quick_tier_macros=True,
+                 unsaved_files=None,
+                 reference_chunk_size=None):
         self.file_manager = file_manager
+        self.tier = file_manager.get_tier(cmd.filename)
+        self.quick = self.tier < _TIERS['full']
+        self.record_macros = quick_tier_macros or not self.quick
         self.filename = cmd.filename
         self.cwd = cmd.current_dir
         self.args = cmd.args
-        self.src_index = _Index(cmd)
+        self.usrs = _UsrTable()
+        self.src_index = _Index(cmd, self.usrs, self.tier)
         self.is_included = cmd.is_included
         self.idx_by_path = {self.filename: self.src_index}
+        self.unsaved_files = unsaved_files
+        # references are staged by the file manager in chunks of this size
+        self.reference_chunk_size = reference_chunk_size
+        self.buffered_references = 0
+        self.peak_reference_size = 0
         self.errors = []
+        self.dependencies = set()
+        # lines of indexed files, which bound the tokens of references
+        self.lines_by_path = {}
 
     def index(self):
-        clang_index = clang.cindex.Index.create()
+        cindex = _import_clang()
+        clang_index = cindex.Index.create()
         logger.debug("parsing %s: %s",
                      self.filename,
                      " ".join(self.args.all_args))
+        options = cindex.TranslationUnit.PARSE_INCOMPLETE
+        if self.quick:
+            options |= cindex.TranslationUnit.PARSE_SKIP_FUNCTION_BODIES
+        if self.record_macros:
+            options |= \
+                cindex.TranslationUnit.PARSE_DETAILED_PROCESSING_RECORD
+        start_time = time.time()
         unit = clang_index.parse(
             self.filename,
             self.args.all_args,
-            None,
-            clang.cindex.TranslationUnit.PARSE_INCOMPLETE |
-            clang.cindex.TranslationUnit.PARSE_DETAILED_PROCESSING_RECORD)
+            self.unsaved_files,
+            options)
+        parse_end_time = time.time()
         self._find_references(unit.cursor)
+        self._update_peak_reference_size()
         self._sort_includes(unit.get_includes())
         self._populate_errors(unit.diagnostics)
+        self.src_index.parse_time = parse_end_time - start_time
+        self.src_index.traverse_time = time.time() - parse_end_time
 
-    def _find_references(self, cursor):
+    def _find_references(self, cursor, parent=None):
         location = cursor.location
         if not location.file:
             for child_cursor in cursor.get_children():
-                self._find_references(child_cursor)
+                self._find_references(child_cursor, cursor)
         else:
             path = unicode(os.path.abspath(location.file.name))
             idx = self._get_index(path)
             if idx:
-                if cursor.referenced:
-                    usr = cursor.referenced.get_usr()
-                    if usr and usr != "c:":
-                        idx.add_reference(
-                            usr,
-                            _LocationInFile(location.line, location.column),
-                            _ReferenceData(cursor.is_definition(),
-                                           cursor.kind.from_param()))
+                self._add_cursor_reference(idx, cursor, location, parent)
                 for child_cursor in cursor.get_children():
-                    self._find_references(child_cursor)
+                    self._find_references(child_cursor, cursor)
+
+    def _add_cursor_reference(self, idx, cursor, location, parent):
+        if not cursor.referenced or not self._should_save(cursor):
+            return
+        usr = _from_utf8(cursor.referenced.get_usr())
+        if not usr or usr == u"c:":
+            return
+        kind = cursor.kind.from_param()
+        loc = _LocationInFile(location.line, location.column)
+        name = None
+        # the name is stored once for each interned USR
+        if usr not in self.usrs.ids:
+            name = _from_utf8(cursor.referenced.spelling)
+        length = self._get_token_length(idx.filename, loc)
+        idx.add_reference(usr,
+                          loc,
+                          _ReferenceData(cursor.is_definition(), kind, length),
+                          name)
+        if kind == _BASE_SPECIFIER_KIND and parent:
+            derived_usr = _from_utf8(parent.get_usr())
+            if derived_usr:
+                idx.add_base(derived_usr, usr, loc)
+        self._reference_added()
+
+    def _get_token_length(self, path, loc):
+        """Return the length of the token at a location or 0 if unknown."""
+        lines = self.lines_by_path.get(path, None)
+        if lines is None:
+            lines = self._read_lines(path)
+            self.lines_by_path[path] = lines
+        if not 0 < loc.line <= len(lines):
+            return 0
+        match = _TOKEN_RE.match(lines[loc.line - 1], loc.column - 1)
+        return len(match.group()) if match else 0
+
+    def _read_lines(self, path):
+        for name, contents in self.unsaved_files or []:
+            if os.path.abspath(name) == path:
+                return _to_utf8(contents).split('\n')
+        try:
+            with open(path, 'rb') as f:
+                return f.read().split('\n')
+        except IOError:
+            return []
+
+    def _reference_added(self):
+        self.buffered_references += 1
+        if self.buffered_references == self.reference_chunk_size:
+            self._stage_references()
+
+    def _stage_references(self):
+        self._update_peak_reference_size()
+        for idx in self.idx_by_path.itervalues():
+            if len(idx.references):
+                self.file_manager.stage_references(idx)
+        # all interned USRs have been written out with the references
+        self.usrs.clear()
+        self.buffered_references = 0
+
+    def _update_peak_reference_size(self):
+        size = self.usrs.size + sum(idx.references.get_size()
+                                    for idx in self.idx_by_path.itervalues())
+        self.peak_reference_size = max(self.peak_reference_size, size)
+
+    def _should_save(self, cursor):
+        if not self.quick:
+            return True
+        kind = cursor.kind.from_param()
+        return (kind == _BASE_SPECIFIER_KIND or
+                kind == _MACRO_DEFINITION_KIND or
+                cursor.kind.is_declaration())
 
     def _get_index(self, path):
         idx = self.idx_by_path.get(path, None)
@@ -1067,7 +5017,9 @@ class Indexer(object):
         return idx
 
     def _make_child_index(self, path):
-        return _Index(self.src_index.make_child_compile_command(path))
+        return _Index(self.src_index.make_child_compile_command(path),
+                      self.usrs,
+                      self.tier)
 
     def _populate_errors(self, diags):
         def translate_diag(diag):
@@ -1081,13 +5033,14 @@ class Indexer(object):
                           diag.disable_option)
         self.errors = [translate_diag(d)
                        for d in diags
-                       if d.severity >= clang.cindex.Diagnostic.Error]
+                       if d.severity >= _import_clang().Diagnostic.Error]
 
     def _sort_includes(self, includes):
         if not self.is_included:
             for inc in self.args.includes:
                 self.src_index.add_include(_FileInclusion(inc, 0, 0))
         for inc in includes:
+            self.dependencies.add(os.path.normpath(inc.include.name))
             if inc.source:
                 idx = self.idx_by_path.get(inc.source.name, None)
                 if idx: